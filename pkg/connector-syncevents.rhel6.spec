@@ -62,6 +62,8 @@ rm -rf $RPM_BUILD_ROOT
 %attr(640,root,vigilo-syncevents) %config(noreplace) %{_sysconfdir}/vigilo/%{module}/settings.ini
 %attr(644,root,root) %config(noreplace) %{_sysconfdir}/cron.d/*
 %{python_sitelib}/vigilo*
+%dir %{_localstatedir}/lib/vigilo
+%attr(-,vigilo-syncevents,vigilo-syncevents) %{_localstatedir}/lib/vigilo/%{module}
 %attr(-,vigilo-syncevents,vigilo-syncevents) %{_localstatedir}/lock/subsys/vigilo-connector-syncevents
 
 %changelog
@@ -66,6 +66,8 @@ rm -rf $RPM_BUILD_ROOT
 %attr(640,root,vigilo-syncevents) %config(noreplace) %{_sysconfdir}/vigilo/%{module}/settings.ini
 %attr(644,root,root) %config(noreplace) %{_sysconfdir}/cron.d/*
 %{python_sitelib}/vigilo*
+%dir %{_localstatedir}/lib/vigilo
+%attr(-,vigilo-syncevents,vigilo-syncevents) %{_localstatedir}/lib/vigilo/%{module}
 %attr(644,root,root) %{_tmpfilesdir}/%{name}.conf
 
 %changelog
@@ -73,6 +73,7 @@ setup(name='vigilo-connector-syncevents',
                         ["pkg/vigilo-connector-syncevents%s" % cronext]),
                     (os.path.join(localstatedir, "lock/subsys"), []),
                     (os.path.join(localstatedir, "lock/subsys/vigilo-connector-syncevents"), []),
+                    (os.path.join(localstatedir, "lib/vigilo/connector-syncevents"), []),
                    ] + install_i18n("i18n", os.path.join(sys.prefix, "share", "locale")),
         )
 
@@ -0,0 +1,202 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Ajustement automatique du nombre maximum de demandes par exécution.
+
+Le nombre de demandes autorisées (budget) augmente progressivement tant que
+le bus et les collecteurs Nagios absorbent la charge, et diminue fortement
+dès qu'ils semblent saturés (augmentation additive, diminution
+multiplicative) :
+
+    - la latence moyenne de publication d'un message sur le bus dépasse
+      le seuil configuré ;
+    - l'envoi des demandes approche du délai maximum autorisé ;
+    - une trop faible proportion des éléments pour lesquels une demande
+      a été envoyée lors de l'exécution précédente a vu son état mis à jour
+      depuis (Nagios ou le corrélateur ne suivent pas).
+"""
+
+import random
+from datetime import datetime
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+from vigilo.connector_syncevents.state import DATE_FORMAT
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+
+
+class AdaptiveBudget(object):
+    """
+    Nombre maximum de demandes de mise à jour par exécution, ajusté
+    d'après les exécutions précédentes. Le budget et les éléments à
+    vérifier sont enregistrés dans une section du fichier d'état.
+    """
+
+    def __init__(self, state, minimum, maximum, initial=None,
+                 increase=None, decrease=0.5, latency_target=1.0,
+                 min_refreshed=0.8, timeout=0, sample_size=100):
+        """
+        @param state: Section du fichier d'état réservée au budget.
+        @type  state: C{dict}
+        @param minimum: Budget minimum.
+        @type  minimum: C{int}
+        @param maximum: Budget maximum.
+        @type  maximum: C{int}
+        @param initial: Budget lors de la première exécution
+            (par défaut, le budget minimum).
+        @type  initial: C{int}
+        @param increase: Augmentation du budget après une exécution qui
+            l'a entièrement consommé sans signe de saturation (par défaut,
+            un dixième du budget minimum).
+        @type  increase: C{int}
+        @param decrease: Facteur appliqué au budget en cas de saturation.
+        @type  decrease: C{float}
+        @param latency_target: Latence moyenne de publication (en secondes)
+            au-delà de laquelle le bus est considéré comme saturé.
+        @type  latency_target: C{float}
+        @param min_refreshed: Proportion minimale des éléments demandés lors
+            de l'exécution précédente dont l'état doit avoir été mis à jour.
+        @type  min_refreshed: C{float}
+        @param timeout: Délai maximum (en secondes) autorisé pour l'envoi
+            des demandes, ou 0.
+        @type  timeout: C{float}
+        @param sample_size: Nombre d'éléments demandés conservés pour
+            vérifier la mise à jour de leur état.
+        @type  sample_size: C{int}
+        """
+        self.state = state
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        if increase is None:
+            increase = max(1, self.minimum // 10)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.min_refreshed = min_refreshed
+        self.timeout = timeout
+        self.sample_size = sample_size
+        budget = state.get("budget", initial or self.minimum)
+        self.budget = min(self.maximum, max(self.minimum, int(budget)))
+        # Mesures relatives à l'exécution en cours.
+        self.refreshed = None
+        self.sent = 0
+        self._sample = []
+        self._requested_at = None
+
+
+    def check(self, now, count_refreshed):
+        """
+        Vérifie si l'état des éléments demandés lors de l'exécution
+        précédente a été mis à jour depuis.
+
+        @param now: Date de l'exécution en cours.
+        @type  now: C{datetime.datetime}
+        @param count_refreshed: Fonction renvoyant le nombre d'éléments
+            (parmi ceux passés en paramètre) dont l'état a été mis à jour
+            depuis la date passée en paramètre
+            (voir L{vigilo.connector_syncevents.desync.count_refreshed}).
+        @type  count_refreshed: C{callable}
+        """
+        self._requested_at = now
+        pending = self.state.get("pending")
+        requested_at = self.state.get("requested_at")
+        if not pending or not requested_at:
+            return
+        since = datetime.strptime(requested_at, DATE_FORMAT)
+        supitems = [ tuple(supitem) for supitem in pending ]
+        self.refreshed = count_refreshed(supitems, since) / float(len(pending))
+        LOGGER.debug(_("%(ratio).0f%% of the items requested at %(date)s "
+                       "have been refreshed"),
+                     {"ratio": self.refreshed * 100, "date": requested_at})
+
+
+    def track(self, supitems):
+        """
+        Compte les éléments pour lesquels une demande a été publiée et en
+        conserve un échantillon (tirage aléatoire uniforme), pour vérifier
+        lors de l'exécution suivante que leur état a bien été mis à jour.
+
+        @param supitems: Hôtes/services pour lesquels une demande
+            a été publiée.
+        @type  supitems: C{list}
+        """
+        for supitem in supitems:
+            self.sent += 1
+            key = (supitem.hostname, supitem.servicename)
+            if len(self._sample) < self.sample_size:
+                self._sample.append(key)
+            else:
+                index = random.randint(0, self.sent - 1)
+                if index < self.sample_size:
+                    self._sample[index] = key
+
+
+    def congested(self, sender=None):
+        """
+        @param sender: Objet ayant envoyé les demandes, ou C{None}.
+        @type  sender: L{vigilo.connector_syncevents.sender.SyncSender}
+        @return: Raison pour laquelle le bus ou les collecteurs semblent
+            saturés, ou C{None}.
+        @rtype: C{unicode}
+        """
+        if self.refreshed is not None and \
+                self.refreshed < self.min_refreshed:
+            return _("too few items were refreshed")
+        if sender is None or not sender.messages:
+            return None
+        latency = sender.publish_time / sender.messages
+        if latency > self.latency_target:
+            return _("publishing latency is %.2fs") % latency
+        if self.timeout and sender.duration > 0.8 * self.timeout:
+            return _("publishing took %.1fs") % sender.duration
+        return None
+
+
+    def finish(self, sender=None):
+        """
+        Ajuste le budget à l'issue d'une exécution.
+
+        @param sender: Objet ayant envoyé les demandes, ou C{None}
+            si aucune demande n'a été envoyée.
+        @type  sender: L{vigilo.connector_syncevents.sender.SyncSender}
+        """
+        previous = self.budget
+        reason = self.congested(sender)
+        if reason is not None:
+            self.budget = max(self.minimum, int(self.budget * self.decrease))
+        elif self.sent >= self.budget:
+            # Le budget a limité l'exécution sans signe de saturation.
+            self.budget = min(self.maximum, self.budget + self.increase)
+        if self.budget < previous:
+            LOGGER.info(_("Reducing the number of requests per run from "
+                          "%(old)d to %(new)d: %(reason)s"),
+                        {"old": previous, "new": self.budget,
+                         "reason": reason})
+        elif self.budget > previous:
+            LOGGER.debug(_("Increasing the number of requests per run "
+                           "from %(old)d to %(new)d"),
+                         {"old": previous, "new": self.budget})
+
+
+    def flush(self):
+        """
+        Recopie le budget et les éléments à vérifier dans la section
+        du fichier d'état, et prépare l'exécution suivante.
+        """
+        self.state["budget"] = self.budget
+        self.state["pending"] = self._sample
+        if self._requested_at is not None and self._sample:
+            self.state["requested_at"] = \
+                self._requested_at.strftime(DATE_FORMAT)
+        else:
+            self.state.pop("requested_at", None)
+        self.refreshed = None
+        self.sent = 0
+        self._sample = []
+        self._requested_at = None
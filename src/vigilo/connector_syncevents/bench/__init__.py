@@ -0,0 +1,196 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Outils communs aux bancs d'essai du connecteur syncevents.
+
+Les bancs d'essai génèrent un parc synthétique dans une base de données
+dédiée (SQLite ou PostgreSQL) : ils ne doivent jamais être lancés sur
+la base de données de production.
+"""
+
+from __future__ import print_function
+import sys
+import time
+from datetime import datetime, timedelta
+
+from vigilo.common.conf import settings
+settings.load_module(__name__)
+
+
+STATENAMES = [
+    (u'OK', 1), (u'UNKNOWN', 2), (u'WARNING', 3), (u'CRITICAL', 4),
+    (u'UP', 1), (u'UNREACHABLE', 2), (u'DOWN', 4),
+]
+
+
+def configure(url):
+    """
+    Configure l'accès à la base de données du banc d'essai.
+    Doit être appelée avant tout import du module
+    C{vigilo.connector_syncevents.desync}.
+
+    @param url: URL SQLAlchemy de la base de données.
+    @type  url: C{str}
+    """
+    from vigilo.models.configure import configure_db
+    settings['database']['sqlalchemy_url'] = url
+    settings['database']['sqlalchemy_echo'] = 'false'
+    configure_db(settings['database'], 'sqlalchemy_')
+
+
+def create_schema():
+    """Crée les tables, puis les vues, du modèle de Vigilo."""
+    from vigilo.models.session import metadata
+    mapped_tables = metadata.tables.copy()
+    views = {}
+    for tablename in mapped_tables:
+        info = mapped_tables[tablename].info or {}
+        if info.get('vigilo_view'):
+            views[tablename] = mapped_tables[tablename]
+    for view in views:
+        del mapped_tables[view]
+    metadata.create_all(tables=mapped_tables.values())
+    metadata.create_all(tables=views.values())
+
+
+def is_seeded():
+    """
+    @return: Indique si la base contient déjà un parc synthétique.
+    @rtype: C{bool}
+    """
+    from vigilo.models.session import DBSession
+    from vigilo.models import tables
+    return DBSession.query(tables.Host.idhost).first() is not None
+
+
+def seed_fleet(collectors, hosts, services, stale=0.05, down=0.01,
+               desync=0.01, hls=0, progress=True, correvents=0):
+    """
+    Génère un parc synthétique.
+
+    @param collectors: Nombre de collecteurs Nagios.
+    @type  collectors: C{int}
+    @param hosts: Nombre d'hôtes.
+    @type  hosts: C{int}
+    @param services: Nombre de services de bas niveau par hôte.
+    @type  services: C{int}
+    @param stale: Proportion d'états non-OK et trop anciens.
+    @type  stale: C{float}
+    @param down: Proportion d'hôtes DOWN.
+    @type  down: C{float}
+    @param desync: Proportion de services dont l'état ne correspond pas
+        à l'événement (ouvert) associé.
+    @type  desync: C{float}
+    @param hls: Nombre de services de haut niveau.
+    @type  hls: C{int}
+    @param progress: Affiche la progression sur la sortie d'erreur.
+    @type  progress: C{bool}
+    @param correvents: Proportion des services dans un état non-OK et trop
+        ancien associés à un événement corrélé ouvert.
+    @type  correvents: C{float}
+    """
+    import transaction
+    from vigilo.models.session import DBSession
+    from vigilo.models import tables
+    from vigilo.models.demo import functions as df
+
+    for statename, order in STATENAMES:
+        DBSession.add(tables.StateName(statename=statename, order=order))
+    DBSession.flush()
+    df.add_application(u"nagios")
+    for c in range(collectors):
+        df.add_vigiloserver(u"collector%d" % c)
+
+    now = datetime.utcnow()
+    old = now - timedelta(hours=2)
+    # Répartition déterministe, pour que les résultats soient comparables
+    # d'une exécution à l'autre.
+    def pick(index, ratio):
+        return ratio and (index % int(round(1 / ratio)) == 0)
+
+    count = stale_count = 0
+    for h in range(hosts):
+        host = df.add_host(u"host%d" % h)
+        df.add_ventilation(host, u"collector%d" % (h % collectors), u"nagios")
+        if pick(h, down):
+            df.add_host_state(host, u"DOWN", timestamp=old)
+        else:
+            df.add_host_state(host, u"UP", timestamp=now)
+        for s in range(services):
+            count += 1
+            svc = df.add_lowlevelservice(host, u"service%d" % s)
+            if pick(count, stale):
+                df.add_svc_state(svc, u"CRITICAL", timestamp=old)
+                stale_count += 1
+                if pick(stale_count, correvents):
+                    event = df.add_event(svc, u"CRITICAL", u"benchmark")
+                    df.add_correvent([event])
+            elif pick(count + 1, desync):
+                df.add_svc_state(svc, u"WARNING", timestamp=now)
+                event = df.add_event(svc, u"CRITICAL", u"benchmark")
+                df.add_correvent([event])
+            else:
+                df.add_svc_state(svc, u"OK", timestamp=now)
+        if progress and h % 1000 == 999:
+            print("%d/%d hosts" % (h + 1, hosts), file=sys.stderr)
+            transaction.commit()
+    for i in range(hls):
+        svc = df.add_highlevelservice(u"hls%d" % i)
+        df.add_svc_state(svc, u"OK" if pick(i, stale) else u"UNKNOWN",
+                         timestamp=old)
+    transaction.commit()
+
+
+def timed(func, repeat=1):
+    """
+    Mesure la durée d'exécution d'une fonction.
+
+    @param func: Fonction à appeler (sans argument).
+    @type  func: C{callable}
+    @param repeat: Nombre d'appels.
+    @type  repeat: C{int}
+    @return: Durées mesurées (en secondes) et résultat du dernier appel.
+    @rtype: C{tuple}
+    """
+    durations = []
+    result = None
+    for _i in range(repeat):
+        start = time.time()
+        result = func()
+        durations.append(time.time() - start)
+    return durations, result
+
+
+def peak_rss():
+    """
+    @return: Mémoire résidente maximale du processus courant (en Kio),
+        ou 0 si elle ne peut pas être mesurée.
+    @rtype: C{int}
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Valeur exprimée en octets sous Mac OS X.
+        usage //= 1024
+    return int(usage)
+
+
+def percentile(values, ratio):
+    """
+    @param values: Valeurs mesurées.
+    @type  values: C{list}
+    @param ratio: Rang du centile (entre 0 et 1).
+    @type  ratio: C{float}
+    @return: Centile demandé (plus proche rang).
+    @rtype: C{float}
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round(ratio * (len(values) - 1)))
+    return values[index]
@@ -0,0 +1,372 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Banc d'essai de la chaîne complète de resynchronisation.
+
+Sur un parc synthétique de taille paramétrable, mesure la recherche des
+éléments désynchronisés, la construction des messages pour Nagios et leur
+publication (sur un bus factice, qui se contente de sérialiser les
+messages) :
+
+    - débit (demandes par seconde) ;
+    - centiles de la durée de publication de chaque message et du délai
+      entre le début de l'exécution et sa publication ;
+    - mémoire résidente maximale.
+
+Chaque mesure est effectuée dans un nouvel interpréteur, de sorte que la
+mémoire consommée par la génération du parc ou par les mesures précédentes
+ne fausse pas le résultat. Les résultats peuvent être enregistrés puis
+comparés à ceux d'une version précédente :
+
+    python -m vigilo.connector_syncevents.bench.pipeline \\
+        --hosts 20000 --services 20 --output results-2.1.json \\
+        --compare results-2.0.json
+
+Les options de la section C{connector-syncevents} (C{max_events},
+C{max_inflight}, C{batch_size}, etc.) peuvent être modifiées à l'aide de
+l'option C{--set}. L'option C{--publisher} permet de simuler la latence,
+la limitation du débit et les erreurs d'un serveur AMQP
+(voir L{vigilo.connector_syncevents.publishers.get_publisher}) :
+
+    python -m vigilo.connector_syncevents.bench.pipeline \
+        --publisher loopback:latency=0.005,max_pending=100 \
+        --set max_inflight=50 --set batch_size=20
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+from optparse import OptionParser
+from datetime import datetime
+
+from vigilo.connector_syncevents.bench import configure, create_schema, \
+                                              is_seeded, seed_fleet, \
+                                              percentile, peak_rss
+
+
+# Indicateurs comparés d'une version à l'autre, et sens de l'amélioration.
+COMPARED = [
+    ("throughput", "requests/s", True),
+    ("duration", "s", False),
+    ("first_publish", "s", False),
+    ("publish_p95", "s", False),
+    ("peak_rss", "KiB", False),
+]
+
+
+
+class BenchPublisher(object):
+    """
+    Bus factice : les messages sont sérialisés (comme ils le seraient
+    avant leur publication), puis transmis au bus local éventuel.
+    La durée de publication de chaque message est mesurée jusqu'à
+    son acquittement.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.start = time.time()
+        self.messages = 0
+        self.size = 0
+        self.latencies = []
+        self.published_at = []
+
+    def write(self, message):
+        before = time.time()
+        self.size += len(json.dumps(message))
+        if self.backend is None:
+            return self._acknowledged(None, before)
+        d = self.backend.write(message)
+        d.addCallback(self._acknowledged, before)
+        return d
+
+    def _acknowledged(self, result, before):
+        after = time.time()
+        self.messages += 1
+        self.latencies.append(after - before)
+        self.published_at.append(after - self.start)
+        return result
+
+
+
+def summarize(values):
+    """
+    @param values: Durées mesurées.
+    @type  values: C{list}
+    @return: Principaux centiles de ces durées.
+    @rtype: C{dict}
+    """
+    return dict([ ("p%d" % (ratio * 100), percentile(values, ratio))
+                  for ratio in (0.5, 0.95, 0.99) ] +
+                [ ("max", max(values) if values else 0.0) ])
+
+
+def run_pipeline(now=None, backend=None):
+    """
+    Exécute une resynchronisation complète, avec la configuration courante,
+    en publiant les messages sur un bus factice.
+
+    La base de données doit avoir été configurée au préalable
+    (voir L{vigilo.connector_syncevents.bench.configure}).
+
+    @param now: Date de l'exécution (par défaut, la date courante en UTC,
+        comme lors de la génération du parc).
+    @type  now: C{datetime.datetime}
+    @param backend: Bus local auquel les messages sont transmis
+        (voir L{vigilo.connector_syncevents.publishers.get_publisher}),
+        ou C{None} pour se contenter de les sérialiser.
+    @type  backend: C{object}
+    @return: Mesures de l'exécution.
+    @rtype: C{dict}
+    """
+    import transaction
+    from vigilo.connector_syncevents.main import find_desync, create_sender
+    from vigilo.connector_syncevents.metrics import RunMetrics
+
+    if now is None:
+        now = datetime.utcnow()
+    base_rss = peak_rss()
+    metrics = RunMetrics()
+    publisher = BenchPublisher(backend)
+    errors = []
+    try:
+        events = find_desync(now, metrics=metrics)
+        sender = create_sender(events)
+        sender.publisher = publisher
+        if backend is None:
+            # Le bus factice répond immédiatement : l'envoi se termine
+            # sans qu'il soit nécessaire de lancer le réacteur.
+            d = sender.askNagios(None)
+            d.addErrback(errors.append)
+        else:
+            from vigilo.connector_syncevents.publishers import run_offline
+            failure = run_offline(sender)
+            if failure is not None:
+                errors.append(failure)
+            backend.close()
+    finally:
+        transaction.abort()
+    if errors:
+        errors[0].raiseException()
+    duration = time.time() - publisher.start
+    metrics.record_sender(sender)
+    return {
+        "duration": duration,
+        "requests": sender.count,
+        "messages": publisher.messages,
+        "bytes": publisher.size,
+        "throughput": sender.count / max(duration, 1e-6),
+        "first_publish": publisher.published_at[0]
+                         if publisher.published_at else 0.0,
+        "publish": summarize(publisher.latencies),
+        "time_to_publish": summarize(publisher.published_at),
+        "timings": metrics.as_dict()["timings"],
+        "base_rss": base_rss,
+        "peak_rss": peak_rss(),
+    }
+
+
+def probe(url, overrides, publisher=None):
+    """
+    Exécute L{run_pipeline} dans un nouvel interpréteur.
+
+    @param url: URL SQLAlchemy de la base de données du banc d'essai.
+    @type  url: C{str}
+    @param overrides: Options de la section C{connector-syncevents}
+        à modifier.
+    @type  overrides: C{dict}
+    @param publisher: Description du bus local, ou C{None}.
+    @type  publisher: C{str}
+    @return: Mesures de l'exécution.
+    @rtype: C{dict}
+    """
+    command = [sys.executable, "-m",
+               "vigilo.connector_syncevents.bench.pipeline",
+               "--url", url, "--run"]
+    if publisher:
+        command.extend(["--publisher", publisher])
+    for option, value in sorted(overrides.items()):
+        command.extend(["--set", "%s=%s" % (option, value)])
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    output = subprocess.check_output(command, env=env)
+    # Seule la dernière ligne contient le résultat (le reste est journalisé).
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def get_version():
+    """
+    @return: Version installée du connecteur, si elle est connue.
+    @rtype: C{str}
+    """
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution(
+                    "vigilo-connector-syncevents").version
+    except Exception: # pylint: disable-msg=W0703
+        return None
+
+
+def compare(results, baseline):
+    """
+    Affiche l'évolution des principaux indicateurs par rapport
+    à des résultats précédents.
+
+    @param results: Résultats courants.
+    @type  results: C{dict}
+    @param baseline: Résultats de référence.
+    @type  baseline: C{dict}
+    @return: Indique si l'un des indicateurs s'est dégradé de plus de 10 %.
+    @rtype: C{bool}
+    """
+    if baseline.get("fleet") != results["fleet"] or \
+            baseline.get("settings") != results["settings"] or \
+            baseline.get("publisher") != results.get("publisher"):
+        print("Warning: the fleets or settings differ, the results "
+              "may not be comparable", file=sys.stderr)
+    print("%-14s %12s %12s %8s" % ("", baseline.get("version") or "baseline",
+                                   results.get("version") or "current",
+                                   "change"))
+    regressed = False
+    for name, unit, higher_is_better in COMPARED:
+        before = baseline["summary"].get(name)
+        after = results["summary"].get(name)
+        if not before or after is None:
+            continue
+        change = (after - before) / float(before)
+        if (change < -0.1) if higher_is_better else (change > 0.1):
+            regressed = True
+        print("%-14s %12.4g %12.4g %+7.1f%%  %s"
+              % (name, before, after, change * 100, unit))
+    return regressed
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--url",
+                      help="SQLAlchemy URL of the benchmark database "
+                           "(default: one SQLite database per fleet size)")
+    parser.add_option("--collectors", type="int", default=10,
+                      help="Number of Nagios collectors")
+    parser.add_option("--hosts", type="int", default=1000,
+                      help="Number of hosts")
+    parser.add_option("--services", type="int", default=10,
+                      help="Number of services per host")
+    parser.add_option("--stale", type="float", default=0.05,
+                      help="Fraction of stale non-OK states")
+    parser.add_option("--down", type="float", default=0.01,
+                      help="Fraction of DOWN hosts")
+    parser.add_option("--desync", type="float", default=0.01,
+                      help="Fraction of services whose state does not "
+                           "match their open event")
+    parser.add_option("--correvents", type="float", default=0.5,
+                      help="Fraction of stale services with an open "
+                           "correlated event")
+    parser.add_option("--hls", type="int", default=0,
+                      help="Number of high-level services")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="Number of runs")
+    parser.add_option("--set", action="append", default=[],
+                      metavar="OPTION=VALUE",
+                      help="Override a connector-syncevents setting "
+                           "(may be repeated)")
+    parser.add_option("--publisher", metavar="SPEC",
+                      help="Send the messages to a local publisher, e.g. "
+                           "loopback:latency=0.005,max_pending=100")
+    parser.add_option("--output", help="Save the results as JSON")
+    parser.add_option("--compare", metavar="FILE",
+                      help="Compare the results with those saved in FILE "
+                           "and fail if they regressed by more than 10%")
+    parser.add_option("--run", action="store_true",
+                      help="Run the pipeline once and print the "
+                           "measurements (used internally)")
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("No arguments allowed")
+    overrides = {}
+    for override in opts.set:
+        if "=" not in override:
+            parser.error("Invalid setting: %s" % override)
+        option, value = override.split("=", 1)
+        overrides[option.strip()] = value.strip()
+
+    fleet = {
+        "collectors": opts.collectors,
+        "hosts": opts.hosts,
+        "services": opts.services,
+        "stale": opts.stale,
+        "down": opts.down,
+        "desync": opts.desync,
+        "correvents": opts.correvents,
+        "hls": opts.hls,
+    }
+    if opts.url is None:
+        opts.url = "sqlite:////tmp/syncevents-pipeline-%d-%d-%d-%d.db" % (
+                        opts.collectors, opts.hosts, opts.services, opts.hls)
+
+    if opts.run:
+        from vigilo.common.conf import settings
+        configure(opts.url)
+        settings["connector-syncevents"].update(overrides)
+        backend = None
+        if opts.publisher:
+            from vigilo.connector_syncevents.publishers import get_publisher
+            backend = get_publisher(opts.publisher)
+        print(json.dumps(run_pipeline(backend=backend)))
+        return
+
+    configure(opts.url)
+    create_schema()
+    if not is_seeded():
+        print("Seeding %d hosts with %d services each..."
+              % (opts.hosts, opts.services), file=sys.stderr)
+        seed_fleet(opts.collectors, opts.hosts, opts.services,
+                   stale=opts.stale, down=opts.down, desync=opts.desync,
+                   hls=opts.hls, correvents=opts.correvents)
+
+    runs = []
+    for _i in range(opts.repeat):
+        run = probe(opts.url, overrides, opts.publisher)
+        runs.append(run)
+        print("%6d request(s) in %.3fs  %8.1f req/s  first %.3fs  "
+              "p95 %.3fs  peak RSS %d KiB"
+              % (run["requests"], run["duration"], run["throughput"],
+                 run["first_publish"], run["time_to_publish"]["p95"],
+                 run["peak_rss"]))
+
+    results = {
+        "version": get_version(),
+        "date": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "fleet": fleet,
+        "settings": overrides,
+        "publisher": opts.publisher,
+        "runs": runs,
+        "summary": {
+            "throughput": percentile([ run["throughput"] for run in runs ],
+                                     0.5),
+            "duration": percentile([ run["duration"] for run in runs ], 0.5),
+            "first_publish": percentile([ run["first_publish"]
+                                          for run in runs ], 0.5),
+            "publish_p95": percentile([ run["publish"]["p95"]
+                                        for run in runs ], 0.5),
+            "peak_rss": max([ run["peak_rss"] for run in runs ]),
+        },
+    }
+    if opts.output:
+        with open(opts.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if opts.compare:
+        with open(opts.compare) as baseline:
+            if compare(results, json.load(baseline)):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
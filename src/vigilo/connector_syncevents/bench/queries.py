@@ -0,0 +1,143 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Banc d'essai de la requête de resynchronisation.
+
+Compare le temps d'exécution et le plan de la requête sous ses deux
+formes : sous-requêtes répétées dans chaque branche de l'UNION,
+ou CTE partagées par toutes les branches. La durée de la recherche
+rapide préalable (C{has_desync}) est également mesurée.
+
+Un parc synthétique est généré lors du premier lancement. La taille
+étant fixée à la création de la base, on utilise une base par taille :
+
+    for n in 10000 100000 1000000; do
+        python -m vigilo.connector_syncevents.bench.queries \\
+            --url sqlite:////tmp/syncevents-bench-$n.db --supitems $n
+    done
+"""
+
+from __future__ import print_function
+import sys
+import json
+from optparse import OptionParser
+from datetime import datetime, timedelta
+
+from vigilo.connector_syncevents.bench import configure, create_schema, \
+                                              is_seeded, seed_fleet, timed, \
+                                              percentile
+
+
+def explain(query):
+    """
+    @param query: Requête à analyser.
+    @type  query: C{sqlalchemy.orm.query.Query}
+    @return: Plan d'exécution de la requête, ligne par ligne.
+    @rtype: C{list} of C{str}
+    """
+    from vigilo.models.session import DBSession
+    bind = DBSession.get_bind()
+    compiled = query.statement.compile(dialect=bind.dialect)
+    if bind.dialect.name == "postgresql":
+        prefix = "EXPLAIN ANALYZE "
+    elif bind.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    if compiled.positional:
+        params = [compiled.params[key] for key in compiled.positiontup]
+    else:
+        params = compiled.params
+    cursor = DBSession.connection().connection.cursor()
+    try:
+        cursor.execute(prefix + str(compiled), params)
+        return [" ".join(str(col) for col in row)
+                for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--url", default="sqlite:////tmp/syncevents-bench.db",
+                      help="SQLAlchemy URL of the benchmark database")
+    parser.add_option("--supitems", type="int", default=10000,
+                      help="Approximate number of supervised items")
+    parser.add_option("--services", type="int", default=10,
+                      help="Number of services per host")
+    parser.add_option("--collectors", type="int", default=10,
+                      help="Number of Nagios collectors")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="Number of runs of each query")
+    parser.add_option("--no-explain", action="store_false", dest="explain",
+                      default=True, help="Do not display the query plans")
+    parser.add_option("--output", help="Save the results as JSON")
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("No arguments allowed")
+
+    configure(opts.url)
+    import transaction
+    from vigilo.connector_syncevents.desync import _get_desync_query, \
+                                                   has_desync
+
+    create_schema()
+    if not is_seeded():
+        hosts = max(1, opts.supitems // (opts.services + 1))
+        print("Seeding %d hosts with %d services each..."
+              % (hosts, opts.services), file=sys.stderr)
+        seed_fleet(opts.collectors, hosts, opts.services,
+                   hls=opts.supitems // 100)
+
+    time_limit = datetime.utcnow() - timedelta(minutes=45)
+    results = []
+    for form, use_cte in (("subqueries", False), ("cte", True)):
+        def run():
+            return _get_desync_query(time_limit, time_limit,
+                                     use_cte=use_cte).all()
+        try:
+            durations, rows = timed(run, opts.repeat)
+            plan = []
+            if opts.explain:
+                plan = explain(_get_desync_query(time_limit, time_limit,
+                                                 use_cte=use_cte))
+        finally:
+            transaction.abort()
+        results.append({
+            "form": form,
+            "supitems": opts.supitems,
+            "rows": len(rows),
+            "durations": durations,
+            "plan": plan,
+        })
+        print("%-10s %8d row(s)  min %.3fs  median %.3fs"
+              % (form, len(rows), min(durations),
+                 percentile(durations, 0.5)))
+        for line in plan:
+            print("    " + line)
+
+    # Recherche rapide préalable (voir has_desync).
+    try:
+        durations, found = timed(lambda: has_desync(time_limit, time_limit),
+                                 opts.repeat)
+    finally:
+        transaction.abort()
+    results.append({
+        "form": "probe",
+        "supitems": opts.supitems,
+        "rows": int(found),
+        "durations": durations,
+        "plan": [],
+    })
+    print("%-10s %8d row(s)  min %.3fs  median %.3fs"
+          % ("probe", int(found), min(durations), percentile(durations, 0.5)))
+
+    if opts.output:
+        with open(opts.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Banc d'essai du démarrage du connecteur.
+
+Mesure, dans un nouvel interpréteur à chaque fois, la durée des chemins
+d'exécution les plus fréquents lorsque le connecteur est lancé par cron :
+
+    - C{import} : chargement du module principal ;
+    - C{locked} : une autre instance détient le verrou.
+
+Les modules lourds chargés sur chacun de ces chemins sont également listés :
+aucun d'entre eux ne devrait l'être.
+
+    python -m vigilo.connector_syncevents.bench.startup --repeat 20 \\
+        --max-median 0.5
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+from vigilo.connector_syncevents.bench import percentile
+
+
+# Modules dont le chargement est coûteux et qui ne sont nécessaires
+# que pour interroger la base de données ou publier sur le bus.
+HEAVY_MODULES = [
+    "sqlalchemy",
+    "twisted.internet.reactor",
+    "vigilo.models.session",
+    "vigilo.connector.client",
+    "vigilo.connector.handlers",
+]
+
+SCENARIOS = {
+    "import": "",
+    "locked": """
+from vigilo.common.conf import settings
+settings["connector-syncevents"]["lockfile"] = %(lockfile)r
+sys.argv = ["vigilo-connector-syncevents"]
+try:
+    main.main()
+except SystemExit:
+    pass
+""",
+}
+
+PROBE = """
+import sys, time, json
+start = time.time()
+import vigilo.connector_syncevents.main as main
+%(scenario)s
+print(json.dumps({
+    "duration": time.time() - start,
+    "heavy": sorted(name for name in %(heavy)r if name in sys.modules),
+}))
+"""
+
+
+def probe(scenario, lockfile=None):
+    """
+    Exécute un chemin de démarrage dans un nouvel interpréteur.
+
+    @param scenario: Nom du chemin (voir C{SCENARIOS}).
+    @type  scenario: C{str}
+    @param lockfile: Verrou détenu par une autre instance.
+    @type  lockfile: C{str}
+    @return: Durée du chemin d'exécution (en secondes)
+        et modules lourds chargés.
+    @rtype: C{dict}
+    """
+    code = PROBE % {
+        "scenario": SCENARIOS[scenario] % {"lockfile": lockfile},
+        "heavy": HEAVY_MODULES,
+    }
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    output = subprocess.check_output([sys.executable, "-c", code], env=env)
+    # Seule la dernière ligne contient le résultat (le reste est journalisé).
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    opt_parser = OptionParser()
+    opt_parser.add_option("--repeat", type="int", default=10,
+                          help="Number of runs per scenario")
+    opt_parser.add_option("--max-median", type="float",
+                          help="Fail if the median duration of a scenario "
+                               "exceeds this value (in seconds)")
+    opt_parser.add_option("--output", help="Write the results to this file "
+                                           "(JSON)")
+    opts, args = opt_parser.parse_args()
+    if args:
+        opt_parser.error("No arguments allowed")
+
+    # Verrou détenu par une "autre instance", pour le chemin "locked".
+    from vigilo.common.lock import grab_lock
+    lockdir = tempfile.mkdtemp(prefix="syncevents-bench-")
+    lockfile = os.path.join(lockdir, "lock")
+    held = grab_lock(lockfile)
+
+    results = []
+    failed = False
+    try:
+        for scenario in sorted(SCENARIOS):
+            runs = [ probe(scenario, lockfile) for _i in range(opts.repeat) ]
+            durations = [ run["duration"] for run in runs ]
+            heavy = sorted(set(name for run in runs for name in run["heavy"]))
+            median = percentile(durations, 0.5)
+            results.append({
+                "scenario": scenario,
+                "durations": durations,
+                "heavy": heavy,
+            })
+            print("%-8s min %.3fs  median %.3fs  heavy modules: %s"
+                  % (scenario, min(durations), median,
+                     ", ".join(heavy) or "none"))
+            if heavy or (opts.max_median and median > opts.max_median):
+                failed = True
+    finally:
+        del held
+        shutil.rmtree(lockdir, ignore_errors=True)
+
+    if opts.output:
+        with open(opts.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Mode démon du connecteur syncevents.
+
+Au lieu d'être relancé périodiquement par cron, le connecteur reste actif :
+le réacteur Twisted, la connexion au bus et le pool de connexions à la base
+de données sont conservés d'une resynchronisation à l'autre.
+"""
+
+from datetime import datetime
+
+import transaction
+from twisted.internet import defer, reactor, task
+
+from vigilo.common.conf import settings
+from vigilo.common.logging import get_logger, get_error_message
+from vigilo.common.gettext import translate
+
+from vigilo.connector.client import client_factory
+from vigilo.connector.handlers import buspublisher_factory
+
+from vigilo.connector_syncevents.main import find_desync, create_sender, \
+                                             get_state_file, save_state, \
+                                             get_incremental_scan, \
+                                             get_suppression_cache, \
+                                             get_adaptive_budget, \
+                                             get_request_tracker, \
+                                             get_spool, load_events, \
+                                             get_reference_cache, \
+                                             get_time_delays, \
+                                             get_max_events, get_deadline, \
+                                             check_requests, \
+                                             track_requests, report_metrics
+from vigilo.connector_syncevents.metrics import RunMetrics
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+
+
+class SyncDaemon(object):
+    """
+    Lance périodiquement la recherche des éléments désynchronisés
+    et l'envoi des demandes de mise à jour à Nagios.
+    """
+
+    def __init__(self, client, publisher, interval, state_file=None,
+                 scan=None, suppression=None, shard=None, refs=None,
+                 budget=None, tracker=None, spool=None, watch=False):
+        """
+        @param client: Client du bus, déjà démarré ou en cours de connexion.
+        @type  client: C{vigilo.connector.client.VigiloClient}
+        @param publisher: Objet chargé de publier les messages sur le bus.
+        @type  publisher: C{vigilo.connector.handlers.BusPublisher}
+        @param interval: Délai (en secondes) entre deux resynchronisations.
+        @type  interval: C{int}
+        @param state_file: Fichier d'état du connecteur.
+        @type  state_file: L{vigilo.connector_syncevents.state.StateFile}
+        @param scan: Suivi de la recherche incrémentale, ou C{None}.
+        @type  scan: L{vigilo.connector_syncevents.incremental.IncrementalScan}
+        @param suppression: Cache des demandes envoyées récemment, conservé
+            en mémoire d'une resynchronisation à l'autre, ou C{None}.
+        @type  suppression:
+            L{vigilo.connector_syncevents.suppression.SuppressionCache}
+        @param shard: Part des collecteurs traitée, ou C{None}.
+        @type  shard: L{vigilo.connector_syncevents.shard.Shard}
+        @param refs: Cache des données de référence, conservé en mémoire
+            d'une resynchronisation à l'autre, ou C{None}.
+        @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+        @param budget: Nombre maximum de demandes ajusté automatiquement,
+            ou C{None}.
+        @type  budget: L{vigilo.connector_syncevents.adaptive.AdaptiveBudget}
+        @param tracker: Suivi de l'efficacité des demandes, ou C{None}.
+        @type  tracker: L{vigilo.connector_syncevents.tracker.RequestTracker}
+        @param spool: Fichier de reprise des éléments à synchroniser,
+            ou C{None}.
+        @type  spool: L{vigilo.connector_syncevents.spool.Spool}
+        @param watch: Indique si les éléments dont l'état est trop ancien
+            sont pris en charge par le suivi des échéances (option
+            C{--watch}) : seules les désynchronisations entre états et
+            événements sont alors recherchées périodiquement.
+        @type  watch: C{bool}
+        """
+        self.client = client
+        self.publisher = publisher
+        self.interval = interval
+        self.state_file = state_file
+        self.scan = scan
+        self.suppression = suppression
+        self.shard = shard
+        self.refs = refs
+        self.budget = budget
+        self.tracker = tracker
+        self.spool = spool
+        self.watch = watch
+        self._loop = task.LoopingCall(self.synchronize)
+
+
+    def start(self):
+        """Démarre les resynchronisations périodiques."""
+        LOGGER.info(_("Synchronizing every %d second(s)"), self.interval)
+        return self._loop.start(self.interval, now=True)
+
+
+    def stop(self):
+        """Arrête les resynchronisations périodiques."""
+        if self._loop.running:
+            self._loop.stop()
+
+
+    @defer.inlineCallbacks
+    def synchronize(self):
+        """
+        Effectue une resynchronisation. Les erreurs sont journalisées
+        mais n'interrompent pas le démon : la resynchronisation sera
+        retentée à l'échéance suivante.
+        """
+        if not self.client.isConnected():
+            LOGGER.warning(_("Not connected to the bus, skipping "
+                             "this synchronization"))
+            return
+
+        metrics = RunMetrics()
+        try:
+            now = datetime.now()
+            check_requests(now, self.budget, self.tracker, metrics)
+            events = load_events(
+                lambda: find_desync(now, self.scan, self.suppression,
+                                    self.shard, metrics, self.refs,
+                                    self.budget, self.tracker,
+                                    ages=not self.watch),
+                self.spool, self.scan, now)
+            # Un cycle ne déborde pas sur le suivant : les éléments
+            # restants sont envoyés lors de celui-ci.
+            syncsender = create_sender(events, self.suppression,
+                                       get_deadline(reactor.seconds(),
+                                                    self.interval))
+            syncsender.publisher = self.publisher
+            track_requests(syncsender, now, self.scan, self.budget,
+                           self.tracker, self.spool)
+            try:
+                yield syncsender.askNagios(self.client)
+            finally:
+                if self.spool is not None:
+                    self.spool.finish()
+            if not syncsender.count:
+                LOGGER.info(_("No events to synchronize"))
+            if self.budget is not None:
+                self.budget.finish(syncsender)
+            save_state(self.state_file, self.scan, self.suppression,
+                       self.budget, self.tracker, now)
+            metrics.record_sender(syncsender)
+            for message in report_metrics(metrics, self.shard):
+                yield self.publisher.write(message)
+        except Exception as e:
+            LOGGER.error(_("Synchronization failed: %s"),
+                         get_error_message(e))
+        finally:
+            # Libère la connexion à la base de données (elle retourne
+            # dans le pool) et évite de travailler sur un instantané
+            # périmé des données lors du cycle suivant.
+            transaction.abort()
+
+
+
+def get_watcher(client, publisher, shard=None, suppression=None):
+    """
+    Prépare la resynchronisation déclenchée par les changements d'état
+    (option C{--watch}), d'après la configuration.
+
+    @return: Objet chargé de surveiller les échéances.
+    @rtype: L{vigilo.connector_syncevents.watcher.SyncWatcher}
+    """
+    # Import local : configure l'accès à la base de données.
+    from vigilo.connector_syncevents import desync # pylint: disable-msg=W0611
+    from vigilo.models.session import DBSession
+    from vigilo.connector_syncevents.watcher import SyncWatcher, \
+            PgNotifySource, QueueSource, DEFAULT_CHANNEL
+
+    options = settings["connector-syncevents"]
+    bind = DBSession.get_bind()
+    if bind.dialect.name == "postgresql":
+        source = PgNotifySource(bind, options.get("watch_channel",
+                                                  DEFAULT_CHANNEL))
+    else:
+        # Pas de notification : les échéances ne sont recalculées
+        # que périodiquement.
+        LOGGER.warning(_("State change notifications are only available "
+                         "with PostgreSQL"))
+        source = QueueSource()
+    return SyncWatcher(client, publisher, source, get_time_delays(),
+                       float(options.get("watch_poll_interval", 1)),
+                       int(options.get("watch_reload_interval", 3600)),
+                       get_max_events(), shard, suppression)
+
+
+def run_daemon(interval, log_traffic=False, shard=None, watch=False):
+    """
+    Exécute le connecteur en mode démon, jusqu'à l'arrêt du réacteur.
+
+    @param interval: Délai (en secondes) entre deux resynchronisations.
+    @type  interval: C{int}
+    @param log_traffic: Indique si le trafic échangé avec le bus
+        doit être journalisé.
+    @type  log_traffic: C{bool}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{vigilo.connector_syncevents.shard.Shard}
+    @param watch: Indique si les demandes sont également envoyées dès
+        l'échéance de chaque élément (voir L{get_watcher}).
+    @type  watch: C{bool}
+    """
+    client = client_factory(settings)
+    client.factory.noisy = False
+    client.log_traffic = log_traffic
+
+    publisher = buspublisher_factory(settings, client)
+    state_file = get_state_file(shard)
+    # Le suivi des échéances et les resynchronisations périodiques
+    # partagent le cache des demandes envoyées récemment : il est activé
+    # par défaut avec l'option --watch, pour qu'un même élément ne soit
+    # pas demandé par les deux.
+    default_ttl = max(1, (interval + 59) // 60) if watch else 0
+    daemon = SyncDaemon(client, publisher, interval, state_file,
+                        get_incremental_scan(state_file),
+                        get_suppression_cache(state_file, default_ttl), shard,
+                        get_reference_cache(), get_adaptive_budget(state_file),
+                        get_request_tracker(state_file), get_spool(shard),
+                        watch)
+
+    reactor.callWhenRunning(client.startService)
+    reactor.callWhenRunning(daemon.start)
+    reactor.addSystemEventTrigger("before", "shutdown", daemon.stop)
+    if watch:
+        watcher = get_watcher(client, publisher, shard, daemon.suppression)
+        reactor.callWhenRunning(watcher.start)
+        reactor.addSystemEventTrigger("before", "shutdown", watcher.stop)
+    reactor.addSystemEventTrigger("before", "shutdown", client.stopService)
+    reactor.run()
@@ -0,0 +1,1227 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Requêtes de recherche des hôtes/services désynchronisés.
+
+L'import de ce module configure l'accès à la base de données : il n'est
+importé qu'une fois le verrou du connecteur obtenu (voir
+L{vigilo.connector_syncevents.main}).
+"""
+
+import time
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import transaction
+
+from vigilo.common.conf import settings
+settings.load_module(__name__)
+
+from vigilo.models.configure import configure_db
+configure_db(settings['database'], 'sqlalchemy_')
+
+from vigilo.common.logging import get_logger, get_error_message
+LOGGER = get_logger(__name__)
+
+from vigilo.common.gettext import translate
+_ = translate(__name__)
+
+from sqlalchemy.exc import InvalidRequestError, OperationalError
+from sqlalchemy.sql.expression import null as expr_null, union, union_all, \
+                                      or_, and_, case, exists, literal_column
+from sqlalchemy.sql import func
+from sqlalchemy.orm import aliased
+from sqlalchemy.types import Integer
+
+from vigilo.models.session import DBSession
+from vigilo.models import tables
+from vigilo.models.tables.eventsaggregate import EventsAggregate
+
+from vigilo.connector_syncevents.records import SupItem, StringPool, compact
+from vigilo.connector_syncevents.hlsgraph import order_hls
+
+
+
+_DesyncCTEs = namedtuple("_DesyncCTEs", "hosts_up nagios")
+
+
+def _state_value(name, refs=None):
+    if refs is not None:
+        return refs.state_value(name)
+    return tables.StateName.statename_to_value(name)
+
+
+def _get_hosts_up(refs=None):
+    """
+    Récupère les hôtes OK/UP, pour ne remonter que les services
+    désynchronisés sur ces hôtes (#727) : si l'hôte est DOWN/UNREACHABLE,
+    Nagios n'enverra pas de mise à jour pour ses services.
+
+    Un hôte peut être "OK" si un exploitant a "Forcé à fermer"
+    une alarme portant sur cet hôte.
+
+    @param refs: Cache des données de référence, ou C{None}.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Requête SQL permettant de récupérer les identifiants
+        des hôtes OK/UP.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    state_up = _state_value(u'UP', refs)
+    state_ok = _state_value(u'OK', refs)
+    return DBSession.query(
+        tables.Host.idhost,
+    ).join(
+        (tables.State, tables.State.idsupitem == tables.Host.idhost),
+    ).filter(
+        tables.State.state.in_([state_up, state_ok]),
+    )
+
+
+def get_nagios_ventilation(shard=None):
+    """
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @return: Requête SQL permettant de récupérer le collecteur Nagios
+        (actif) responsable de chaque hôte.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    query = DBSession.query(
+        tables.Ventilation.idhost,
+        tables.VigiloServer.name.label("vigiloserver"),
+    ).select_from(
+        tables.Ventilation
+    ).join(
+        (tables.VigiloServer,
+            tables.VigiloServer.idvigiloserver
+            == tables.Ventilation.idvigiloserver),
+        (tables.Application,
+            tables.Application.idapp == tables.Ventilation.idapp),
+    ).filter(
+        tables.Application.name == u"nagios"
+    ).filter(
+        tables.VigiloServer.disabled == False
+    )
+    if shard is not None:
+        query = shard.filter(query)
+    return query
+
+
+def get_desync_ctes(shard=None, refs=None):
+    """
+    Construit les expressions de table communes (CTE) partagées par les
+    différentes branches de la requête de resynchronisation : les hôtes
+    OK/UP et la ventilation sur les collecteurs Nagios ne sont ainsi
+    calculés qu'une seule fois, au lieu d'une fois par branche.
+
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @param refs: Cache des données de référence, ou C{None}.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: CTE des hôtes OK/UP (C{hosts_up}) et de la ventilation
+        Nagios (C{nagios}).
+    @rtype: C{tuple}
+    """
+    return _DesyncCTEs(
+        hosts_up=_get_hosts_up(refs).cte("hosts_up"),
+        nagios=get_nagios_ventilation(shard).cte("nagios_ventilation"),
+    )
+
+
+def _vigiloserver_column(ctes=None, refs=None):
+    if refs is not None:
+        # Le collecteur sera retrouvé à partir de l'identifiant de l'hôte.
+        return tables.Host.idhost.label("idhost")
+    if ctes is not None:
+        return ctes.nagios.c.vigiloserver.label("vigiloserver")
+    return tables.VigiloServer.name.label("vigiloserver")
+
+
+def _only_hosts_up(query, ctes=None, refs=None):
+    if ctes is not None:
+        return query.join(
+            (ctes.hosts_up, ctes.hosts_up.c.idhost == tables.Host.idhost))
+    return query.filter(tables.Host.idhost.in_(_get_hosts_up(refs)))
+
+
+def _add_ventilation(query, ctes=None, shard=None, refs=None):
+    if refs is not None:
+        # Le collecteur de chaque hôte est connu du cache : on se contente
+        # d'écarter les hôtes ventilés sur aucun collecteur (actif) de la
+        # part traitée, pour que la limite de la requête ne porte que sur
+        # des éléments qui seront effectivement retenus.
+        if ctes is not None:
+            ventilated = DBSession.query(ctes.nagios.c.idhost)
+        else:
+            nagios = get_nagios_ventilation(shard).subquery()
+            ventilated = DBSession.query(nagios.c.idhost)
+        return query.filter(tables.Host.idhost.in_(ventilated))
+    if ctes is not None:
+        # La CTE ne porte déjà que sur les collecteurs de la part traitée.
+        return query.join(
+            (ctes.nagios, ctes.nagios.c.idhost == tables.Host.idhost))
+    query = query.join(
+                (tables.Ventilation,
+                    tables.Ventilation.idhost == tables.Host.idhost),
+                (tables.VigiloServer,
+                    tables.VigiloServer.idvigiloserver
+                    == tables.Ventilation.idvigiloserver),
+                (tables.Application,
+                    tables.Application.idapp == tables.Ventilation.idapp),
+            ).filter(
+                tables.Application.name == u"nagios"
+            ).filter(
+                tables.VigiloServer.disabled == False
+            )
+    if shard is not None:
+        query = shard.filter(query)
+    return query
+
+
+def get_old_lls(time_limit, time_since=None, ctes=None, shard=None,
+                refs=None):
+    """
+    Récupère les services à synchroniser.
+
+    On configure Nagios pour renvoyer l'état des services non-OK toutes les X
+    minutes. L'état est alors mis à jour dans la base. Donc si on trouve un
+    état dans la base qui n'a pas été mis à jour il y a moins de X minutes,
+    c'est potentiellement un message perdu, donc un service à re-synchroniser.
+
+    Attention par contre, si l'hôte est DOWN Nagios n'enverra pas de mise à
+    jours pour les services de cet hôte. Il faut donc exclure ces services.
+
+    @param time_limit: Date après laquelle on ignore les états,
+        ou C{None} pour retenir tous les états anormaux.
+    @type  time_limit: C{datetime.datetime}
+    @param time_since: Date avant laquelle on ignore les états
+        (recherche incrémentale), ou C{None}.
+    @type  time_since: C{datetime.datetime}
+    @param ctes: CTE partagées (voir L{get_desync_ctes}), ou C{None}.
+    @type  ctes: C{tuple}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @param refs: Cache des données de référence, ou C{None}. S'il est
+        fourni, la requête ne fait pas la jointure avec la ventilation
+        et renvoie l'identifiant de l'hôte (C{idhost}) à la place du
+        nom du collecteur.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Requête SQL permettant de récupérer la liste des services
+        dont l'état est obsolète.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    state_up = _state_value(u'UP', refs)
+    state_ok = _state_value(u'OK', refs)
+
+    lls_to_update = DBSession.query(
+        tables.Host.name.label('hostname'),
+        tables.LowLevelService.servicename.label('servicename'),
+        _vigiloserver_column(ctes, refs),
+    ).join(
+        (tables.LowLevelService,
+            tables.LowLevelService.idhost == tables.Host.idsupitem),
+        (tables.State,
+            tables.State.idsupitem == tables.LowLevelService.idservice),
+    ).filter(
+        # On ne veut resynchroniser que les états anormaux.
+        ~tables.State.state.in_([state_up, state_ok]),
+    )
+    if time_limit is not None:
+        lls_to_update = lls_to_update.filter(
+            tables.State.timestamp <= time_limit)
+    # On ne remonte que les services désynchronisés
+    # sur les hôtes OK/UP (#727).
+    lls_to_update = _only_hosts_up(lls_to_update, ctes, refs)
+    if time_since is not None:
+        lls_to_update = lls_to_update.filter(
+            tables.State.timestamp > time_since)
+    return _add_ventilation(lls_to_update, ctes, shard, refs)
+
+
+def get_old_hosts(time_limit, time_since=None, ctes=None, shard=None,
+                  refs=None):
+    """
+    Récupère les hôtes à synchroniser.
+
+    Voir le commentaire précédent sur les services pour le critère de
+    désynchronisation. La situation est similaire pour les hôtes.
+
+    @param time_limit: Date après laquelle on ignore les états,
+        ou C{None} pour retenir tous les états anormaux.
+    @type  time_limit: C{datetime.datetime}
+    @param time_since: Date avant laquelle on ignore les états
+        (recherche incrémentale), ou C{None}.
+    @type  time_since: C{datetime.datetime}
+    @param ctes: CTE partagées (voir L{get_desync_ctes}), ou C{None}.
+    @type  ctes: C{tuple}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @param refs: Cache des données de référence, ou C{None}. S'il est
+        fourni, la requête ne fait pas la jointure avec la ventilation
+        et renvoie l'identifiant de l'hôte (C{idhost}) à la place du
+        nom du collecteur.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Requête SQL permettant de récupérer la liste des hôtes
+        dont l'état est obsolète.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    # Les hôtes OK/UP ne nous intéressent pas.
+    # Un hôte peut être "OK" si un exploitant a "Forcé à fermer"
+    # une alarme portant sur cet hôte.
+    state_up = _state_value(u'UP', refs)
+    state_ok = _state_value(u'OK', refs)
+
+    q = DBSession.query(
+        tables.Host.name.label('hostname'),
+        # pour faire une UNION il faut le même nombre de colonnes
+        expr_null().label('servicename'),
+        _vigiloserver_column(ctes, refs),
+    ).join(
+        (tables.State, tables.State.idsupitem == tables.Host.idhost),
+    ).filter(
+        # On ne veut resynchroniser que les états anormaux.
+        ~tables.State.state.in_([state_up, state_ok])
+    )
+    if time_limit is not None:
+        q = q.filter(tables.State.timestamp <= time_limit)
+    if time_since is not None:
+        q = q.filter(tables.State.timestamp > time_since)
+    return _add_ventilation(q, ctes, shard, refs)
+
+
+def get_old_hls(hls_time_limit, hls_time_since=None, refs=None):
+    """
+    Récupère les services de haut niveau à synchroniser.
+
+    On configure Nagios pour renvoyer l'état des services de haut niveau
+    non-OK toutes les X minutes. L'état est alors mis à jour dans la base.
+    Donc si on trouve un état dans la base qui n'a pas été mis à jour
+    il y a moins de X minutes, c'est potentiellement un message perdu
+    donc un service à re-synchroniser.
+
+    La resynchronisation permet aussi d'initialiser proprement
+    les services de haut niveau côté Vigilo lorsqu'ils sont
+    dans un état nominal côté Nagios.
+
+    @param hls_time_limit: Date après laquelle on ignore les états,
+        ou C{None} pour retenir tous les états OK/UNKNOWN.
+    @type  hls_time_limit: C{datetime.datetime}
+    @param hls_time_since: Date avant laquelle on ignore les états
+        (recherche incrémentale), ou C{None}.
+    @type  hls_time_since: C{datetime.datetime}
+    @param refs: Cache des données de référence, ou C{None}.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Requête SQL permettant de récupérer la liste des services
+        de haut niveau dont l'état est obsolète.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    # On force Nagios à envoyer une notification pour les états suivants :
+    # OK : état nominal; Nagios n'émet pas de notification dans ce cas,
+    #      mais on a besoin de l'information pour éviter des incohérences.
+    # UNKNOWN : état initial des HLS dans Nagios. Donc il n'enverra pas
+    #           de notification à Vigilo si le service est toujours UNKNOWN
+    #           après la première vérification.
+    state_ok = _state_value(u'OK', refs)
+    state_unknown = _state_value(u'UNKNOWN', refs)
+
+    q = DBSession.query(
+        expr_null().label('hostname'),
+        tables.HighLevelService.servicename,
+        expr_null().label('vigiloserver' if refs is None else 'idhost'),
+    ).select_from(
+        tables.HighLevelService
+    ).join(
+        (tables.State,
+            tables.State.idsupitem == tables.HighLevelService.idservice),
+    ).filter(tables.State.state.in_([state_ok, state_unknown]))
+    if hls_time_limit is not None:
+        q = q.filter(tables.State.timestamp <= hls_time_limit)
+    if hls_time_since is not None:
+        q = q.filter(tables.State.timestamp > hls_time_since)
+    return q
+
+
+def get_changed_hls(hls_time_limit, hls_time_since=None, refs=None):
+    """
+    Récupère les services de haut niveau à synchroniser d'après leurs
+    dépendances : au lieu de tous les services de haut niveau OK/UNKNOWN
+    (voir L{get_old_hls}), seuls sont retenus :
+
+        - ceux qui sont encore dans leur état initial (UNKNOWN) ;
+        - ceux dont l'une des dépendances (hôte, service de bas ou de haut
+          niveau) a changé d'état après eux, sans qu'ils aient été mis à
+          jour dans le délai imparti.
+
+    @param hls_time_limit: Date après laquelle on ignore les états
+        (du service de haut niveau ou de ses dépendances).
+    @type  hls_time_limit: C{datetime.datetime}
+    @param hls_time_since: Date avant laquelle on ignore les états
+        (recherche incrémentale), ou C{None}.
+    @type  hls_time_since: C{datetime.datetime}
+    @param refs: Cache des données de référence, ou C{None}.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Requête SQL renvoyant l'identifiant et le nom des services
+        de haut niveau à synchroniser.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    state_ok = _state_value(u'OK', refs)
+    state_unknown = _state_value(u'UNKNOWN', refs)
+    dep_state = aliased(tables.State)
+
+    initial = and_(tables.State.state == state_unknown,
+                   tables.State.timestamp <= hls_time_limit)
+    changed = [
+        tables.DependencyGroup.iddependent ==
+            tables.HighLevelService.idservice,
+        tables.DependencyGroup.role == u'hls',
+        tables.Dependency.idgroup == tables.DependencyGroup.idgroup,
+        dep_state.idsupitem == tables.Dependency.idsupitem,
+        dep_state.timestamp > tables.State.timestamp,
+        dep_state.timestamp <= hls_time_limit,
+    ]
+    if hls_time_since is not None:
+        initial = and_(initial, tables.State.timestamp > hls_time_since)
+        changed.append(dep_state.timestamp > hls_time_since)
+
+    return DBSession.query(
+        tables.HighLevelService.idservice,
+        tables.HighLevelService.servicename,
+    ).join(
+        (tables.State,
+            tables.State.idsupitem == tables.HighLevelService.idservice),
+    ).filter(
+        tables.State.state.in_([state_ok, state_unknown])
+    ).filter(or_(initial, exists().where(and_(*changed))))
+
+
+def get_hls_dependencies():
+    """
+    @return: Requête SQL renvoyant les couples (identifiant du service de
+        haut niveau dépendant, identifiant du service de haut niveau dont
+        il dépend).
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    return DBSession.query(
+        tables.DependencyGroup.iddependent,
+        tables.Dependency.idsupitem,
+    ).join(
+        (tables.Dependency,
+            tables.Dependency.idgroup == tables.DependencyGroup.idgroup),
+        (tables.HighLevelService,
+            tables.HighLevelService.idservice == tables.Dependency.idsupitem),
+    ).filter(tables.DependencyGroup.role == u'hls')
+
+
+def get_hls_by_dependencies(hls_time_limit, hls_time_since=None, refs=None,
+                            postpone=None):
+    """
+    Retourne les services de haut niveau à synchroniser (voir
+    L{get_changed_hls}), dans l'ordre de leurs dépendances (voir
+    L{vigilo.connector_syncevents.hlsgraph.order_hls}).
+
+    @param hls_time_limit: Date après laquelle on ignore les états.
+    @type  hls_time_limit: C{datetime.datetime}
+    @param hls_time_since: Date avant laquelle on ignore les états
+        (recherche incrémentale), ou C{None}.
+    @type  hls_time_since: C{datetime.datetime}
+    @param refs: Cache des données de référence, ou C{None}.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @param postpone: Fonction appelée pour chaque service écarté parce
+        qu'il dépend d'un service synchronisé, ou C{None}.
+    @type  postpone: C{callable}
+    @return: Services de haut niveau à synchroniser.
+    @rtype: C{list} of L{SupItem}
+    """
+    LOGGER.info(_("Listing high-level services whose dependencies changed "
+                  "before %s"), hls_time_limit.strftime("%Y-%m-%d %H:%M:%S"))
+    try:
+        candidates = OrderedDict(
+            (row.idservice, SupItem(None, row.servicename, None))
+            for row in get_changed_hls(hls_time_limit, hls_time_since,
+                                       refs).all())
+        if not candidates:
+            return []
+        edges = get_hls_dependencies().all()
+    except (InvalidRequestError, OperationalError) as e:
+        LOGGER.error(_('Database exception raised: %s'),
+                        get_error_message(e))
+        raise e
+    supitems, deferred = order_hls(candidates, edges)
+    if deferred:
+        LOGGER.info(_("Postponed %d high-level service(s) depending on "
+                      "high-level services being synchronized"),
+                    len(deferred))
+        if postpone is not None:
+            for supitem in deferred:
+                postpone(supitem)
+    return supitems
+
+
+def _changed_since(query, event_since):
+    return query.filter(or_(
+        tables.State.timestamp > event_since,
+        tables.Event.timestamp > event_since,
+    ))
+
+
+def get_desync_event_services(event_since=None, ctes=None, shard=None,
+                              refs=None):
+    """
+    Récupère les services dont l'état et les événements sont désynchronisés
+
+    @param event_since: Si renseigné, seuls les états et événements
+        modifiés après cette date sont pris en compte
+        (recherche incrémentale).
+    @type  event_since: C{datetime.datetime}
+    @param ctes: CTE partagées (voir L{get_desync_ctes}), ou C{None}.
+    @type  ctes: C{tuple}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @param refs: Cache des données de référence, ou C{None}. S'il est
+        fourni, la requête ne fait pas la jointure avec la ventilation
+        et renvoie l'identifiant de l'hôte (C{idhost}) à la place du
+        nom du collecteur.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Requête SQL permettant de récupérer la liste des services
+        dont l'état ne correspond pas au dernier événement stocké.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    q = DBSession.query(
+        tables.Host.name.label('hostname'),
+        tables.LowLevelService.servicename.label('servicename'),
+        _vigiloserver_column(ctes, refs),
+    ).join(
+        (tables.LowLevelService,
+            tables.LowLevelService.idhost == tables.Host.idhost),
+        (tables.State,
+            tables.State.idsupitem == tables.LowLevelService.idservice),
+        (tables.Event,
+            tables.Event.idsupitem == tables.State.idsupitem),
+    ).filter(
+        tables.State.state != tables.Event.current_state
+    )
+    # On ne remonte que les services désynchronisés
+    # sur les hôtes OK/UP (#727).
+    q = _only_hosts_up(q, ctes, refs)
+    if event_since is not None:
+        q = _changed_since(q, event_since)
+    return _add_ventilation(q, ctes, shard, refs)
+
+
+def get_desync_event_hosts(event_since=None, ctes=None, shard=None,
+                           refs=None):
+    """
+    Récupère les hôtes dont l'état et les événements sont désynchronisés.
+
+    @param event_since: Si renseigné, seuls les états et événements
+        modifiés après cette date sont pris en compte
+        (recherche incrémentale).
+    @type  event_since: C{datetime.datetime}
+    @param ctes: CTE partagées (voir L{get_desync_ctes}), ou C{None}.
+    @type  ctes: C{tuple}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @param refs: Cache des données de référence, ou C{None}. S'il est
+        fourni, la requête ne fait pas la jointure avec la ventilation
+        et renvoie l'identifiant de l'hôte (C{idhost}) à la place du
+        nom du collecteur.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Requête SQL permettant de récupérer la liste des hôtes
+        dont l'état ne correspond pas au dernier événement stocké.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    q = DBSession.query(
+        tables.Host.name.label('hostname'),
+        # pour faire une UNION il faut le même nombre de colonnes
+        expr_null().label('servicename'),
+        _vigiloserver_column(ctes, refs),
+    ).join(
+        (tables.State,
+            tables.State.idsupitem == tables.Host.idhost),
+        (tables.Event,
+            tables.Event.idsupitem == tables.State.idsupitem),
+    ).filter(
+        tables.State.state != tables.Event.current_state
+    )
+    if event_since is not None:
+        q = _changed_since(q, event_since)
+    return _add_ventilation(q, ctes, shard, refs)
+
+
+def _has_open_correvent():
+    """
+    @return: Expression valant 1 si un événement corrélé encore ouvert
+        porte sur l'hôte/service de l'état courant, 0 sinon.
+    @rtype: C{sqlalchemy.sql.expression.ColumnElement}
+    """
+    return case([(exists().where(and_(
+                    tables.Event.idsupitem == tables.State.idsupitem,
+                    EventsAggregate.idevent == tables.Event.idevent,
+                    tables.CorrEvent.idcorrevent
+                        == EventsAggregate.idcorrevent,
+                    tables.CorrEvent.ack != tables.CorrEvent.ACK_CLOSED,
+                )), 1)], else_=0)
+
+
+def _add_priority(query, has_correvent=None):
+    """
+    Ajoute à une branche de la requête de resynchronisation les critères
+    servant à classer les éléments par priorité : présence d'un événement
+    corrélé ouvert, gravité de l'état et date de l'état.
+
+    @param query: Branche de la requête (doit porter sur la table State).
+    @type  query: C{sqlalchemy.orm.query.Query}
+    @param has_correvent: Expression indiquant la présence d'un événement
+        corrélé ouvert, ou C{None} pour la calculer.
+    @type  has_correvent: C{sqlalchemy.sql.expression.ColumnElement}
+    @return: Requête complétée.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    if has_correvent is None:
+        has_correvent = _has_open_correvent()
+    return query.join(
+        (tables.StateName,
+            tables.StateName.idstatename == tables.State.state),
+    ).add_columns(
+        has_correvent.label("has_correvent"),
+        tables.StateName.order.label("severity"),
+        tables.State.timestamp.label("state_timestamp"),
+    )
+
+
+def keep_only_open_correvents(req):
+    """
+    Ne conserve que les évènements associés à un C{CorrEvent} encore ouvert
+
+    @param req: Requête SQLAlchemy de filtrage pour ne garder que les
+        C{CorrEvent} actifs.
+    @type req: C{sqlalchemy.orm.query.Query}
+    """
+    return req.join(
+            (EventsAggregate,
+                EventsAggregate.idevent == tables.Event.idevent),
+            (tables.CorrEvent,
+                tables.CorrEvent.idcorrevent == EventsAggregate.idcorrevent),
+        ).filter(
+            tables.CorrEvent.ack != tables.CorrEvent.ACK_CLOSED
+        )
+
+
+def _get_desync_branches(time_limit, hls_time_limit, time_since=None,
+                         hls_time_since=None, event_since=None, ctes=None,
+                         shard=None, refs=None):
+    """
+    Construit les branches de la requête de resynchronisation.
+    Voir L{get_desync} pour la signification des paramètres.
+
+    @return: Branches de la requête, indexées par leur nom. Les deux
+        dernières sont celles des événements désynchronisés.
+    @rtype: C{OrderedDict} of C{sqlalchemy.orm.query.Query}
+    """
+    resync = OrderedDict()
+    if time_limit is not None:
+        # Resynchronisation des états des LLS/hosts.
+        resync["old_lls"] = get_old_lls(time_limit, time_since, ctes,
+                                        shard, refs)
+        resync["old_hosts"] = get_old_hosts(time_limit, time_since, ctes,
+                                            shard, refs)
+
+    if hls_time_limit is not None and (shard is None or shard.with_hls):
+        # Resynchronisation des états des HLS.
+        resync["old_hls"] = get_old_hls(hls_time_limit, hls_time_since,
+                                        refs)
+
+    resync["event_services"] = keep_only_open_correvents(
+                    get_desync_event_services(event_since, ctes, shard,
+                                              refs))
+    resync["event_hosts"] = keep_only_open_correvents(
+                    get_desync_event_hosts(event_since, ctes, shard, refs))
+    return resync
+
+
+def _get_desync_query(time_limit, hls_time_limit, max_events=0,
+                      time_since=None, hls_time_since=None, event_since=None,
+                      use_cte=None, priority=False, shard=None, refs=None):
+    """
+    Construit la requête listant les hôtes/services à synchroniser.
+    Voir L{get_desync} pour la signification des paramètres.
+
+    @return: Requête SQL permettant de récupérer la liste des hôtes/services
+        à synchroniser.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    if use_cte is None:
+        # Le module sqlite3 de Python 2 ne sait pas décrire les colonnes
+        # du résultat (vide) d'une requête commençant par "WITH" :
+        # les CTE ne sont utilisées par défaut qu'avec PostgreSQL.
+        use_cte = (DBSession.get_bind().dialect.name == "postgresql")
+    ctes = get_desync_ctes(shard, refs) if use_cte else None
+
+    if time_limit is not None:
+        LOGGER.info(_("Listing hosts/services states older than %s"),
+                     time_limit.strftime("%Y-%m-%d %H:%M:%S"))
+    if hls_time_limit is not None and (shard is None or shard.with_hls):
+        LOGGER.info(_("Listing high-level services states older than %s"),
+                     hls_time_limit.strftime("%Y-%m-%d %H:%M:%S"))
+    resync = list(_get_desync_branches(time_limit, hls_time_limit, time_since,
+                                       hls_time_since, event_since, ctes,
+                                       shard, refs).values())
+
+    if priority:
+        return _prioritize(resync, max_events, refs)
+
+    to_update = union(*resync, correlate=False)
+    if max_events:
+        to_update = to_update.limit(max_events)
+    return DBSession.query(to_update.alias())
+
+
+def has_desync(time_limit, hls_time_limit, time_since=None,
+               hls_time_since=None, event_since=None, shard=None,
+               metrics=None):
+    """
+    Indique rapidement s'il existe au moins un hôte/service à synchroniser.
+
+    Chaque branche de la requête de resynchronisation est interrogée
+    séparément, en ne demandant qu'un seul résultat : la base de données
+    peut s'arrêter au premier élément trouvé, au lieu de calculer l'union
+    complète. Les branches suivantes ne sont pas interrogées dès qu'un
+    élément a été trouvé. Voir L{get_desync} pour la signification des
+    paramètres.
+
+    @param metrics: Mesures de l'exécution en cours (durée de la recherche
+        pour chaque branche interrogée), ou C{None}.
+    @type  metrics: L{vigilo.connector_syncevents.metrics.RunMetrics}
+    @return: C{True} s'il existe au moins un élément à synchroniser.
+    @rtype: C{bool}
+    """
+    try:
+        branches = _get_desync_branches(time_limit, hls_time_limit,
+                                        time_since, hls_time_since,
+                                        event_since, shard=shard)
+        for name, branch in branches.items():
+            start = time.time()
+            found = branch.limit(1).first() is not None
+            if metrics is not None:
+                metrics.add_time("probe_%s" % name, time.time() - start)
+            if found:
+                return True
+        return False
+    except (InvalidRequestError, OperationalError) as e:
+        LOGGER.error(_('Database exception raised: %s'),
+                        get_error_message(e))
+        raise e
+
+
+def _prioritize(resync, max_events=0, refs=None):
+    """
+    Classe les éléments à synchroniser par priorité décroissante :
+    d'abord ceux auxquels un événement corrélé ouvert est associé,
+    puis par gravité décroissante de l'état, et enfin du plus ancien
+    au plus récent. La limite C{max_events} s'applique alors aux
+    éléments les plus prioritaires.
+
+    @param resync: Branches de la requête de resynchronisation.
+        Les deux dernières sont celles des événements désynchronisés.
+    @type  resync: C{list} of C{sqlalchemy.orm.query.Query}
+    @param max_events: Nombre maximum d'éléments.
+    @type  max_events: C{int}
+    @param refs: Cache des données de référence, ou C{None}.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Requête SQL permettant de récupérer la liste des hôtes/services
+        à synchroniser, par ordre de priorité.
+    @rtype: C{sqlalchemy.orm.query.Query}
+    """
+    # Les branches des événements désynchronisés ne portent
+    # que sur des événements corrélés ouverts.
+    open_correvent = literal_column("1", Integer)
+    branches = [ _add_priority(q) for q in resync[:-2] ]
+    branches.extend([ _add_priority(q, open_correvent) for q in resync[-2:] ])
+
+    # Un même élément peut être remonté par plusieurs branches :
+    # on conserve ses critères les plus prioritaires.
+    to_update = union_all(*branches, correlate=False).alias()
+    if refs is None:
+        server = to_update.c.vigiloserver
+    else:
+        server = to_update.c.idhost
+    query = DBSession.query(
+        to_update.c.hostname,
+        to_update.c.servicename,
+        server,
+    ).group_by(
+        to_update.c.hostname,
+        to_update.c.servicename,
+        server,
+    ).order_by(
+        func.max(to_update.c.has_correvent).desc(),
+        func.max(to_update.c.severity).desc(),
+        func.min(to_update.c.state_timestamp),
+    )
+    if max_events:
+        query = query.limit(max_events)
+    return query
+
+
+def _resolve_ventilation(rows, refs, shard=None, max_events=0, pool=None):
+    """
+    Retrouve le collecteur Nagios de chaque élément à synchroniser à partir
+    de l'identifiant de l'hôte, à l'aide du cache des données de référence.
+    Les éléments portant sur un hôte qui n'est ventilé sur aucun collecteur
+    (actif) de la part traitée sont écartés.
+
+    @param rows: Résultats d'une requête construite avec ce cache.
+    @type  rows: C{iterable}
+    @param refs: Cache des données de référence.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @param max_events: Nombre maximum d'éléments.
+    @type  max_events: C{int}
+    @param pool: Chaînes partagées, ou C{None} pour en créer un ensemble.
+    @type  pool: L{StringPool}
+    @return: Générateur d'hôtes/services à synchroniser.
+    @rtype: C{generator} of L{SupItem}
+    """
+    if pool is None:
+        pool = StringPool()
+    ventilation = refs.ventilation(shard)
+    count = 0
+    for row in rows:
+        if row.idhost is None:
+            # Service de haut niveau.
+            servers = [None]
+        else:
+            servers = ventilation.get(row.idhost, ())
+        for vigiloserver in servers:
+            yield SupItem(pool(row.hostname), pool(row.servicename),
+                          vigiloserver)
+            count += 1
+            if max_events and count >= max_events:
+                return
+
+
+def get_desync(time_limit, hls_time_limit, max_events=0,
+               time_since=None, hls_time_since=None, event_since=None,
+               use_cte=None, priority=False, shard=None, refs=None):
+    """
+    Retourne les hôtes/services à synchroniser.
+
+    @param time_limit: Date après laquelle on ignore les états
+        en ce qui concerne les hôtes et les services de bas niveau.
+        Passer la valeur C{None} pour désactiver cette partie
+        de la resynchronisation.
+    @type  time_limit: C{datetime.datetime} or C{None}
+    @param hls_time_limit: Date après laquelle on ignore les états
+        pour les services de haut niveau. Passer la valeur C{None}
+        pour désactiver cette partie de la resynchronisation.
+    @type  hls_time_limit: C{datetime.datetime} or C{None}
+    @param max_events: Nombre maximum d'éléments.
+    @type  max_events: C{int}
+    @param time_since: Date avant laquelle on ignore les états des hôtes
+        et services de bas niveau (recherche incrémentale), ou C{None}.
+    @type  time_since: C{datetime.datetime}
+    @param hls_time_since: Date avant laquelle on ignore les états des
+        services de haut niveau (recherche incrémentale), ou C{None}.
+    @type  hls_time_since: C{datetime.datetime}
+    @param event_since: Date avant laquelle on ignore les désynchronisations
+        entre états et événements (recherche incrémentale), ou C{None}.
+    @type  event_since: C{datetime.datetime}
+    @param use_cte: Indique si les hôtes OK/UP et la ventilation Nagios
+        sont calculés une seule fois pour toutes les branches de la requête
+        (à l'aide de CTE), plutôt qu'une fois par branche. Par défaut,
+        les CTE ne sont utilisées qu'avec PostgreSQL.
+    @type  use_cte: C{bool}
+    @param priority: Indique si les éléments doivent être classés
+        par priorité (voir L{_prioritize}).
+    @type  priority: C{bool}
+    @param shard: Part des collecteurs traitée, ou C{None} pour traiter
+        l'ensemble des collecteurs.
+    @type  shard: L{Shard}
+    @param refs: Cache des données de référence (valeurs des états et
+        ventilation), ou C{None}. S'il est fourni, la requête ne fait pas
+        la jointure avec la ventilation : le collecteur de chaque élément
+        est retrouvé à l'aide du cache (la requête se contente d'écarter
+        les hôtes ventilés sur aucun collecteur actif de la part traitée).
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Liste d'hôtes/services à synchroniser
+    @rtype: C{list} of L{SupItem}
+
+    @todo: récupérer aussi l'adresse du serveur nagios dans la ventilation
+    """
+    try:
+        if refs is None:
+            return list(compact(_get_desync_query(
+                                time_limit, hls_time_limit, max_events,
+                                time_since, hls_time_since, event_since,
+                                use_cte, priority, shard)))
+        rows = _get_desync_query(time_limit, hls_time_limit, max_events,
+                                 time_since, hls_time_since, event_since,
+                                 use_cte, priority, shard, refs).all()
+        return list(_resolve_ventilation(rows, refs, shard, max_events))
+    except (InvalidRequestError, OperationalError) as e:
+        LOGGER.error(_('Database exception raised: %s'),
+                        get_error_message(e))
+        raise e
+
+
+def iter_desync(time_limit, hls_time_limit, max_events=0, fetch_size=1000,
+                time_since=None, hls_time_since=None, event_since=None,
+                use_cte=None, priority=False, shard=None, refs=None):
+    """
+    Variante de L{get_desync} qui parcourt les résultats au fil de l'eau.
+
+    Les résultats sont lus par lots depuis un curseur côté serveur, si la
+    base de données le permet : la consommation mémoire ne dépend pas du
+    nombre d'éléments à synchroniser et les premiers éléments peuvent être
+    traités avant la fin de la lecture des résultats.
+
+    La session de base de données doit rester ouverte tant que le
+    générateur n'a pas été entièrement parcouru.
+
+    @param fetch_size: Nombre de résultats lus à la fois.
+    @type  fetch_size: C{int}
+    @return: Générateur d'hôtes/services à synchroniser.
+    @rtype: C{generator} of L{SupItem}
+    """
+    query = _get_desync_query(time_limit, hls_time_limit, max_events,
+                              time_since, hls_time_since, event_since,
+                              use_cte, priority, shard, refs)
+    query = query.execution_options(stream_results=True)
+    try:
+        rows = query.yield_per(fetch_size)
+        if refs is not None:
+            rows = _resolve_ventilation(rows, refs, shard, max_events)
+        else:
+            rows = compact(rows)
+        for supitem in rows:
+            yield supitem
+    except (InvalidRequestError, OperationalError) as e:
+        LOGGER.error(_('Database exception raised: %s'),
+                        get_error_message(e))
+        raise e
+
+
+def _branch_rows(name, params, max_events=0):
+    """
+    @param name: Nom de la branche de la requête de resynchronisation.
+    @type  name: C{str}
+    @param params: Paramètres de L{_get_desync_branches}.
+    @type  params: C{tuple}
+    @param max_events: Nombre maximum de résultats (0 pour ne pas imposer
+        de limite).
+    @type  max_events: C{int}
+    @return: Résultats de la branche.
+    @rtype: C{list}
+    """
+    query = _get_desync_branches(*params)[name]
+    if max_events:
+        # Aucune branche ne peut fournir plus d'éléments que la limite
+        # globale : inutile de charger les autres en mémoire.
+        query = query.limit(max_events)
+    return query.all()
+
+
+def _fetch_branch(task):
+    """
+    Exécute l'une des branches de la requête de resynchronisation.
+    Cette fonction est appelée dans un fil d'exécution dédié : la session
+    (et donc la connexion à la base de données) lui est propre.
+
+    @param task: Nom de la branche, paramètres de L{_get_desync_branches}
+        et nombre maximum de résultats.
+    @type  task: C{tuple}
+    @return: Nom de la branche, résultats et durée de la requête.
+    @rtype: C{tuple}
+    """
+    name, params, max_events = task
+    try:
+        start = time.time()
+        rows = _branch_rows(name, params, max_events)
+        return (name, rows, time.time() - start)
+    finally:
+        # Libère la connexion de ce fil d'exécution.
+        transaction.abort()
+
+
+def get_desync_parallel(time_limit, hls_time_limit, max_events=0,
+                        time_since=None, hls_time_since=None,
+                        event_since=None, shard=None, workers=4,
+                        metrics=None, refs=None):
+    """
+    Variante de L{get_desync} qui exécute chaque branche de la requête
+    séparément, sur des connexions distinctes et en parallèle. La durée
+    de la recherche correspond alors à celle de la branche la plus lente,
+    plutôt qu'à la somme des durées de toutes les branches.
+
+    Les doublons (éléments remontés par plusieurs branches) sont éliminés
+    et la limite C{max_events} est appliquée à l'issue de cette élimination
+    (et de la recherche du collecteur de chaque élément, avec le cache des
+    données de référence). Chaque branche est en outre limitée par la base
+    de données : elle ne renvoie que des éléments de la part traitée, qui
+    seront tous retenus. Avec SQLite, les branches sont exécutées l'une
+    après l'autre.
+
+    @param workers: Nombre maximum de requêtes exécutées simultanément.
+    @type  workers: C{int}
+    @param metrics: Mesures de l'exécution en cours (durée de chaque
+        branche), ou C{None}.
+    @type  metrics: L{vigilo.connector_syncevents.metrics.RunMetrics}
+    @param refs: Cache des données de référence, ou C{None}.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @return: Liste d'hôtes/services à synchroniser.
+    @rtype: C{list}
+    """
+    params = (time_limit, hls_time_limit, time_since, hls_time_since,
+              event_since, None, shard, refs)
+    names = list(_get_desync_branches(*params).keys())
+    tasks = [ (name, params, max_events) for name in names ]
+
+    try:
+        if DBSession.get_bind().dialect.name == "sqlite" or workers <= 1:
+            # Une base SQLite ne peut pas être partagée entre plusieurs
+            # fils d'exécution de manière fiable.
+            fetched = []
+            for name in names:
+                start = time.time()
+                rows = _branch_rows(name, params, max_events)
+                fetched.append((name, rows, time.time() - start))
+        else:
+            pool = ThreadPool(min(workers, len(tasks)))
+            try:
+                fetched = pool.map(_fetch_branch, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        results = []
+        for name, rows, duration in fetched:
+            if metrics is not None:
+                metrics.add_time("branch_%s" % name, duration)
+            results.append(rows)
+    except (InvalidRequestError, OperationalError) as e:
+        LOGGER.error(_('Database exception raised: %s'),
+                        get_error_message(e))
+        raise e
+    pool = StringPool()
+    if refs is not None:
+        results = [ _resolve_ventilation(rows, refs, shard, pool=pool)
+                    for rows in results ]
+    else:
+        results = [ compact(rows, pool) for rows in results ]
+
+    seen = set()
+    to_update = []
+    for rows in results:
+        for supitem in rows:
+            if supitem in seen:
+                continue
+            seen.add(supitem)
+            to_update.append(supitem)
+            if max_events and len(to_update) >= max_events:
+                return to_update
+    return to_update
+
+
+def _chunks(values, size=400):
+    """
+    Découpe une liste de valeurs en lots, chaque lot faisant l'objet
+    d'une requête distincte : le nombre de paramètres d'une requête reste
+    ainsi borné quel que soit le nombre de valeurs.
+
+    @param values: Valeurs à découper.
+    @type  values: C{iterable}
+    @param size: Nombre maximal de valeurs par lot.
+    @type  size: C{int}
+    @return: Lots de valeurs.
+    @rtype: C{list} of C{list}
+    """
+    values = list(values)
+    return [ values[i:i + size] for i in range(0, len(values), size) ]
+
+
+def get_watched_states(with_lls=True, with_hls=True, supitems=None,
+                       shard=None):
+    """
+    Récupère les éléments susceptibles de devoir être synchronisés
+    à l'avenir, avec la date de leur état : hôtes et services de bas niveau
+    dans un état anormal, services de haut niveau OK/UNKNOWN. La date à
+    laquelle chacun d'eux devra être synchronisé s'en déduit
+    (voir L{vigilo.connector_syncevents.watcher}).
+
+    @param with_lls: Indique si les hôtes et services de bas niveau
+        sont recherchés.
+    @type  with_lls: C{bool}
+    @param with_hls: Indique si les services de haut niveau sont recherchés.
+    @type  with_hls: C{bool}
+    @param supitems: Identifiants des éléments supervisés dont l'état a
+        changé, ou C{None} pour rechercher tous les éléments. Les services
+        d'un hôte dont l'identifiant figure dans cette liste sont également
+        recherchés.
+    @type  supitems: C{iterable} of C{int}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @return: Liste de résultats disposant des propriétés C{idsupitem},
+        C{idhost} (C{None} pour un service de haut niveau), C{hostname},
+        C{servicename}, C{vigiloserver} et C{state_timestamp}.
+    @rtype: C{list}
+    """
+    if supitems is not None:
+        rows = []
+        for chunk in _chunks(supitems):
+            rows.extend(_get_watched_states(with_lls, with_hls, chunk,
+                                            shard))
+        return rows
+    return _get_watched_states(with_lls, with_hls, None, shard)
+
+
+def _get_watched_states(with_lls, with_hls, supitems, shard):
+    queries = []
+    if with_lls:
+        lls = get_old_lls(None, shard=shard).add_columns(
+            tables.State.idsupitem.label("idsupitem"),
+            tables.Host.idhost.label("idhost"),
+            tables.State.timestamp.label("state_timestamp"),
+        )
+        hosts = get_old_hosts(None, shard=shard).add_columns(
+            tables.State.idsupitem.label("idsupitem"),
+            tables.Host.idhost.label("idhost"),
+            tables.State.timestamp.label("state_timestamp"),
+        )
+        if supitems is not None:
+            lls = lls.filter(or_(
+                tables.Host.idhost.in_(supitems),
+                tables.LowLevelService.idservice.in_(supitems),
+            ))
+            hosts = hosts.filter(tables.Host.idhost.in_(supitems))
+        queries.extend([lls, hosts])
+    if with_hls and (shard is None or shard.with_hls):
+        hls = get_old_hls(None).add_columns(
+            tables.State.idsupitem.label("idsupitem"),
+            expr_null().label("idhost"),
+            tables.State.timestamp.label("state_timestamp"),
+        )
+        if supitems is not None:
+            hls = hls.filter(
+                tables.HighLevelService.idservice.in_(supitems))
+        queries.append(hls)
+
+    try:
+        rows = []
+        for query in queries:
+            rows.extend(query.all())
+        return rows
+    except (InvalidRequestError, OperationalError) as e:
+        LOGGER.error(_('Database exception raised: %s'),
+                        get_error_message(e))
+        raise e
+
+
+def _state_timestamp_queries(supitems, size=400):
+    """
+    Les éléments sont répartis en lots de C{size} éléments au plus, chaque
+    lot faisant l'objet de requêtes distinctes : le nombre de paramètres
+    d'une requête reste ainsi borné quel que soit le nombre d'éléments.
+
+    @param supitems: Couples (nom d'hôte, nom de service) désignant
+        les éléments. Le nom d'hôte vaut C{None} pour un service de haut
+        niveau, le nom de service vaut C{None} pour un hôte.
+    @type  supitems: C{list} of C{tuple}
+    @param size: Nombre maximal d'éléments par requête.
+    @type  size: C{int}
+    @return: Requêtes renvoyant le nom d'hôte, le nom de service et la date
+        de l'état de ces éléments.
+    @rtype: C{list}
+    """
+    supitems = list(supitems)
+    if len(supitems) > size:
+        queries = []
+        for chunk in _chunks(supitems, size):
+            queries.extend(_state_timestamp_queries(chunk, size))
+        return queries
+
+    hosts = [ host for host, service in supitems
+              if host is not None and service is None ]
+    services = [ (host, service) for host, service in supitems
+                 if host is not None and service is not None ]
+    hls = [ service for host, service in supitems if host is None ]
+
+    queries = []
+    if hosts:
+        queries.append(DBSession.query(
+            tables.Host.name.label("hostname"),
+            expr_null().label("servicename"),
+            tables.State.timestamp.label("state_timestamp"),
+        ).join(
+            (tables.State, tables.State.idsupitem == tables.Host.idhost),
+        ).filter(tables.Host.name.in_(hosts)))
+    if services:
+        queries.append(DBSession.query(
+            tables.Host.name.label("hostname"),
+            tables.LowLevelService.servicename.label("servicename"),
+            tables.State.timestamp.label("state_timestamp"),
+        ).join(
+            (tables.LowLevelService,
+                tables.LowLevelService.idhost == tables.Host.idhost),
+            (tables.State,
+                tables.State.idsupitem == tables.LowLevelService.idservice),
+        ).filter(or_(*[ and_(tables.Host.name == host,
+                             tables.LowLevelService.servicename == service)
+                        for host, service in services ])))
+    if hls:
+        queries.append(DBSession.query(
+            tables.HighLevelService.servicename.label("servicename"),
+            expr_null().label("hostname"),
+            tables.State.timestamp.label("state_timestamp"),
+        ).join(
+            (tables.State,
+                tables.State.idsupitem == tables.HighLevelService.idservice),
+        ).filter(tables.HighLevelService.servicename.in_(hls)))
+    return queries
+
+
+def count_refreshed(supitems, since):
+    """
+    Compte les éléments dont l'état a été mis à jour depuis une date
+    donnée (par exemple, en réponse à une demande de mise à jour).
+
+    @param supitems: Couples (nom d'hôte, nom de service) désignant
+        les éléments. Le nom d'hôte vaut C{None} pour un service de haut
+        niveau, le nom de service vaut C{None} pour un hôte.
+    @type  supitems: C{list} of C{tuple}
+    @param since: Date de référence.
+    @type  since: C{datetime.datetime}
+    @return: Nombre d'éléments dont l'état est plus récent que cette date.
+    @rtype: C{int}
+    """
+    try:
+        return sum([ query.filter(tables.State.timestamp > since).count()
+                     for query in _state_timestamp_queries(supitems) ])
+    except (InvalidRequestError, OperationalError) as e:
+        LOGGER.error(_('Database exception raised: %s'),
+                        get_error_message(e))
+        raise e
+
+
+def get_state_timestamps(supitems):
+    """
+    Récupère la date du dernier changement d'état de plusieurs éléments.
+
+    @param supitems: Couples (nom d'hôte, nom de service) désignant
+        les éléments (voir L{count_refreshed}).
+    @type  supitems: C{list} of C{tuple}
+    @return: Date de l'état de chaque élément trouvé, indexée par
+        le couple (nom d'hôte, nom de service).
+    @rtype: C{dict}
+    """
+    timestamps = {}
+    try:
+        for query in _state_timestamp_queries(supitems):
+            for row in query.all():
+                timestamps[(row.hostname, row.servicename)] = \
+                    row.state_timestamp
+    except (InvalidRequestError, OperationalError) as e:
+        LOGGER.error(_('Database exception raised: %s'),
+                        get_error_message(e))
+        raise e
+    return timestamps
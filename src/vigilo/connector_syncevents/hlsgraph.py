@@ -0,0 +1,150 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Ordonnancement des services de haut niveau à synchroniser d'après
+le graphe de leurs dépendances.
+
+Un service de haut niveau peut dépendre d'autres services de haut niveau.
+La mise à jour de l'un d'eux se propage à ceux qui en dépendent : il est
+donc inutile de demander en même temps la mise à jour d'un service et celle
+d'un service qui en dépend. Les services retenus sont envoyés dans l'ordre
+de leurs dépendances (les feuilles d'abord).
+"""
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+
+
+def _cycle_members(nodes, children):
+    """
+    Recherche les composantes fortement connexes du graphe (algorithme de
+    Tarjan, en version itérative).
+
+    @param nodes: Nœuds à examiner.
+    @type  nodes: C{iterable}
+    @param children: Successeurs de chaque nœud.
+    @type  children: C{dict}
+    @return: Nœuds appartenant à un cycle.
+    @rtype: C{set}
+    """
+    nodes = set(nodes)
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    members = set()
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(children.get(root, ())))]
+        while work:
+            node, successors = work[-1]
+            for child in successors:
+                if child not in nodes:
+                    continue
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(children.get(child, ()))))
+                    break
+                if child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] != index[node]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1:
+                    members.update(component)
+    return members
+
+
+def order_hls(candidates, edges):
+    """
+    Ordonne les services de haut niveau à synchroniser.
+
+    Un service est écarté lorsque l'un des services de haut niveau dont il
+    dépend (directement ou non) doit lui-même être synchronisé : sa mise à
+    jour découlera de celle de ce dernier. S'il reste désynchronisé, il sera
+    retenu lors d'une recherche ultérieure.
+
+    @param candidates: Services de haut niveau à synchroniser, indexés
+        par leur identifiant.
+    @type  candidates: C{dict}
+    @param edges: Couples (identifiant du service dépendant, identifiant du
+        service de haut niveau dont il dépend).
+    @type  edges: C{iterable}
+    @return: Couple formé de la liste des services retenus, dans l'ordre
+        de leurs dépendances, et de la liste des services écartés.
+    @rtype: C{tuple}
+    """
+    children = {}
+    parents = {}
+    for parent, child in edges:
+        if parent == child:
+            continue
+        children.setdefault(parent, set()).add(child)
+        parents.setdefault(child, set()).add(parent)
+
+    # Parcours des feuilles vers les racines (algorithme de Kahn) :
+    # la hauteur d'un service est sa distance maximale à une feuille.
+    height = {}
+    below = {}
+    remaining = dict((node, len(nodes)) for node, nodes in children.items())
+    ready = [ node for node in parents if node not in children ]
+    while ready:
+        node = ready.pop()
+        height[node] = max([ height[child] + 1
+                             for child in children.get(node, ()) ] or [0])
+        below[node] = any(child in candidates or below[child]
+                          for child in children.get(node, ()))
+        for parent in parents.get(node, ()):
+            remaining[parent] -= 1
+            if not remaining[parent]:
+                ready.append(parent)
+
+    # Services dont l'ordre n'a pu être établi : ceux pris dans un cycle
+    # et ceux qui dépendent (directement ou non) de l'un d'eux.
+    cyclic = set(node for node in candidates
+                 if node in children and node not in height)
+    if cyclic:
+        in_cycles = _cycle_members([ node for node in children
+                                     if node not in height ], children)
+        LOGGER.warning(_("Dependency cycle between %(cycle)d high-level "
+                         "service(s), synchronizing %(unordered)d unordered "
+                         "service(s) last"),
+                       {"cycle": len(in_cycles), "unordered": len(cyclic)})
+
+    kept = []
+    deferred = []
+    for node in candidates:
+        if below.get(node):
+            deferred.append(candidates[node])
+        else:
+            kept.append(node)
+    deferred.sort(key=lambda supitem: supitem.servicename or u"")
+    # Les services pris dans un cycle sont envoyés en dernier.
+    last = max(list(height.values()) or [0]) + 1
+    kept.sort(key=lambda node: (last if node in cyclic
+                                else height.get(node, 0),
+                                candidates[node].servicename or u""))
+    return [ candidates[node] for node in kept ], deferred
@@ -0,0 +1,253 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Recherche incrémentale des éléments désynchronisés.
+
+Plutôt que de réexaminer tous les états à chaque exécution, on mémorise
+la date de la dernière recherche complète et les éléments pour lesquels
+une mise à jour a déjà été demandée. Une exécution ne considère alors
+que les états et événements modifiés depuis la recherche précédente,
+ainsi que les éléments dont la demande de mise à jour a expiré.
+
+Un élément peut être désynchronisé sans que son propre état ait changé
+(par exemple, un service dont l'hôte redevient UP) : une recherche
+complète est donc effectuée périodiquement.
+"""
+
+from datetime import datetime
+
+from vigilo.connector_syncevents.state import DATE_FORMAT
+
+
+
+def _parse(value):
+    if value is None:
+        return None
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def _format(value):
+    if value is None:
+        return None
+    return value.strftime(DATE_FORMAT)
+
+
+def supitem_key(supitem):
+    """
+    @param supitem: Hôte ou service à synchroniser.
+    @type  supitem: C{object}
+    @return: Clé identifiant l'élément.
+    @rtype: C{unicode}
+    """
+    return u"\t".join([supitem.hostname or u"",
+                       supitem.servicename or u"",
+                       supitem.vigiloserver or u""])
+
+
+
+class IncrementalScan(object):
+    """
+    Suivi de la recherche incrémentale des éléments désynchronisés.
+
+    Utilisation :
+
+        1. L{start} indique la date à partir de laquelle les changements
+           doivent être pris en compte (C{None} pour une recherche complète) ;
+        2. L{exclude} et L{record} retirent des résultats les éléments
+           pour lesquels une demande est encore en cours ;
+        3. L{mark} mémorise les éléments pour lesquels une demande
+           a effectivement été publiée ;
+        4. L{finish} fait avancer la date de référence, si tous les
+           résultats ont été parcourus.
+    """
+
+    def __init__(self, state, expiry, full_interval=None):
+        """
+        @param state: Section du fichier d'état réservée à la recherche
+            incrémentale (modifiée en place).
+        @type  state: C{dict}
+        @param expiry: Délai au-delà duquel une demande de mise à jour
+            restée sans effet est renouvelée.
+        @type  expiry: C{datetime.timedelta}
+        @param full_interval: Délai au-delà duquel une recherche complète
+            est effectuée, ou C{None} pour ne jamais l'imposer.
+        @type  full_interval: C{datetime.timedelta}
+        """
+        self.state = state
+        self.state.setdefault("asked", {})
+        self.expiry = expiry
+        self.full_interval = full_interval
+        self.now = None
+        self.since = None
+        self.complete = False
+        self.released = 0
+
+
+    def start(self, now):
+        """
+        Prépare une nouvelle recherche.
+
+        @param now: Date de la recherche.
+        @type  now: C{datetime.datetime}
+        @return: Date à partir de laquelle les changements doivent être
+            pris en compte, ou C{None} si une recherche complète est
+            nécessaire.
+        @rtype: C{datetime.datetime}
+        """
+        self.now = now
+        self.complete = False
+        self.released = 0
+        since = _parse(self.state.get("last_scan"))
+        full = since is None
+        if self.full_interval:
+            last_full = _parse(self.state.get("last_full_scan"))
+            if last_full is None or last_full + self.full_interval <= now:
+                full = True
+
+        # Les demandes expirées sont oubliées. On élargit la fenêtre
+        # de recherche pour que les éléments concernés soient retrouvés
+        # s'ils sont toujours désynchronisés.
+        asked = self.state["asked"]
+        for key, (asked_at, asked_since) in list(asked.items()):
+            if _parse(asked_at) + self.expiry > now:
+                continue
+            del asked[key]
+            if asked_since is None:
+                full = True
+            elif not full:
+                since = min(since, _parse(asked_since))
+
+        self.since = None if full else since
+        return self.since
+
+
+    def resume(self, now):
+        """
+        Prépare l'envoi d'éléments repris du fichier de reprise, sans
+        nouvelle recherche. La date de référence n'avance pas à l'issue
+        de cet envoi et les demandes expirées ne seront traitées que par
+        la recherche suivante.
+
+        La fenêtre de recherche qui a permis de trouver ces éléments
+        n'étant pas connue, l'expiration de leur demande entraînera une
+        recherche complète.
+
+        @param now: Date de l'envoi.
+        @type  now: C{datetime.datetime}
+        """
+        self.now = now
+        self.since = None
+        self.complete = False
+        self.released = 0
+
+
+    def filter(self, supitems):
+        """
+        Ignore les éléments pour lesquels une mise à jour a déjà
+        été demandée et mémorise les autres, comme si une demande était
+        publiée pour chacun d'eux au fil du parcours.
+
+        @param supitems: Éléments à synchroniser.
+        @type  supitems: C{iterable}
+        @return: Éléments pour lesquels une demande doit être envoyée.
+        @rtype: C{generator}
+        """
+        for supitem in self.record(self.exclude(supitems)):
+            self.mark([supitem])
+            yield supitem
+
+
+    def exclude(self, supitems):
+        """
+        @param supitems: Éléments à synchroniser.
+        @type  supitems: C{iterable}
+        @return: Éléments pour lesquels aucune mise à jour n'a encore
+            été demandée.
+        @rtype: C{generator}
+        """
+        asked = self.state["asked"]
+        for supitem in supitems:
+            if supitem_key(supitem) not in asked:
+                yield supitem
+
+
+    def record(self, supitems, truncated=None):
+        """
+        Parcourt les éléments pour lesquels une demande va être envoyée,
+        en ignorant les doublons. La recherche est considérée comme complète
+        une fois tous les éléments parcourus.
+
+        Les éléments ne sont mémorisés qu'une fois la demande publiée
+        (voir L{mark}) : si l'envoi est interrompu, ceux qui restent
+        seront retrouvés par la recherche suivante.
+
+        @param supitems: Éléments à synchroniser.
+        @type  supitems: C{iterable}
+        @param truncated: Fonction indiquant, une fois les éléments
+            parcourus, si certains d'entre eux ont été écartés en amont
+            (la recherche n'est alors pas complète).
+        @type  truncated: C{callable}
+        @return: Éléments pour lesquels une demande doit être envoyée.
+        @rtype: C{generator}
+        """
+        asked = self.state["asked"]
+        seen = set()
+        for supitem in supitems:
+            key = supitem_key(supitem)
+            if key in asked or key in seen:
+                continue
+            seen.add(key)
+            yield supitem
+        self.complete = truncated is None or not truncated()
+
+
+    def mark(self, supitems):
+        """
+        Mémorise les éléments pour lesquels une demande a été publiée.
+
+        @param supitems: Éléments concernés.
+        @type  supitems: C{list}
+        """
+        asked = self.state["asked"]
+        entry = [_format(self.now), _format(self.since)]
+        for supitem in supitems:
+            asked[supitem_key(supitem)] = entry
+
+
+    def release(self, supitems):
+        """
+        Signale des éléments parcourus pour lesquels aucune demande n'a été
+        publiée (envoi interrompu) : la recherche n'est pas complète et ils
+        seront retrouvés par la recherche suivante.
+
+        @param supitems: Éléments concernés.
+        @type  supitems: C{list}
+        """
+        self.released += len(supitems)
+
+
+    def postpone(self, supitem):
+        """
+        Mémorise un élément écarté temporairement (sans demande de mise à
+        jour) : comme pour une demande restée sans effet, il sera réexaminé
+        à l'expiration du délai.
+
+        @param supitem: Élément écarté.
+        @type  supitem: C{object}
+        """
+        self.state["asked"][supitem_key(supitem)] = \
+            [_format(self.now), _format(self.since)]
+
+
+    def finish(self):
+        """
+        Termine la recherche. La date de référence n'avance que si tous
+        les résultats ont été parcourus (la recherche suivante reprendra
+        sinon là où celle-ci s'est arrêtée).
+        """
+        if self.complete and not self.released:
+            self.state["last_scan"] = _format(self.now)
+            if self.since is None:
+                self.state["last_full_scan"] = _format(self.now)
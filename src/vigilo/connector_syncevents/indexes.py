@@ -0,0 +1,232 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Vérification des index utiles aux requêtes du connecteur syncevents.
+
+Les index recommandés correspondent aux filtres et jointures des requêtes
+de resynchronisation (voir L{vigilo.connector_syncevents.desync}).
+Avec PostgreSQL, des index partiels sont recommandés lorsque la requête
+ne porte que sur une petite partie de la table (par exemple, les états
+anormaux).
+
+Comme L{vigilo.connector_syncevents.desync}, l'import de ce module
+configure l'accès à la base de données.
+"""
+
+from __future__ import print_function
+import re
+
+# Configure l'accès à la base de données.
+from vigilo.connector_syncevents import desync # pylint: disable-msg=W0611
+
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.sql.expression import text
+
+from vigilo.models.session import DBSession
+from vigilo.models import tables
+from vigilo.models.tables.eventsaggregate import EventsAggregate
+
+
+
+class IndexSpec(object):
+    """
+    Index recommandé pour les requêtes du connecteur.
+    """
+
+    def __init__(self, name, table, columns, where=None, fallback=None,
+                 reason=None):
+        """
+        @param name: Nom de l'index à créer.
+        @type  name: C{str}
+        @param table: Table indexée.
+        @type  table: C{sqlalchemy.Table}
+        @param columns: Colonnes indexées, dans l'ordre.
+        @type  columns: C{list} of C{str}
+        @param where: Condition d'un index partiel (PostgreSQL), ou C{None}.
+        @type  where: C{str}
+        @param fallback: Colonnes indexées lorsque les index partiels ne
+            sont pas disponibles, ou C{None} pour utiliser C{columns}.
+        @type  fallback: C{list} of C{str}
+        @param reason: Requête bénéficiant de l'index.
+        @type  reason: C{str}
+        """
+        self.name = name
+        self.table = table
+        self.columns = list(columns)
+        self.where = where
+        self.fallback = list(fallback or columns)
+        self.reason = reason
+
+
+    def for_dialect(self, dialect):
+        """
+        @param dialect: Nom du dialecte SQL de la base de données.
+        @type  dialect: C{str}
+        @return: Colonnes et condition de l'index pour ce dialecte.
+        @rtype: C{tuple}
+        """
+        if self.where is not None and dialect == "postgresql":
+            return (self.columns, self.where)
+        return (self.fallback, None)
+
+
+    def ddl(self, dialect):
+        """
+        @param dialect: Nom du dialecte SQL de la base de données.
+        @type  dialect: C{str}
+        @return: Instruction de création de l'index.
+        @rtype: C{str}
+        """
+        columns, where = self.for_dialect(dialect)
+        # Sous PostgreSQL, l'index est créé sans bloquer les écritures
+        # sur la table (le connecteur peut rester actif).
+        concurrently = "CONCURRENTLY " if dialect == "postgresql" else ""
+        ddl = "CREATE INDEX %s%s ON %s (%s)" % (concurrently, self.name,
+                                               self.table.name,
+                                               ", ".join(columns))
+        if where is not None:
+            ddl += " WHERE %s" % where
+        return ddl + ";"
+
+
+
+def get_recommended_indexes():
+    """
+    @return: Index recommandés pour les requêtes du connecteur.
+    @rtype: C{list} of L{IndexSpec}
+    """
+    state_up = tables.StateName.statename_to_value(u'UP')
+    state_ok = tables.StateName.statename_to_value(u'OK')
+    state = tables.State.__table__
+    return [
+        IndexSpec("ix_syncevents_state_stale", state,
+                  ["timestamp"],
+                  where="%s NOT IN (%d, %d)" % (state.c.state.name,
+                                                state_up, state_ok),
+                  fallback=["state", "timestamp"],
+                  reason="states older than minutes_old"),
+        IndexSpec("ix_syncevents_event_supitem", tables.Event.__table__,
+                  ["idsupitem", "current_state"],
+                  reason="state/event mismatches"),
+        IndexSpec("ix_syncevents_ventilation", tables.Ventilation.__table__,
+                  ["idhost", "idapp"],
+                  reason="Nagios ventilation"),
+        IndexSpec("ix_syncevents_correvent_open", tables.CorrEvent.__table__,
+                  ["idcorrevent"],
+                  where="ack != %d" % tables.CorrEvent.ACK_CLOSED,
+                  fallback=["ack"],
+                  reason="open correlated events"),
+        IndexSpec("ix_syncevents_eventsaggregate",
+                  EventsAggregate.__table__, ["idevent"],
+                  reason="open correlated events"),
+        IndexSpec("ix_syncevents_lls_host", tables.LowLevelService.__table__,
+                  ["idhost"],
+                  reason="services of UP hosts"),
+    ]
+
+
+def _pg_indexes(bind, table):
+    """
+    @return: Index existants sur une table PostgreSQL : colonnes
+        et condition (pour les index partiels).
+    @rtype: C{list} of C{tuple}
+    """
+    rows = bind.execute(text("SELECT indexdef FROM pg_indexes "
+                             "WHERE tablename = :table"), table=table)
+    indexes = []
+    for (indexdef, ) in rows:
+        match = re.search(r"\((.*?)\)(?: WHERE (.*))?$", indexdef)
+        if match is None:
+            continue
+        columns = [ col.strip().strip('"')
+                    for col in match.group(1).split(",") ]
+        indexes.append((columns, match.group(2)))
+    return indexes
+
+
+def get_existing_indexes(bind, table):
+    """
+    @param bind: Connexion à la base de données.
+    @type  bind: C{sqlalchemy.engine.Engine}
+    @param table: Nom de la table.
+    @type  table: C{str}
+    @return: Index existants (y compris la clé primaire) : liste
+        de couples (colonnes, condition ou C{None}).
+    @rtype: C{list} of C{tuple}
+    """
+    if bind.dialect.name == "postgresql":
+        # L'inspecteur de SQLAlchemy ne restitue pas la condition
+        # des index partiels.
+        return _pg_indexes(bind, table)
+    inspector = Inspector.from_engine(bind)
+    indexes = [ (index["column_names"], None)
+                for index in inspector.get_indexes(table) ]
+    primary_key = inspector.get_pk_constraint(table)
+    if primary_key.get("constrained_columns"):
+        indexes.append((primary_key["constrained_columns"], None))
+    return indexes
+
+
+def check_index(spec, existing, dialect):
+    """
+    @param spec: Index recommandé.
+    @type  spec: L{IndexSpec}
+    @param existing: Index existants sur la table (voir
+        L{get_existing_indexes}).
+    @type  existing: C{list} of C{tuple}
+    @param dialect: Nom du dialecte SQL de la base de données.
+    @type  dialect: C{str}
+    @return: C{"ok"} si un index existant convient, C{"full"} si seul un
+        index complet existe alors qu'un index partiel est recommandé,
+        C{"missing"} sinon.
+    @rtype: C{str}
+    """
+    columns, where = spec.for_dialect(dialect)
+    status = "missing"
+    for index_columns, index_where in existing:
+        # Un index est utilisable si les colonnes recherchées
+        # en constituent le début.
+        if list(index_columns[:len(columns)]) != columns:
+            continue
+        if where is None or index_where is not None:
+            return "ok"
+        status = "full"
+    if status == "missing" and where is not None:
+        for index_columns, _where in existing:
+            if list(index_columns[:len(spec.fallback)]) == spec.fallback:
+                status = "full"
+    return status
+
+
+def check_indexes(ddl=False):
+    """
+    Vérifie la présence des index recommandés et affiche un rapport.
+
+    @param ddl: Indique si les instructions de création des index
+        manquants doivent être affichées.
+    @type  ddl: C{bool}
+    @return: Nombre d'index manquants.
+    @rtype: C{int}
+    """
+    bind = DBSession.get_bind()
+    dialect = bind.dialect.name
+    missing = []
+    for spec in get_recommended_indexes():
+        status = check_index(spec,
+                             get_existing_indexes(bind, spec.table.name),
+                             dialect)
+        columns, where = spec.for_dialect(dialect)
+        description = "%s(%s)" % (spec.table.name, ", ".join(columns))
+        if where is not None:
+            description += " WHERE %s" % where
+        print("%-8s %s -- %s" % (status.upper(), description, spec.reason))
+        if status != "ok":
+            missing.append(spec)
+
+    if ddl and missing:
+        print()
+        for spec in missing:
+            print(spec.ddl(dialect))
+    return len(missing)
@@ -6,396 +6,780 @@
 Ce composant lit les événements en cours dans la base de données, et demande
 à Nagios de renvoyer les états pour les services concernés, afin de garantir
 la synchronicité des deux bases.
+
+Les modules lourds (accès à la base de données, bus) ne sont importés
+qu'au moment où ils deviennent nécessaires : une instance qui ne parvient pas
+à obtenir le verrou, ou qui n'a rien à synchroniser, se termine rapidement.
 """
 
 import time
+# Début du démarrage, pour les mesures de l'exécution (voir RunMetrics).
+_STARTED = time.time()
+
 import sys
+import socket
 import logging
+import itertools
 from optparse import OptionParser
 from datetime import datetime, timedelta
 
-from zope.interface import implements
-
 from vigilo.common.conf import settings
 settings.load_module(__name__)
 
-from vigilo.models.configure import configure_db
-configure_db(settings['database'], 'sqlalchemy_')
-
 from vigilo.common.logging import get_logger, get_error_message
 LOGGER = get_logger(__name__)
 
 from vigilo.common.gettext import translate
 _ = translate(__name__)
 
-from twisted.internet import defer
-from sqlalchemy.exc import InvalidRequestError, OperationalError
-from sqlalchemy.sql.expression import null as expr_null, union
-
 from vigilo.common.lock import grab_lock
-from vigilo.connector.client import oneshotclient_factory
-from vigilo.connector.handlers import buspublisher_factory
-from vigilo.models.session import DBSession
-from vigilo.models import tables
-from vigilo.models.tables.eventsaggregate import EventsAggregate
-
-
-
-def _add_ventilation(query):
-    return query.join(
-                (tables.Ventilation,
-                    tables.Ventilation.idhost == tables.Host.idhost),
-                (tables.VigiloServer,
-                    tables.VigiloServer.idvigiloserver
-                    == tables.Ventilation.idvigiloserver),
-                (tables.Application,
-                    tables.Application.idapp == tables.Ventilation.idapp),
-            ).filter(
-                tables.Application.name == u"nagios"
-            ).filter(
-                tables.VigiloServer.disabled == False
-            )
-
-
-def get_old_lls(time_limit):
-    """
-    Récupère les services à synchroniser.
-
-    On configure Nagios pour renvoyer l'état des services non-OK toutes les X
-    minutes. L'état est alors mis à jour dans la base. Donc si on trouve un
-    état dans la base qui n'a pas été mis à jour il y a moins de X minutes,
-    c'est potentiellement un message perdu, donc un service à re-synchroniser.
-
-    Attention par contre, si l'hôte est DOWN Nagios n'enverra pas de mise à
-    jours pour les services de cet hôte. Il faut donc exclure ces services.
-
-    @param time_limit: Date après laquelle on ignore les états.
-    @type  time_limit: C{datetime.datetime}
-    @return: Requête SQL permettant de récupérer la liste des services
-        dont l'état est obsolète.
-    @rtype: C{sqlalchemy.orm.query.Query}
-    """
-    state_up = tables.StateName.statename_to_value(u'UP')
-    state_ok = tables.StateName.statename_to_value(u'OK')
-
-    # On récupère d'abord les hôtes DOWN/UNREACHABLE pour pouvoir ne remonter
-    # que les services désynchronisés sur les hôtes OK/UP (#727)
-    # Un hôte peut être "OK" si un exploitant a "Forcé à fermer"
-    # une alarme portant sur cet hôte.
-    hosts_down = DBSession.query(
-        tables.Host.idhost,
-    ).join(
-        (tables.State, tables.State.idsupitem == tables.Host.idhost),
-    ).filter(
-        tables.State.state.in_([state_up, state_ok]),
-    )
-
-    lls_to_update = DBSession.query(
-        tables.Host.name.label('hostname'),
-        tables.LowLevelService.servicename.label('servicename'),
-        tables.VigiloServer.name.label("vigiloserver"),
-    ).join(
-        (tables.LowLevelService,
-            tables.LowLevelService.idhost == tables.Host.idsupitem),
-        (tables.State,
-            tables.State.idsupitem == tables.LowLevelService.idservice),
-    ).filter(
-        # On ne veut resynchroniser que les états anormaux.
-        ~tables.State.state.in_([state_up, state_ok]),
-    ).filter(
-        tables.State.timestamp <= time_limit,
-    ).filter(
-        tables.Host.idhost.in_(hosts_down)
-    )
-    return _add_ventilation(lls_to_update)
-
-
-def get_old_hosts(time_limit):
-    """
-    Récupère les hôtes à synchroniser.
-
-    Voir le commentaire précédent sur les services pour le critère de
-    désynchronisation. La situation est similaire pour les hôtes.
-
-    @param time_limit: Date après laquelle on ignore les états.
-    @type  time_limit: C{datetime.datetime}
-    @return: Requête SQL permettant de récupérer la liste des hôtes
-        dont l'état est obsolète.
-    @rtype: C{sqlalchemy.orm.query.Query}
-    """
-    # Les hôtes OK/UP ne nous intéressent pas.
-    # Un hôte peut être "OK" si un exploitant a "Forcé à fermer"
-    # une alarme portant sur cet hôte.
-    state_up = tables.StateName.statename_to_value(u'UP')
-    state_ok = tables.StateName.statename_to_value(u'OK')
-
-    q = DBSession.query(
-        tables.Host.name.label('hostname'),
-        # pour faire une UNION il faut le même nombre de colonnes
-        expr_null().label('servicename'),
-        tables.VigiloServer.name.label("vigiloserver"),
-    ).join(
-        (tables.State, tables.State.idsupitem == tables.Host.idhost),
-    ).filter(
-        # On ne veut resynchroniser que les états anormaux.
-        ~tables.State.state.in_([state_up, state_ok])
-    ).filter(
-        tables.State.timestamp <= time_limit
-    )
-    return _add_ventilation(q)
-
-
-def get_old_hls(hls_time_limit):
-    """
-    Récupère les services de haut niveau à synchroniser.
-
-    On configure Nagios pour renvoyer l'état des services de haut niveau
-    non-OK toutes les X minutes. L'état est alors mis à jour dans la base.
-    Donc si on trouve un état dans la base qui n'a pas été mis à jour
-    il y a moins de X minutes, c'est potentiellement un message perdu
-    donc un service à re-synchroniser.
-
-    La resynchronisation permet aussi d'initialiser proprement
-    les services de haut niveau côté Vigilo lorsqu'ils sont
-    dans un état nominal côté Nagios.
-
-    @param hls_time_limit: Date après laquelle on ignore les états.
-    @type  hls_time_limit: C{datetime.datetime}
-    @return: Requête SQL permettant de récupérer la liste des services
-        de haut niveau dont l'état est obsolète.
-    @rtype: C{sqlalchemy.orm.query.Query}
-    """
-    # On force Nagios à envoyer une notification pour les états suivants :
-    # OK : état nominal; Nagios n'émet pas de notification dans ce cas,
-    #      mais on a besoin de l'information pour éviter des incohérences.
-    # UNKNOWN : état initial des HLS dans Nagios. Donc il n'enverra pas
-    #           de notification à Vigilo si le service est toujours UNKNOWN
-    #           après la première vérification.
-    state_ok = tables.StateName.statename_to_value(u'OK')
-    state_unknown = tables.StateName.statename_to_value(u'UNKNOWN')
-
-    q = DBSession.query(
-        expr_null().label('hostname'),
-        tables.HighLevelService.servicename,
-        expr_null().label('vigiloserver'),
-    ).select_from(
-        tables.HighLevelService
-    ).join(
-        (tables.State,
-            tables.State.idsupitem == tables.HighLevelService.idservice),
-    ).filter(tables.State.state.in_([state_ok, state_unknown])
-    ).filter(tables.State.timestamp <= hls_time_limit)
-    return q
-
-
-def get_desync_event_services():
-    """
-    Récupère les services dont l'état et les événements sont désynchronisés
-
-    @return: Requête SQL permettant de récupérer la liste des services
-        dont l'état ne correspond pas au dernier événement stocké.
-    @rtype: C{sqlalchemy.orm.query.Query}
-    """
-    # Les hôtes OK/UP ne nous intéressent pas.
-    # Un hôte peut être "OK" si un exploitant a "Forcé à fermer"
-    # une alarme portant sur cet hôte.
-    state_up = tables.StateName.statename_to_value(u'UP')
-    state_ok = tables.StateName.statename_to_value(u'OK')
-
-    # On récupère d'abord les hôtes DOWN/UNREACHABLE pour pouvoir ne remonter
-    # que les services désynchronisés sur les hôtes OK/UP (#727)
-    # Un hôte peut être "OK" si un exploitant a "Forcé à fermer"
-    # une alarme portant sur cet hôte.
-    hosts_down = DBSession.query(
-        tables.Host.idhost,
-    ).join(
-        (tables.State, tables.State.idsupitem == tables.Host.idhost),
-    ).filter(
-        tables.State.state.in_([state_up, state_ok]),
-    )
-
-    q = DBSession.query(
-        tables.Host.name.label('hostname'),
-        tables.LowLevelService.servicename.label('servicename'),
-        tables.VigiloServer.name.label("vigiloserver"),
-    ).join(
-        (tables.LowLevelService,
-            tables.LowLevelService.idhost == tables.Host.idhost),
-        (tables.State,
-            tables.State.idsupitem == tables.LowLevelService.idservice),
-        (tables.Event,
-            tables.Event.idsupitem == tables.State.idsupitem),
-    ).filter(
-        tables.State.state != tables.Event.current_state
-    ).filter(
-        tables.Host.idhost.in_(hosts_down)
-    )
-    return _add_ventilation(q)
-
-
-def get_desync_event_hosts():
-    """
-    Récupère les hôtes dont l'état et les événements sont désynchronisés.
-
-    @return: Requête SQL permettant de récupérer la liste des hôtes
-        dont l'état ne correspond pas au dernier événement stocké.
-    @rtype: C{sqlalchemy.orm.query.Query}
-    """
-    q = DBSession.query(
-        tables.Host.name.label('hostname'),
-        # pour faire une UNION il faut le même nombre de colonnes
-        expr_null().label('servicename'),
-        tables.VigiloServer.name.label("vigiloserver"),
-    ).join(
-        (tables.State,
-            tables.State.idsupitem == tables.Host.idhost),
-        (tables.Event,
-            tables.Event.idsupitem == tables.State.idsupitem),
-    ).filter(
-        tables.State.state != tables.Event.current_state
-    )
-    return _add_ventilation(q)
-
-
-def keep_only_open_correvents(req):
-    """
-    Ne conserve que les évènements associés à un C{CorrEvent} encore ouvert
-
-    @param req: Requête SQLAlchemy de filtrage pour ne garder que les
-        C{CorrEvent} actifs.
-    @type req: C{sqlalchemy.orm.query.Query}
-    """
-    return req.join(
-            (EventsAggregate,
-                EventsAggregate.idevent == tables.Event.idevent),
-            (tables.CorrEvent,
-                tables.CorrEvent.idcorrevent == EventsAggregate.idcorrevent),
-        ).filter(
-            tables.CorrEvent.ack != tables.CorrEvent.ACK_CLOSED
-        )
-
-
-def get_desync(time_limit, hls_time_limit, max_events=0):
-    """
-    Retourne les hôtes/services à synchroniser.
-
-    @param time_limit: Date après laquelle on ignore les états
-        en ce qui concerne les hôtes et les services de bas niveau.
-        Passer la valeur C{None} pour désactiver cette partie
-        de la resynchronisation.
-    @type  time_limit: C{datetime.datetime} or C{None}
-    @param hls_time_limit: Date après laquelle on ignore les états
-        pour les services de haut niveau. Passer la valeur C{None}
-        pour désactiver cette partie de la resynchronisation.
-    @type  hls_time_limit: C{datetime.datetime} or C{None}
-    @param max_events: Nombre maximum d'éléments.
-    @type  max_events: C{int}
-    @return: Liste d'hôtes/services à synchroniser
-    @rtype: C{list} of C{mixed}
-
-    @todo: récupérer aussi l'adresse du serveur nagios dans la ventilation
-    """
-    resync = []
-
-    if time_limit is not None:
-        # Resynchronisation des états des LLS/hosts.
-        LOGGER.info(_("Listing hosts/services states older than %s"),
-                     time_limit.strftime("%Y-%m-%d %H:%M:%S"))
-        resync.extend([
-            get_old_lls(time_limit),
-            get_old_hosts(time_limit),
-        ])
-
-    if hls_time_limit is not None:
-        # Resynchronisation des états des HLS.
-        LOGGER.info(_("Listing high-level services states older than %s"),
-                     hls_time_limit.strftime("%Y-%m-%d %H:%M:%S"))
-        resync.append(get_old_hls(hls_time_limit))
-
-    resync.append(keep_only_open_correvents(get_desync_event_services()))
-    resync.append(keep_only_open_correvents(get_desync_event_hosts()))
-
-    to_update = union(*resync, correlate=False)
-    if max_events:
-        to_update = to_update.limit(max_events)
 
+from vigilo.connector_syncevents.state import StateFile
+from vigilo.connector_syncevents.incremental import IncrementalScan
+from vigilo.connector_syncevents.scheduler import FairScheduler, \
+                                                  CollectorRateLimiter
+from vigilo.connector_syncevents.suppression import SuppressionCache
+from vigilo.connector_syncevents.shard import Shard
+from vigilo.connector_syncevents.metrics import RunMetrics
+from vigilo.connector_syncevents.adaptive import AdaptiveBudget
+from vigilo.connector_syncevents.tracker import RequestTracker, \
+                                                print_unresponsive
+from vigilo.connector_syncevents.spool import Spool
+
+
+
+def get_time_delays():
+    """
+    @return: Âge à partir duquel les états des hôtes et services de bas
+        niveau, puis des services de haut niveau, sont considérés comme
+        désynchronisés (C{None} lorsque la resynchronisation
+        correspondante est désactivée).
+    @rtype: C{tuple} of C{datetime.timedelta}
+    """
     try:
-        return DBSession.query(to_update.alias()).all()
-    except (InvalidRequestError, OperationalError) as e:
-        LOGGER.error(_('Database exception raised: %s'),
-                        get_error_message(e))
-        raise e
+        minutes_old = int(settings['connector-syncevents']["minutes_old"])
+    except KeyError:
+        minutes_old = 45
 
+    try:
+        hls_minutes_old = int(settings['connector-syncevents']["hls_minutes_old"])
+    except KeyError:
+        hls_minutes_old = -1
 
+    delays = []
+    for minutes in (minutes_old, hls_minutes_old):
+        if minutes < 0:
+            delays.append(None)
+        else:
+            delays.append(timedelta(minutes=minutes))
+    return tuple(delays)
 
-class SyncSender(object):
+
+def get_time_limits(now):
     """
-    Envoi des demandes de synchronisation sur le bus, à destination des serveurs Nagios
+    Calcule les dates limites au-delà desquelles les états sont considérés
+    comme désynchronisés, d'après la configuration.
+
+    @param now: Date de référence pour le calcul.
+    @type  now: C{datetime.datetime}
+    @return: Date limite pour les hôtes et services de bas niveau, puis
+        pour les services de haut niveau (C{None} lorsque la
+        resynchronisation correspondante est désactivée).
+    @rtype: C{tuple}
     """
+    return tuple([ None if delay is None else now - delay
+                   for delay in get_time_delays() ])
 
-    #implements(IPushProducer)
 
+def get_bool_option(option, default=False):
+    """
+    @param option: Nom de l'option de la section C{connector-syncevents}.
+    @type  option: C{str}
+    @param default: Valeur par défaut si l'option n'est pas renseignée.
+    @type  default: C{bool}
+    @return: Valeur booléenne de l'option.
+    @rtype: C{bool}
+    """
+    try:
+        return settings['connector-syncevents'].as_bool(option)
+    except KeyError:
+        return default
 
-    def __init__(self, to_sync):
-        """
-        @param to_sync: Résultats de la requête à la base de données. Chaque
-            résultat doit disposer d'une propriété C{hostname} et d'une
-            propriété C{servicename}
-        @type  to_sync: C{list}
-        """
-        self.to_sync = to_sync
-        self.publisher = None # BusSender
 
+def get_state_file(shard=None):
+    """
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @return: Fichier d'état du connecteur, chargé.
+    @rtype: L{StateFile}
+    """
+    path = settings["connector-syncevents"].get("state_file",
+                "/var/lib/vigilo/connector-syncevents/state.json")
+    if shard is not None:
+        path = shard.path(path)
+    state_file = StateFile(path)
+    state_file.load()
+    return state_file
+
+
+def get_incremental_scan(state_file):
+    """
+    @param state_file: Fichier d'état du connecteur.
+    @type  state_file: L{StateFile}
+    @return: Suivi de la recherche incrémentale, ou C{None}
+        si elle est désactivée.
+    @rtype: L{IncrementalScan}
+    """
+    if not get_bool_option("incremental"):
+        return None
+    try:
+        expiry = int(settings['connector-syncevents']["resync_expiry"])
+    except KeyError:
+        expiry = 60
+    try:
+        full_interval = int(
+            settings['connector-syncevents']["full_scan_interval"])
+    except KeyError:
+        full_interval = 1440
+    return IncrementalScan(state_file.section("incremental"),
+                           timedelta(minutes=expiry),
+                           timedelta(minutes=full_interval)
+                           if full_interval > 0 else None)
+
+
+def get_suppression_cache(state_file, default_ttl=0):
+    """
+    @param state_file: Fichier d'état du connecteur.
+    @type  state_file: L{StateFile}
+    @param default_ttl: Durée de vie des entrées (en minutes) si l'option
+        C{suppression_ttl} n'est pas renseignée.
+    @type  default_ttl: C{int}
+    @return: Cache des demandes envoyées récemment, ou C{None}
+        s'il est désactivé.
+    @rtype: L{SuppressionCache}
+    """
+    try:
+        ttl = int(settings['connector-syncevents']["suppression_ttl"])
+    except KeyError:
+        ttl = default_ttl
+    if ttl <= 0:
+        return None
+    try:
+        max_size = int(settings['connector-syncevents']["suppression_size"])
+    except KeyError:
+        max_size = 100000
+    return SuppressionCache(state_file.section("suppression"), ttl * 60,
+                            max_size)
+
+
+def get_adaptive_budget(state_file):
+    """
+    @param state_file: Fichier d'état du connecteur.
+    @type  state_file: L{StateFile}
+    @return: Nombre maximum de demandes par exécution ajusté
+        automatiquement, ou C{None} si l'option C{adaptive_budget}
+        est désactivée.
+    @rtype: L{AdaptiveBudget}
+    """
+    if not get_bool_option("adaptive_budget"):
+        return None
+    options = settings['connector-syncevents']
+    try:
+        timeout = float(settings['connector']["timeout"])
+    except KeyError:
+        timeout = 30
+    return AdaptiveBudget(
+        state_file.section("adaptive"),
+        int(options.get("adaptive_min_events", 50)),
+        int(options.get("adaptive_max_events", 1000)),
+        initial=get_max_events() or None,
+        latency_target=float(options.get("adaptive_latency", 1.0)),
+        min_refreshed=float(options.get("adaptive_min_refreshed", 80)) / 100,
+        timeout=timeout)
+
+
+def get_request_tracker(state_file):
+    """
+    @param state_file: Fichier d'état du connecteur.
+    @type  state_file: L{StateFile}
+    @return: Suivi de l'efficacité des demandes envoyées, ou C{None}
+        si l'option C{track_requests} est désactivée.
+    @rtype: L{RequestTracker}
+    """
+    if not get_bool_option("track_requests"):
+        return None
+    options = settings['connector-syncevents']
+    try:
+        delay = int(options["backoff_delay"])
+    except KeyError:
+        delay = 10
+    try:
+        max_delay = int(options["backoff_max_delay"])
+    except KeyError:
+        max_delay = 1440
+    try:
+        threshold = int(options["unresponsive_threshold"])
+    except KeyError:
+        threshold = 3
+    return RequestTracker(state_file.section("tracker"),
+                          timedelta(minutes=delay),
+                          timedelta(minutes=max_delay), threshold)
+
+
+def get_spool(shard=None):
+    """
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @return: Fichier de reprise des éléments à synchroniser, ou C{None}
+        si l'option C{spool} est désactivée. Un avertissement est alors
+        journalisé si l'envoi peut être arrêté avant son terme (voir
+        L{get_deadline}).
+    @rtype: L{Spool}
+    """
+    if not get_bool_option("spool"):
+        if get_deadline_margin() >= 0:
+            LOGGER.warning(_("The spool is disabled: synchronization "
+                             "requests left when the deadline is reached "
+                             "will not be sent first by the next run"))
+        return None
+    path = settings["connector-syncevents"].get("spool_file",
+                "/var/lib/vigilo/connector-syncevents/spool.bin")
+    if shard is not None:
+        path = shard.path(path)
+    try:
+        max_age = int(settings['connector-syncevents']["spool_max_age"])
+    except KeyError:
+        max_age = 30
+    return Spool(path, timedelta(minutes=max_age))
+
+
+def load_events(find, spool=None, scan=None, now=None):
+    """
+    Recherche les éléments à synchroniser ou, si un envoi précédent
+    n'a pas abouti, reprend celui-ci sans relancer la recherche.
+
+    @param find: Fonction (sans argument) effectuant la recherche
+        (voir L{find_desync}).
+    @type  find: C{callable}
+    @param spool: Fichier de reprise, ou C{None}.
+    @type  spool: L{Spool}
+    @param scan: Suivi de la recherche incrémentale, ou C{None}.
+    @type  scan: L{IncrementalScan}
+    @param now: Date de l'exécution en cours.
+    @type  now: C{datetime.datetime}
+    @return: Générateur d'hôtes/services à synchroniser.
+    @rtype: C{generator}
+    """
+    if spool is None:
+        return find()
+    pending = spool.pending()
+    if pending:
+        LOGGER.info(_("Resuming %d synchronization request(s) from "
+                      "the spool"), pending)
+        if scan is not None:
+            scan.resume(now)
+        return spool.replay()
+    spool.write(find())
+    return spool.replay()
+
+
+def save_state(state_file, scan=None, suppression=None, budget=None,
+               tracker=None, now=None):
+    """
+    Enregistre l'état du connecteur à l'issue d'une resynchronisation.
+
+    @param state_file: Fichier d'état du connecteur.
+    @type  state_file: L{StateFile}
+    @param scan: Suivi de la recherche incrémentale, ou C{None}.
+    @type  scan: L{IncrementalScan}
+    @param suppression: Cache des demandes envoyées récemment, ou C{None}.
+    @type  suppression: L{SuppressionCache}
+    @param budget: Nombre maximum de demandes ajusté automatiquement,
+        ou C{None}.
+    @type  budget: L{AdaptiveBudget}
+    @param tracker: Suivi de l'efficacité des demandes, ou C{None}.
+    @type  tracker: L{RequestTracker}
+    @param now: Date de la recherche (par défaut, la date courante).
+    @type  now: C{datetime.datetime}
+    """
+    if scan is None and suppression is None and budget is None and \
+            tracker is None:
+        return
+    if scan is not None:
+        scan.finish()
+    if suppression is not None:
+        suppression.flush()
+    if budget is not None:
+        budget.flush()
+    if tracker is not None:
+        tracker.report()
+        tracker.flush(now or datetime.now())
+    state_file.save()
+
+
+def find_desync(now, scan=None, suppression=None, shard=None, metrics=None,
+                refs=None, budget=None, tracker=None, ages=True):
+    """
+    Recherche les hôtes/services à synchroniser, d'après la configuration.
+
+    @param now: Date de la recherche.
+    @type  now: C{datetime.datetime}
+    @param scan: Suivi de la recherche incrémentale, ou C{None}
+        pour une recherche complète.
+    @type  scan: L{IncrementalScan}
+    @param suppression: Cache des demandes envoyées récemment, ou C{None}.
+    @type  suppression: L{SuppressionCache}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @param metrics: Mesures de l'exécution en cours, ou C{None}.
+    @type  metrics: L{RunMetrics}
+    @param refs: Cache des données de référence conservé d'une recherche
+        à l'autre, ou C{None} pour le préparer d'après la configuration.
+    @type  refs: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    @param budget: Nombre maximum de demandes ajusté automatiquement,
+        ou C{None} pour utiliser l'option C{max_events}.
+    @type  budget: L{AdaptiveBudget}
+    @param tracker: Suivi de l'efficacité des demandes, ou C{None}.
+        Les éléments dont les dernières demandes sont restées sans effet
+        ne sont pas retenus tant que le délai avant une nouvelle demande
+        n'est pas écoulé.
+    @type  tracker: L{RequestTracker}
+    @param ages: Indique si les éléments dont l'état est trop ancien sont
+        recherchés. Dans le cas contraire (lorsque l'option C{--watch} s'en
+        charge), seules les désynchronisations entre états et événements
+        sont recherchées.
+    @type  ages: C{bool}
+    @return: Générateur d'hôtes/services à synchroniser.
+    @rtype: C{generator}
+    """
+    if ages:
+        time_limit, hls_time_limit = get_time_limits(now)
+    else:
+        time_limit = hls_time_limit = None
+    if budget is not None:
+        max_events = budget.budget
+    else:
+        max_events = get_max_events()
+    scheduler = get_scheduler()
+
+    time_since = hls_time_since = since = None
+    if scan is not None:
+        since = scan.start(now)
+        if since is not None:
+            LOGGER.info(_("Only considering changes since %s"),
+                        since.strftime("%Y-%m-%d %H:%M:%S"))
+            time_since, hls_time_since = get_time_limits(since)
+
+    # La limite n'est appliquée par la base de données que si aucun
+    # élément n'est écarté par la suite. Sinon, elle est appliquée
+    # après avoir écarté les éléments pour lesquels une demande est
+    # déjà en cours et après répartition entre les collecteurs.
+    if scan is None and suppression is None and scheduler is None and \
+            tracker is None:
+        sql_limit = max_events
+    else:
+        sql_limit = 0
+    if metrics is None:
+        metrics = RunMetrics()
+    # Import local : configure l'accès à la base de données.
+    with metrics.stage("database"):
+        from vigilo.connector_syncevents.desync import iter_desync, \
+                                                       has_desync
+        from vigilo.connector_syncevents.desync import get_desync_parallel
+        if refs is None:
+            refs = get_reference_cache()
+        if refs is not None:
+            refs.refresh()
+    priority = get_bool_option("priority")
+    parallel = get_parallel_queries()
+    hls = []
+    if hls_time_limit is not None and get_bool_option("hls_dependencies") \
+            and (shard is None or shard.with_hls):
+        # Les services de haut niveau sont recherchés d'après leurs
+        # dépendances, en dehors de la requête principale, et envoyés
+        # après les hôtes et services de bas niveau.
+        from vigilo.connector_syncevents.desync import \
+            get_hls_by_dependencies
+        with metrics.stage("fetch_hls"):
+            hls = get_hls_by_dependencies(
+                hls_time_limit, hls_time_since, refs,
+                scan.postpone if scan is not None else None)
+        metrics.add_count("hls", len(hls))
+        hls_time_limit = hls_time_since = None
+    if get_bool_option("probe", True) and \
+            not has_desync(time_limit, hls_time_limit, time_since,
+                           hls_time_since, since, shard, metrics):
+        # Cas le plus fréquent : rien à synchroniser. On évite alors
+        # l'exécution de la requête complète.
+        events = iter([])
+    elif parallel > 1 and not priority:
+        # Le classement par priorité nécessite la requête complète.
+        with metrics.stage("fetch"):
+            events = get_desync_parallel(time_limit, hls_time_limit,
+                                         sql_limit, time_since,
+                                         hls_time_since, since, shard,
+                                         parallel, metrics, refs)
+        metrics.add_count("rows", len(events))
+        events = iter(events)
+    else:
+        events = iter_desync(time_limit, hls_time_limit, sql_limit,
+                             get_fetch_size(), time_since, hls_time_since,
+                             since, priority=priority, shard=shard,
+                             refs=refs)
+        events = metrics.timed_iter("fetch", events, "rows")
+    if hls:
+        events = itertools.chain(events, hls)
+
+    if scan is not None:
+        events = scan.exclude(events)
+    if suppression is not None:
+        events = suppression.exclude(events)
+    if tracker is not None:
+        events = tracker.exclude(events, now,
+                                 scan.postpone if scan is not None else None)
+    if scheduler is not None:
+        events = scheduler.schedule(events, max_events)
+    if scan is not None:
+        # Les éléments écartés par la répartition n'ont pas fait l'objet
+        # d'une demande : ils devront être réexaminés lors de la prochaine
+        # recherche.
+        truncated = None
+        if scheduler is not None:
+            truncated = lambda: scheduler.dropped > 0
+        events = scan.record(events, truncated)
+    # Les services de haut niveau recherchés d'après leurs dépendances
+    # ne sont pas comptés dans la limite appliquée par la base de données.
+    if max_events and (not sql_limit or hls) and scheduler is None:
+        events = itertools.islice(events, max_events)
+    return events
+
+
+def check_requests(now, budget=None, tracker=None, metrics=None):
+    """
+    Vérifie l'effet des demandes envoyées lors des exécutions précédentes.
+    Cette vérification a lieu même si l'exécution reprend un envoi
+    interrompu, sans nouvelle recherche (voir L{load_events}).
+
+    @param now: Date de l'exécution en cours.
+    @type  now: C{datetime.datetime}
+    @param budget: Nombre maximum de demandes ajusté automatiquement,
+        ou C{None}.
+    @type  budget: L{AdaptiveBudget}
+    @param tracker: Suivi de l'efficacité des demandes, ou C{None}.
+    @type  tracker: L{RequestTracker}
+    @param metrics: Mesures de l'exécution en cours, ou C{None}.
+    @type  metrics: L{RunMetrics}
+    """
+    if budget is None and tracker is None:
+        return
+    if metrics is None:
+        metrics = RunMetrics()
+    # Import local : configure l'accès à la base de données.
+    with metrics.stage("database"):
+        from vigilo.connector_syncevents.desync import count_refreshed, \
+                                                       get_state_timestamps
+        if budget is not None:
+            budget.check(now, count_refreshed)
+        if tracker is not None:
+            tracker.check(now, get_state_timestamps)
+
+
+def track_requests(syncsender, now, scan=None, budget=None, tracker=None,
+                   spool=None):
+    """
+    Branche le suivi des demandes sur l'objet chargé de leur envoi : les
+    éléments ne sont mémorisés qu'une fois leur demande publiée, de sorte
+    qu'un envoi interrompu ne soit pas compté comme une demande restée
+    sans effet. Les éléments restants sont repris par l'exécution suivante,
+    depuis le fichier de reprise ou par une nouvelle recherche.
+
+    @param syncsender: Objet chargé d'envoyer les demandes.
+    @type  syncsender: L{SyncSender}
+    @param now: Date de l'exécution en cours.
+    @type  now: C{datetime.datetime}
+    @param scan: Suivi de la recherche incrémentale, ou C{None}.
+    @type  scan: L{IncrementalScan}
+    @param budget: Nombre maximum de demandes ajusté automatiquement,
+        ou C{None}.
+    @type  budget: L{AdaptiveBudget}
+    @param tracker: Suivi de l'efficacité des demandes, ou C{None}.
+    @type  tracker: L{RequestTracker}
+    @param spool: Fichier de reprise, ou C{None}.
+    @type  spool: L{Spool}
+    """
+    def sent(supitems):
+        if scan is not None:
+            scan.mark(supitems)
+        if budget is not None:
+            budget.track(supitems)
+        if tracker is not None:
+            tracker.track(supitems, now)
+    syncsender.on_sent = sent
+    if spool is not None:
+        # Les éléments non acquittés restent dans le fichier de reprise.
+        syncsender.on_done = spool.acknowledge
+    elif scan is not None:
+        syncsender.on_unsent = scan.release
+
+
+def report_metrics(metrics, shard=None):
+    """
+    Journalise les mesures d'une exécution et les enregistre dans le fichier
+    désigné par l'option C{metrics_file}, si elle est renseignée.
+
+    @param metrics: Mesures de l'exécution.
+    @type  metrics: L{RunMetrics}
+    @param shard: Part des collecteurs traitée, ou C{None}.
+    @type  shard: L{Shard}
+    @return: Messages de performance à publier sur le bus (aucun si
+        l'option C{perf_metrics} est désactivée).
+    @rtype: C{list} of C{dict}
+    """
+    metrics.log()
+    path = settings["connector-syncevents"].get("metrics_file")
+    if path:
+        if shard is not None:
+            # Chaque part enregistre ses propres mesures.
+            path = shard.path(path)
+        try:
+            metrics.dump(path)
+        except (IOError, OSError) as e:
+            LOGGER.warning(_("Could not save the run metrics: %s"),
+                           get_error_message(e))
+    if not get_bool_option("perf_metrics"):
+        return []
+    connector = settings.get("connector", {})
+    return metrics.perf_messages(
+        connector.get("hostname", socket.getfqdn()),
+        connector.get("status_service", "vigilo-connector-syncevents"),
+        connector.get("self_monitoring_perf_exchange"))
+
+
+def get_shard(spec=None):
+    """
+    @param spec: Part des collecteurs traitée, sous la forme C{i/N},
+        ou C{None}.
+    @type  spec: C{str}
+    @return: Part des collecteurs traitée par cette instance, ou C{None}
+        si elle les traite tous.
+    @rtype: L{Shard}
+    @raise ValueError: La part indiquée est invalide.
+    """
+    try:
+        servers = settings['connector-syncevents'].as_list("servers")
+    except KeyError:
+        servers = None
+    if spec is None and not servers:
+        return None
+    name = settings['connector-syncevents'].get("shard_name")
+    shard = Shard.parse(spec, servers, name, get_bool_option("servers_hls"))
+    if servers and not shard.hls:
+        LOGGER.warning(_("High-level services are not synchronized by this "
+                         "instance: the servers_hls option must be enabled "
+                         "on one of the instances"))
+    return shard
+
+
+def get_scheduler():
+    """
+    @return: Objet chargé de répartir les demandes entre les collecteurs,
+        ou C{None} si la répartition est désactivée.
+    @rtype: L{FairScheduler}
+    """
+    if not get_bool_option("fair_scheduling"):
+        return None
+    try:
+        max_per_collector = int(
+            settings['connector-syncevents']["max_events_per_collector"])
+    except KeyError:
+        max_per_collector = 0
+    return FairScheduler(max_per_collector)
+
+
+def get_rate_limiter():
+    """
+    @return: Objet chargé de limiter le débit des messages envoyés
+        à chaque collecteur, ou C{None} si le débit n'est pas limité.
+    @rtype: L{CollectorRateLimiter}
+    """
+    try:
+        rate = float(settings['connector-syncevents']["collector_rate"])
+    except KeyError:
+        rate = 0
+    if rate <= 0:
+        return None
+    try:
+        burst = int(settings['connector-syncevents']["collector_burst"])
+    except KeyError:
+        burst = 1
+    return CollectorRateLimiter(rate, burst)
+
+
+def get_parallel_queries():
+    """
+    @return: Nombre de branches de la requête de resynchronisation
+        exécutées simultanément (0 ou 1 pour exécuter la requête complète).
+    @rtype: C{int}
+    """
+    try:
+        return int(settings['connector-syncevents']["parallel_queries"])
+    except KeyError:
+        return 0
+
+
+def get_reference_cache():
+    """
+    Prépare le cache des données de référence (valeurs des états
+    et ventilation), si l'option C{reference_cache} est activée.
+    L'appel de cette fonction configure l'accès à la base de données.
+
+    @return: Cache des données de référence, ou C{None}.
+    @rtype: L{vigilo.connector_syncevents.refcache.ReferenceCache}
+    """
+    if not get_bool_option("reference_cache"):
+        return None
+    try:
+        ttl = int(settings['connector-syncevents']["reference_cache_ttl"])
+    except KeyError:
+        ttl = 10
+    from vigilo.connector_syncevents.refcache import ReferenceCache
+    return ReferenceCache(max(0, ttl) * 60)
 
-    @defer.inlineCallbacks
-    def askNagios(self, client):
-        """Envoie les demandes de notifications à Nagios"""
-        for supitem in self.to_sync:
-            message = self._buildNagiosMessage(supitem)
-            yield self.publisher.write(message)
-
-
-    def _buildNagiosMessage(self, supitem):
-        """
-        Construit le message de commande Nagios approprié.
-
-        @param supitem: Hôte ou service concerné. Doit disposer d'une propriété
-            C{hostname} et d'une propriété C{servicename}
-        @type  supitem: C{object}
-        @return: Le message pour Nagios
-        @rtype: C{dict}
-        @todo: ajouter une clé routing_key pour n'envoyer qu'au serveur Nagios
-            concerné
-        """
-        msg = { "type": "nagios",
-                "timestamp": int(time.time()),
-                }
-
-        if supitem.vigiloserver:
-            msg['routing_key'] = supitem.vigiloserver
-
-        if not supitem.hostname:
-            msg["cmdname"] = "SEND_CUSTOM_SVC_NOTIFICATION"
-            msg["value"] = ("High-Level-Services;%s;0;vigilo;syncevents"
-                         % (supitem.servicename, ))
-            LOGGER.debug(
-                _("Asking for update on high-level service \"%(service)s\""),
-                {"service": supitem.servicename})
-        elif supitem.servicename:
-            msg["cmdname"] = "SEND_CUSTOM_SVC_NOTIFICATION"
-            msg["value"] = ("%s;%s;0;vigilo;syncevents"
-                         % (supitem.hostname, supitem.servicename))
-            LOGGER.debug(_("Asking for update on service \"%(service)s\" "
-                           "on host \"%(host)s\""),
-                         {"host": supitem.hostname,
-                          "service": supitem.servicename})
-        else:
-            msg["cmdname"] = "SEND_CUSTOM_HOST_NOTIFICATION"
-            msg["value"] = "%s;0;vigilo;syncevents" % supitem.hostname
-            LOGGER.debug(_("Asking for update on host \"%(host)s\""),
-                         {"host": supitem.hostname})
-        return msg
 
+def get_fetch_size():
+    """
+    @return: Nombre d'éléments à synchroniser lus à la fois
+        depuis la base de données.
+    @rtype: C{int}
+    """
+    try:
+        return int(settings['connector-syncevents']["fetch_size"])
+    except KeyError:
+        return 1000
+
+
+def get_max_inflight():
+    """
+    @return: Nombre maximum de messages en cours d'envoi simultanément
+        sur le bus.
+    @rtype: C{int}
+    """
+    try:
+        return int(settings['connector-syncevents']["max_inflight"])
+    except KeyError:
+        return 10
+
+
+def get_batch_size():
+    """
+    @return: Nombre maximum de commandes regroupées dans un même message
+        (0 pour désactiver le regroupement).
+    @rtype: C{int}
+    """
+    try:
+        return int(settings['connector-syncevents']["batch_size"])
+    except KeyError:
+        return 0
+
+
+def get_deadline_margin():
+    """
+    @return: Marge (en secondes) entre l'arrêt de l'envoi des demandes et
+        l'expiration du délai autorisé, négative si cet arrêt anticipé
+        est désactivé.
+    @rtype: C{float}
+    """
+    try:
+        return float(settings['connector-syncevents']["deadline_margin"])
+    except KeyError:
+        return 5
+
+
+def get_deadline(start, timeout=None):
+    """
+    Calcule la date limite de l'envoi des demandes de mise à jour :
+    l'envoi s'arrête C{deadline_margin} secondes avant l'expiration
+    du délai autorisé.
+
+    @param start: Date (en secondes depuis l'epoch) à partir de laquelle
+        le délai est décompté.
+    @type  start: C{float}
+    @param timeout: Délai autorisé (en secondes), par défaut l'option
+        C{timeout} de la section C{connector}.
+    @type  timeout: C{float}
+    @return: Date limite (en secondes depuis l'epoch), ou C{None} si
+        l'option C{deadline_margin} est négative.
+    @rtype: C{float}
+    """
+    margin = get_deadline_margin()
+    if margin < 0:
+        return None
+    if timeout is None:
+        try:
+            timeout = float(settings['connector']["timeout"])
+        except KeyError:
+            timeout = 30
+    # Une partie du délai reste disponible pour l'envoi, même si la marge
+    # est mal réglée.
+    return start + max(timeout - margin, timeout / 2.0)
+
+
+def create_sender(events, suppression=None, deadline=None):
+    """
+    @param events: Hôtes/services à synchroniser.
+    @type  events: C{iterable}
+    @param suppression: Cache des demandes envoyées récemment, ou C{None}.
+    @type  suppression: L{SuppressionCache}
+    @param deadline: Date limite de l'envoi (voir L{get_deadline}),
+        ou C{None}.
+    @type  deadline: C{float}
+    @return: Objet chargé d'envoyer les demandes de mise à jour,
+        configuré d'après les réglages du connecteur.
+    @rtype: L{SyncSender}
+    """
+    from vigilo.connector_syncevents.sender import SyncSender
+    return SyncSender(events, get_max_inflight(), get_batch_size(),
+                      get_rate_limiter(), suppression, deadline)
+
+
+def replay(events, publisher):
+    """
+    Construit les messages de demande de mise à jour et les envoie
+    sur un bus local (voir L{vigilo.connector_syncevents.publishers}),
+    sans modifier l'état du connecteur.
+
+    @param events: Hôtes/services à synchroniser.
+    @type  events: C{iterable}
+    @param publisher: Bus local (voir
+        L{vigilo.connector_syncevents.publishers.get_publisher}).
+    @type  publisher: C{object}
+    @return: Indique si tous les messages ont été publiés.
+    @rtype: C{bool}
+    """
+    from vigilo.connector_syncevents.publishers import run_offline
+    syncsender = create_sender(events)
+    syncsender.publisher = publisher
+    try:
+        failure = run_offline(syncsender)
+    finally:
+        publisher.close()
+    if failure is not None:
+        LOGGER.error(_("Could not publish the synchronization requests: "
+                       "%s"), get_error_message(failure.value))
+        return False
+    return True
+
+
+def get_max_events():
+    """
+    @return: Nombre maximum de demandes de mise à jour par exécution
+        (0 pour ne pas imposer de limite).
+    @rtype: C{int}
+    """
+    try:
+        return int(settings['connector-syncevents']["max_events"])
+    except KeyError:
+        return 0
 
 
 def main():
@@ -404,57 +788,146 @@ def main():
     opt_parser.add_option("-d", "--debug", action="store_true")
     opt_parser.add_option("-n", "--dry-run", action="store_true",
                           help="Do not send synchronization messages")
+    opt_parser.add_option("--publisher", metavar="SPEC",
+                          help="With --dry-run, build the synchronization "
+                               "messages and send them to a local publisher "
+                               "instead: loopback[:latency=S,jitter=S,"
+                               "max_pending=N,failure_rate=R,seed=N] or "
+                               "file:PATH (one JSON message per line)")
+    opt_parser.add_option("-D", "--daemon", action="store_true",
+                          help="Keep running and synchronize periodically")
+    opt_parser.add_option("-i", "--interval", type="int",
+                          help="Delay (in seconds) between two "
+                               "synchronizations in daemon mode")
+    opt_parser.add_option("-s", "--shard", metavar="I/N",
+                          help="Only synchronize the I-th part (out of N) "
+                               "of the Nagios collectors")
+    opt_parser.add_option("-w", "--watch", action="store_true",
+                          help="In daemon mode, also send synchronization "
+                               "requests as soon as states become too old, "
+                               "based on state change notifications")
+    opt_parser.add_option("--check-indexes", action="store_true",
+                          help="Report the database indexes recommended "
+                               "for the synchronization queries")
+    opt_parser.add_option("--index-ddl", action="store_true",
+                          help="With --check-indexes, also print the SQL "
+                               "statements creating the missing indexes")
+    opt_parser.add_option("--unresponsive", action="store_true",
+                          help="List the items which did not respond to "
+                               "the last synchronization requests "
+                               "(requires the track_requests option)")
     opts, args = opt_parser.parse_args()
     if args:
         opt_parser.error("No arguments allowed")
+    if opts.daemon and opts.dry_run:
+        opt_parser.error("--daemon and --dry-run are mutually exclusive")
+    if opts.watch and not opts.daemon:
+        opt_parser.error("--watch requires --daemon")
+    if opts.publisher and not opts.dry_run:
+        opt_parser.error("--publisher requires --dry-run")
+    if opts.interval is None:
+        opts.interval = int(settings["connector-syncevents"].get(
+                                "daemon_interval", 60))
+    if opts.interval <= 0:
+        opt_parser.error("The interval must be a positive integer")
+    try:
+        shard = get_shard(opts.shard)
+    except ValueError:
+        opt_parser.error("Invalid shard: %s" % opts.shard)
     if opts.debug:
         LOGGER.parent.setLevel(logging.DEBUG)
         log_traffic = True
     else:
         log_traffic = False
 
+    if opts.check_indexes:
+        # Simple vérification du schéma : pas besoin du verrou.
+        from vigilo.connector_syncevents.indexes import check_indexes
+        if check_indexes(ddl=opts.index_ddl):
+            sys.exit(1)
+        return
+
+    if opts.unresponsive:
+        # Simple consultation du fichier d'état : pas besoin du verrou.
+        tracker = get_request_tracker(get_state_file(shard))
+        if tracker is None:
+            opt_parser.error("--unresponsive requires the track_requests "
+                             "option")
+        print_unresponsive(tracker)
+        return
+
+    metrics = RunMetrics()
+    metrics.add_time("startup", time.time() - _STARTED)
+
     # Lock
     lockfile = settings["connector-syncevents"].get("lockfile",
                         "/var/lock/subsys/vigilo-connector-syncevents/lock")
-    lock_result = grab_lock(lockfile)
+    if shard is not None:
+        # Chaque part dispose de son propre verrou.
+        lockfile = shard.path(lockfile)
+    with metrics.stage("lock"):
+        lock_result = grab_lock(lockfile)
     if not lock_result:
         sys.exit(1)
 
+    # Le fichier de sortie n'est ouvert (et vidé) qu'une fois le verrou
+    # obtenu, pour ne pas écraser celui d'une autre instance en cours.
+    publisher = None
+    if opts.publisher:
+        from vigilo.connector_syncevents.publishers import get_publisher
+        try:
+            publisher = get_publisher(opts.publisher)
+        except (ValueError, IOError) as e:
+            opt_parser.error(str(e))
+
+    if opts.daemon:
+        # Import local pour éviter une dépendance circulaire.
+        from vigilo.connector_syncevents.daemon import run_daemon
+        return run_daemon(opts.interval, log_traffic=log_traffic,
+                          shard=shard, watch=opts.watch)
+
+    state_file = get_state_file(shard)
+    scan = get_incremental_scan(state_file)
+    suppression = get_suppression_cache(state_file)
+    budget = get_adaptive_budget(state_file)
+    tracker = get_request_tracker(state_file)
+    spool = None if opts.dry_run else get_spool(shard)
+
     # Récupération des événements corrélés dont la durée
     # de consolidation sont supérieures à celles configurées.
-    try:
-        minutes_old = int(settings['connector-syncevents']["minutes_old"])
-    except KeyError:
-        minutes_old = 45
-
-    try:
-        hls_minutes_old = int(settings['connector-syncevents']["hls_minutes_old"])
-    except KeyError:
-        hls_minutes_old = -1
-
     now = datetime.now()
-    if minutes_old < 0:
-        time_limit = None
-    else:
-        time_limit = now - timedelta(minutes=int(minutes_old))
-
-    if hls_minutes_old < 0:
-        hls_time_limit = None
-    else:
-        hls_time_limit = now - timedelta(minutes=int(hls_minutes_old))
-
+    check_requests(now, budget, tracker, metrics)
+    events = load_events(lambda: find_desync(now, scan, suppression, shard,
+                                             metrics, budget=budget,
+                                             tracker=tracker),
+                         spool, scan, now)
     try:
-        max_events = int(settings['connector-syncevents']["max_events"])
-    except KeyError:
-        max_events = 0
-    events = get_desync(time_limit, hls_time_limit, max_events)
-    if not events:
+        first = next(events)
+    except StopIteration:
         LOGGER.info(_("No events to synchronize"))
+        if publisher is not None:
+            publisher.close()
+        if spool is not None:
+            spool.finish()
+        if not opts.dry_run:
+            if budget is not None:
+                budget.finish()
+            save_state(state_file, scan, suppression, budget, tracker, now)
+            # Le bus n'est pas chargé dans ce cas : les mesures
+            # ne sont qu'enregistrées localement.
+            report_metrics(metrics, shard)
         return # rien à faire
-    LOGGER.info(_("Found %d event(s) to synchronize"), len(events))
+    events = itertools.chain([first], events)
+
+    if publisher is not None:
+        if not replay(events, publisher):
+            sys.exit(1)
+        return
 
     if opts.dry_run:
+        count = 0
         for supitem in events:
+            count += 1
             if not supitem.hostname:
                 LOGGER.debug(
                     _("Asking for update on high-level service \"%(service)s\""),
@@ -467,13 +940,37 @@ def main():
             else:
                 LOGGER.debug(_("Asking for update on host \"%(host)s\""),
                              {"host": supitem.hostname})
+        LOGGER.info(_("Found %d event(s) to synchronize"), count)
         return
 
+    # La pile logicielle du bus n'est chargée que s'il y a
+    # effectivement des demandes à envoyer.
+    from twisted.internet import defer
+    from vigilo.connector.client import oneshotclient_factory
+    from vigilo.connector.handlers import buspublisher_factory
+
     osc = oneshotclient_factory(settings)
     osc.client.factory.noisy = False
 
-    syncsender = SyncSender(events)
-    osc.setHandler(syncsender.askNagios)
+    # Le délai imposé par osc.run() est décompté à partir d'ici.
+    syncsender = create_sender(events, suppression,
+                               get_deadline(time.time()))
+    track_requests(syncsender, now, scan, budget, tracker, spool)
+
+    @defer.inlineCallbacks
+    def handler(client):
+        try:
+            yield syncsender.askNagios(client)
+        finally:
+            if spool is not None:
+                spool.finish()
+        if budget is not None:
+            budget.finish(syncsender)
+        save_state(state_file, scan, suppression, budget, tracker, now)
+        metrics.record_sender(syncsender)
+        for message in report_metrics(metrics, shard):
+            yield bus_publisher.write(message)
+    osc.setHandler(handler)
 
     bus_publisher = buspublisher_factory(settings, osc.client)
     syncsender.publisher = bus_publisher
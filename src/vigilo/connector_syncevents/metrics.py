@@ -0,0 +1,194 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Mesures relatives à une exécution du connecteur : durée de chaque étape
+(démarrage, verrou, requêtes, construction et envoi des messages)
+et nombre d'éléments traités.
+
+Ces mesures peuvent être publiées sur le bus sous forme de données de
+performance (auto-supervision) et enregistrées dans un fichier JSON.
+"""
+
+import os
+import json
+import time
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+
+
+class RunMetrics(object):
+    """
+    Durées (en secondes) et compteurs d'une exécution du connecteur.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        @param clock: Fonction renvoyant l'heure courante (en secondes).
+        @type  clock: C{callable}
+        """
+        self.clock = clock
+        self.timestamp = int(clock())
+        self.timings = OrderedDict()
+        self.counts = OrderedDict()
+
+
+    def add_time(self, stage, duration):
+        """
+        @param stage: Nom de l'étape.
+        @type  stage: C{str}
+        @param duration: Durée à ajouter à celle de l'étape (en secondes).
+        @type  duration: C{float}
+        """
+        self.timings[stage] = self.timings.get(stage, 0.0) + duration
+
+
+    def add_count(self, name, value=1):
+        """
+        @param name: Nom du compteur.
+        @type  name: C{str}
+        @param value: Valeur à ajouter au compteur.
+        @type  value: C{int}
+        """
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        Mesure la durée d'une étape :
+
+            with metrics.stage("lock"):
+                grab_lock(lockfile)
+
+        @param stage: Nom de l'étape.
+        @type  stage: C{str}
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add_time(stage, self.clock() - start)
+
+
+    def timed_iter(self, stage, iterable, counter=None):
+        """
+        Mesure le temps passé à obtenir chacun des éléments d'un itérable
+        (par exemple, la lecture des résultats d'une requête), sans compter
+        le temps passé à les traiter.
+
+        @param stage: Nom de l'étape.
+        @type  stage: C{str}
+        @param iterable: Éléments à parcourir.
+        @type  iterable: C{iterable}
+        @param counter: Nom du compteur d'éléments, ou C{None}.
+        @type  counter: C{str}
+        @return: Les mêmes éléments.
+        @rtype: C{generator}
+        """
+        iterator = iter(iterable)
+        while True:
+            start = self.clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, self.clock() - start)
+                return
+            self.add_time(stage, self.clock() - start)
+            if counter is not None:
+                self.add_count(counter)
+            yield item
+
+
+    def record_sender(self, sender):
+        """
+        Reprend les statistiques d'envoi des messages sur le bus.
+
+        @param sender: Objet ayant envoyé les demandes de mise à jour.
+        @type  sender: L{vigilo.connector_syncevents.sender.SyncSender}
+        """
+        self.add_time("build", sender.build_time)
+        self.add_time("publish", sender.duration)
+        self.add_time("bus_wait", sender.wait_time)
+        self.add_count("requests", sender.count)
+        self.add_count("messages", sender.messages)
+        self.add_count("suppressed", sender.suppressed)
+        self.add_count("expired", int(sender.expired))
+        self.add_count("unsent", sender.unsent)
+
+
+    def as_dict(self):
+        """
+        @return: Mesures, sous une forme sérialisable en JSON.
+        @rtype: C{dict}
+        """
+        return {
+            "timestamp": self.timestamp,
+            "timings": dict(self.timings),
+            "counts": dict(self.counts),
+        }
+
+
+    def perf_messages(self, host, service, exchange=None):
+        """
+        @param host: Nom de l'hôte sur lequel tourne le connecteur.
+        @type  host: C{unicode}
+        @param service: Nom du service d'auto-supervision du connecteur.
+        @type  service: C{unicode}
+        @param exchange: Nom de l'exchange de publication, ou C{None}
+            pour utiliser celui associé au type de message C{perf}.
+        @type  exchange: C{str}
+        @return: Messages de performance à publier sur le bus.
+        @rtype: C{list} of C{dict}
+        """
+        values = [ ("%s-time-%s" % (service, stage), duration)
+                   for stage, duration in self.timings.items() ]
+        values.extend([ ("%s-count-%s" % (service, name), value)
+                        for name, value in self.counts.items() ])
+        messages = []
+        for datasource, value in values:
+            msg = { "type": "perf",
+                    "timestamp": self.timestamp,
+                    "host": host,
+                    "datasource": datasource,
+                    "value": value,
+                    }
+            if exchange:
+                msg["exchange"] = exchange
+            messages.append(msg)
+        return messages
+
+
+    def dump(self, path):
+        """
+        Enregistre les mesures au format JSON. Le fichier est remplacé
+        de manière atomique.
+
+        @param path: Emplacement du fichier.
+        @type  path: C{str}
+        """
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "wb") as output:
+                output.write(json.dumps(self.as_dict(), indent=2)
+                             .encode("utf-8"))
+            os.rename(tmpname, path)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+
+
+    def log(self):
+        """Journalise les mesures."""
+        LOGGER.debug(_("Run metrics: %s"), json.dumps(self.as_dict(),
+                                                      sort_keys=True))
@@ -0,0 +1,251 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Bus locaux, utilisables à la place du bus de Vigilo.
+
+Ils disposent de la même méthode C{write} que le publieur renvoyé par
+C{vigilo.connector.handlers.buspublisher_factory} et permettent d'envoyer
+les demandes de mise à jour sans serveur AMQP :
+
+    - L{LoopbackPublisher} simule la latence, la limitation du débit
+      et les erreurs d'un serveur AMQP ;
+    - L{FilePublisher} enregistre les messages dans un fichier,
+      à raison d'un message JSON par ligne (NDJSON).
+
+Voir L{get_publisher} pour la syntaxe permettant de les désigner
+(option C{--publisher} en ligne de commande).
+"""
+
+import sys
+import json
+import random
+from collections import deque
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+
+class PublishError(Exception):
+    """Erreur simulée lors de la publication d'un message."""
+    pass
+
+
+
+class LoopbackPublisher(object):
+    """
+    Bus en mémoire, simulant le comportement d'un serveur AMQP :
+
+        - chaque message n'est acquitté qu'au bout d'un certain délai
+          (latence), éventuellement variable ;
+        - au-delà d'un certain nombre de messages en attente
+          d'acquittement, les suivants sont mis en attente avant d'être
+          transmis (contrôle de flux du serveur) ;
+        - une partie des publications échoue.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, max_pending=0,
+                 failure_rate=0.0, seed=None, keep=False, clock=None):
+        """
+        @param latency: Délai (en secondes) avant l'acquittement
+            d'un message.
+        @type  latency: C{float}
+        @param jitter: Délai supplémentaire maximum (en secondes), tiré
+            au hasard pour chaque message.
+        @type  jitter: C{float}
+        @param max_pending: Nombre maximum de messages en attente
+            d'acquittement (0 pour ne pas imposer de limite).
+        @type  max_pending: C{int}
+        @param failure_rate: Proportion des publications qui échouent.
+        @type  failure_rate: C{float}
+        @param seed: Graine du générateur aléatoire, pour reproduire
+            un scénario.
+        @type  seed: C{int}
+        @param keep: Indique si les messages publiés sont conservés
+            (attribut C{messages}).
+        @type  keep: C{bool}
+        @param clock: Horloge utilisée pour simuler la latence
+            (par défaut, le réacteur Twisted).
+        @type  clock: C{twisted.internet.interfaces.IReactorTime}
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.max_pending = max_pending
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.messages = [] if keep else None
+        self.pending = 0
+        self._waiting = deque()
+        # Statistiques.
+        self.published = 0
+        self.failed = 0
+        self.throttled = 0
+        self.max_queued = 0
+
+
+    def write(self, message):
+        """
+        Publie un message.
+
+        @param message: Message à publier.
+        @type  message: C{dict}
+        @return: Deferred déclenché une fois le message acquitté.
+        @rtype: C{Deferred}
+        """
+        d = defer.Deferred()
+        if self.max_pending and self.pending >= self.max_pending:
+            self.throttled += 1
+            self._waiting.append((message, d))
+            self.max_queued = max(self.max_queued, len(self._waiting))
+        else:
+            self._send(message, d)
+        return d
+
+
+    def _send(self, message, d):
+        self.pending += 1
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+        failed = self.random.random() < self.failure_rate
+        if delay <= 0:
+            self._acknowledge(message, d, failed)
+            return
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        clock.callLater(delay, self._acknowledge, message, d, failed)
+
+
+    def _acknowledge(self, message, d, failed):
+        self.pending -= 1
+        if self._waiting:
+            self._send(*self._waiting.popleft())
+        if failed:
+            self.failed += 1
+            d.errback(PublishError("Simulated publishing failure"))
+            return
+        self.published += 1
+        if self.messages is not None:
+            self.messages.append(message)
+        d.callback(None)
+
+
+    def close(self):
+        """Aucune ressource à libérer."""
+        pass
+
+
+
+class FilePublisher(object):
+    """
+    Enregistre les messages dans un fichier, à raison d'un message
+    JSON par ligne (NDJSON).
+    """
+
+    def __init__(self, path):
+        """
+        @param path: Emplacement du fichier (remplacé s'il existe),
+            ou C{-} pour la sortie standard.
+        @type  path: C{str}
+        """
+        self.path = path
+        if path == "-":
+            self.output = getattr(sys.stdout, "buffer", sys.stdout)
+        else:
+            self.output = open(path, "wb")
+        self.published = 0
+
+
+    def write(self, message):
+        """
+        Enregistre un message.
+
+        @param message: Message à publier.
+        @type  message: C{dict}
+        @return: Deferred déjà déclenché.
+        @rtype: C{Deferred}
+        """
+        line = json.dumps(message, sort_keys=True)
+        self.output.write((line + "\n").encode("utf-8"))
+        self.published += 1
+        return defer.succeed(None)
+
+
+    def close(self):
+        """Ferme le fichier."""
+        if self.path == "-":
+            self.output.flush()
+        else:
+            self.output.close()
+
+
+
+LOOPBACK_OPTIONS = {
+    "latency": float,
+    "jitter": float,
+    "max_pending": int,
+    "failure_rate": float,
+    "seed": int,
+}
+
+
+def get_publisher(spec):
+    """
+    Prépare un bus local d'après sa description :
+
+        - C{loopback[:option=valeur,...]} pour un L{LoopbackPublisher},
+          les options étant celles de son constructeur (C{latency},
+          C{jitter}, C{max_pending}, C{failure_rate} et C{seed}) ;
+        - C{file:emplacement} pour un L{FilePublisher}.
+
+    @param spec: Description du bus.
+    @type  spec: C{str}
+    @return: Bus local.
+    @rtype: L{LoopbackPublisher} ou L{FilePublisher}
+    @raise ValueError: La description est invalide.
+    """
+    name, _sep, args = spec.partition(":")
+    if name == "file":
+        if not args:
+            raise ValueError("Missing file name: %s" % spec)
+        return FilePublisher(args)
+    if name != "loopback":
+        raise ValueError("Unknown publisher: %s" % spec)
+    options = {}
+    for item in args.split(","):
+        if not item.strip():
+            continue
+        key, sep, value = item.partition("=")
+        key = key.strip()
+        if not sep or key not in LOOPBACK_OPTIONS:
+            raise ValueError("Invalid loopback option: %s" % item)
+        options[key] = LOOPBACK_OPTIONS[key](value.strip())
+    return LoopbackPublisher(**options)
+
+
+def run_offline(sender):
+    """
+    Envoie les demandes de mise à jour sur un bus local, en faisant
+    tourner le réacteur Twisted le temps de l'envoi.
+
+    @param sender: Objet chargé de l'envoi, dont le bus a été renseigné.
+    @type  sender: L{vigilo.connector_syncevents.sender.SyncSender}
+    @return: Erreur survenue lors de l'envoi, ou C{None}.
+    @rtype: C{twisted.python.failure.Failure}
+    """
+    from twisted.internet import reactor
+    result = []
+
+    def run():
+        d = sender.askNagios(None)
+        d.addBoth(result.append)
+        d.addBoth(lambda _result: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
+    if result and isinstance(result[0], Failure):
+        return result[0]
+    return None
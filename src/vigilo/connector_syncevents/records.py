@@ -0,0 +1,74 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Représentation compacte des éléments à synchroniser.
+
+Les résultats des requêtes sont convertis en simples n-uplets (sans
+dictionnaire d'attributs par instance) et les noms d'hôtes, de services
+et de collecteurs, très souvent répétés, ne sont conservés qu'en un seul
+exemplaire. La mémoire occupée reste ainsi modérée lorsque de très nombreux
+éléments sont à synchroniser.
+"""
+
+from collections import namedtuple
+
+
+
+class SupItem(namedtuple("SupItem", "hostname servicename vigiloserver")):
+    """
+    Hôte ou service à synchroniser. Le nom d'hôte vaut C{None} pour
+    un service de haut niveau, le nom de service vaut C{None} pour un hôte.
+    """
+    __slots__ = ()
+
+
+
+class StringPool(object):
+    """
+    Partage des chaînes de caractères identiques : une seule instance
+    de chaque valeur est conservée.
+
+    Contrairement à C{intern()}, les chaînes Unicode sont acceptées
+    et le partage cesse lorsque l'objet est détruit.
+    """
+
+    def __init__(self):
+        self._strings = {}
+
+
+    def __call__(self, value):
+        """
+        @param value: Chaîne de caractères, ou C{None}.
+        @type  value: C{unicode}
+        @return: Instance partagée de cette chaîne.
+        @rtype: C{unicode}
+        """
+        if value is None:
+            return None
+        return self._strings.setdefault(value, value)
+
+
+    def __len__(self):
+        return len(self._strings)
+
+
+
+def compact(rows, pool=None):
+    """
+    Convertit des résultats de requête en éléments compacts.
+
+    @param rows: Résultats disposant des propriétés C{hostname},
+        C{servicename} et C{vigiloserver}.
+    @type  rows: C{iterable}
+    @param pool: Chaînes partagées, ou C{None} pour en créer un ensemble.
+    @type  pool: L{StringPool}
+    @return: Générateur d'éléments à synchroniser.
+    @rtype: C{generator} of L{SupItem}
+    """
+    if pool is None:
+        pool = StringPool()
+    for row in rows:
+        yield SupItem(pool(row.hostname), pool(row.servicename),
+                      pool(row.vigiloserver))
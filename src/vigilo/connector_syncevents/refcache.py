@@ -0,0 +1,125 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Cache des données de référence utilisées par les requêtes de
+resynchronisation : valeurs des états (L{tables.StateName}) et collecteur
+Nagios responsable de chaque hôte (ventilation).
+
+Ces données ne changent que lors d'un déploiement de la configuration.
+Lorsque le cache est utilisé, les requêtes ne font plus la jointure avec
+la ventilation (elles se contentent d'écarter les hôtes ventilés sur aucun
+collecteur de la part traitée) : le collecteur est retrouvé à partir de
+l'identifiant de l'hôte.
+
+Comme L{vigilo.connector_syncevents.desync}, l'import de ce module
+configure l'accès à la base de données.
+"""
+
+import time
+
+from vigilo.connector_syncevents.desync import get_nagios_ventilation
+
+from vigilo.common.logging import get_logger
+LOGGER = get_logger(__name__)
+
+from vigilo.common.gettext import translate
+_ = translate(__name__)
+
+from vigilo.models import tables
+
+
+# Version enregistrée en base par VigiConf à chaque déploiement.
+CONF_VERSION_NAME = u"vigiconf"
+
+
+
+class ReferenceCache(object):
+    """
+    Données de référence, conservées d'une resynchronisation à l'autre
+    (en mode démon) jusqu'à l'expiration du délai de validité ou jusqu'au
+    prochain déploiement de la configuration.
+    """
+
+    def __init__(self, ttl=0, clock=time.time):
+        """
+        @param ttl: Durée de validité des données (en secondes),
+            ou 0 pour ne les invalider que lors d'un déploiement.
+        @type  ttl: C{int}
+        @param clock: Fonction renvoyant l'heure courante (en secondes).
+        @type  clock: C{callable}
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self._states = {}
+        self._ventilation = {}
+        self._loaded = None
+        self._version = None
+
+
+    def invalidate(self):
+        """Oublie les données de référence."""
+        self._states.clear()
+        self._ventilation.clear()
+        self._loaded = None
+
+
+    def _conf_version(self):
+        version = tables.Version.by_object_name(CONF_VERSION_NAME)
+        if version is None:
+            return None
+        return version.version
+
+
+    def refresh(self):
+        """
+        Invalide les données si leur délai de validité a expiré ou si
+        la configuration a été redéployée depuis leur chargement.
+        À appeler au début de chaque resynchronisation.
+        """
+        version = self._conf_version()
+        if self._loaded is None:
+            pass
+        elif version != self._version:
+            LOGGER.info(_("Configuration version changed (%(old)s -> "
+                          "%(new)s), reloading reference data"),
+                        {"old": self._version, "new": version})
+            self.invalidate()
+        elif self.ttl and self.clock() - self._loaded >= self.ttl:
+            LOGGER.debug(_("Reference data expired, reloading"))
+            self.invalidate()
+        if self._loaded is None:
+            self._loaded = self.clock()
+            self._version = version
+
+
+    def state_value(self, name):
+        """
+        @param name: Nom d'un état (par exemple, C{u'UP'}).
+        @type  name: C{unicode}
+        @return: Identifiant de l'état.
+        @rtype: C{int}
+        """
+        if name not in self._states:
+            self._states[name] = tables.StateName.statename_to_value(name)
+        return self._states[name]
+
+
+    def ventilation(self, shard=None):
+        """
+        @param shard: Part des collecteurs traitée, ou C{None}.
+        @type  shard: L{vigilo.connector_syncevents.shard.Shard}
+        @return: Collecteurs Nagios (actifs) de chaque hôte, indexés par
+            l'identifiant de l'hôte. Seuls les hôtes ventilés sur la part
+            des collecteurs traitée sont présents.
+        @rtype: C{dict}
+        """
+        if shard not in self._ventilation:
+            mapping = {}
+            for idhost, vigiloserver in get_nagios_ventilation(shard):
+                mapping.setdefault(idhost, []).append(vigiloserver)
+            LOGGER.debug(_("Loaded the ventilation of %d host(s)"),
+                         len(mapping))
+            self._ventilation[shard] = mapping
+        return self._ventilation[shard]
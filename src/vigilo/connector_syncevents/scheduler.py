@@ -0,0 +1,171 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Répartition équitable des demandes de mise à jour entre les collecteurs.
+
+Sans répartition, la limite C{max_events} s'applique à l'ensemble des
+résultats : un collecteur ayant de nombreux éléments désynchronisés
+(par exemple après une panne) peut alors consommer tout le budget
+d'une exécution à l'autre, au détriment des autres serveurs Nagios.
+"""
+
+import time
+import random
+from collections import deque
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+
+
+class FairScheduler(object):
+    """
+    Regroupe les éléments à synchroniser par collecteur et les restitue
+    à tour de rôle (un élément par collecteur à chaque tour).
+    """
+
+    def __init__(self, max_per_collector=0, shuffle=True):
+        """
+        @param max_per_collector: Nombre maximum de demandes par collecteur
+            et par exécution (0 pour ne pas imposer de limite).
+        @type  max_per_collector: C{int}
+        @param shuffle: Indique si l'ordre de parcours des collecteurs doit
+            être tiré au hasard. Cela évite qu'un budget global inférieur
+            au nombre de collecteurs ne favorise toujours les mêmes.
+        @type  shuffle: C{bool}
+        """
+        self.max_per_collector = max_per_collector
+        self.shuffle = shuffle
+        self.dropped = 0
+
+
+    def schedule(self, supitems, max_events=0):
+        """
+        @param supitems: Éléments à synchroniser. Ils sont tous lus
+            avant que le premier élément ne soit restitué.
+        @type  supitems: C{iterable}
+        @param max_events: Nombre maximum d'éléments restitués
+            (0 pour ne pas imposer de limite).
+        @type  max_events: C{int}
+        @return: Éléments à synchroniser, répartis entre les collecteurs.
+        @rtype: C{generator}
+        """
+        self.dropped = 0
+        queues = {}
+        for supitem in supitems:
+            queue = queues.setdefault(supitem.vigiloserver, deque())
+            if self.max_per_collector and \
+                    len(queue) >= self.max_per_collector:
+                self.dropped += 1
+                continue
+            queue.append(supitem)
+
+        order = sorted(queues, key=lambda name: name or u"")
+        if self.shuffle:
+            random.shuffle(order)
+        active = deque(queues[name] for name in order)
+
+        count = 0
+        while active:
+            queue = active.popleft()
+            if max_events and count >= max_events:
+                self.dropped += len(queue)
+                continue
+            yield queue.popleft()
+            count += 1
+            if queue:
+                active.append(queue)
+
+        if self.dropped:
+            LOGGER.info(_("%(dropped)d synchronization request(s) postponed "
+                          "to balance the load between %(collectors)d "
+                          "collector(s)"), {
+                            "dropped": self.dropped,
+                            "collectors": len(queues),
+                        })
+
+
+
+class TokenBucket(object):
+    """
+    Seau à jetons : autorise un débit moyen de C{rate} messages par seconde,
+    avec des rafales d'au plus C{burst} messages.
+
+    Un jeton peut être réservé alors que le seau est vide : L{reserve}
+    indique alors le délai à respecter avant d'envoyer le message.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time):
+        """
+        @param rate: Débit autorisé (en messages par seconde).
+        @type  rate: C{float}
+        @param burst: Taille maximale d'une rafale.
+        @type  burst: C{int}
+        @param clock: Fonction renvoyant l'heure courante (en secondes).
+        @type  clock: C{callable}
+        """
+        self.rate = float(rate)
+        self.capacity = float(max(1, burst))
+        self.clock = clock
+        self.tokens = self.capacity
+        self.last = clock()
+
+
+    def reserve(self):
+        """
+        Réserve un jeton.
+
+        @return: Délai (en secondes) avant lequel le message
+            ne doit pas être envoyé.
+        @rtype: C{float}
+        """
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+
+class CollectorRateLimiter(object):
+    """
+    Limite le débit des messages envoyés à chaque collecteur,
+    au moyen d'un seau à jetons par collecteur.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time):
+        """
+        @param rate: Débit autorisé par collecteur (en messages par seconde).
+        @type  rate: C{float}
+        @param burst: Taille maximale d'une rafale.
+        @type  burst: C{int}
+        @param clock: Fonction renvoyant l'heure courante (en secondes).
+        @type  clock: C{callable}
+        """
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._buckets = {}
+
+
+    def reserve(self, collector):
+        """
+        @param collector: Nom du collecteur destinataire du message.
+        @type  collector: C{unicode}
+        @return: Délai (en secondes) avant lequel le message
+            ne doit pas être envoyé.
+        @rtype: C{float}
+        """
+        bucket = self._buckets.get(collector)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, self.clock)
+            self._buckets[collector] = bucket
+        return bucket.reserve()
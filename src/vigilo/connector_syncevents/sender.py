@@ -0,0 +1,338 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Envoi des demandes de mise à jour sur le bus, à destination de Nagios.
+"""
+
+import time
+import logging
+
+from twisted.internet import defer, task
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+# Commande Nagios et gabarit de sa valeur, selon le type d'élément.
+COMMANDS = {
+    "hls": ("SEND_CUSTOM_SVC_NOTIFICATION",
+            "High-Level-Services;%s;0;vigilo;syncevents"),
+    "service": ("SEND_CUSTOM_SVC_NOTIFICATION",
+                "%s;%s;0;vigilo;syncevents"),
+    "host": ("SEND_CUSTOM_HOST_NOTIFICATION",
+             "%s;0;vigilo;syncevents"),
+}
+
+
+class SyncSender(object):
+    """
+    Envoi des demandes de synchronisation sur le bus, à destination des serveurs Nagios
+    """
+
+    #implements(IPushProducer)
+
+
+    def __init__(self, to_sync, max_inflight=1, batch_size=0,
+                 rate_limiter=None, suppression=None, deadline=None):
+        """
+        @param to_sync: Résultats de la requête à la base de données. Chaque
+            résultat doit disposer d'une propriété C{hostname} et d'une
+            propriété C{servicename}. Il peut s'agir d'un générateur
+            (voir L{iter_desync}), qui n'est alors parcouru qu'une fois.
+        @type  to_sync: C{iterable}
+        @param max_inflight: Nombre maximum de messages en cours d'envoi
+            simultanément sur le bus.
+        @type  max_inflight: C{int}
+        @param batch_size: Nombre maximum de commandes regroupées dans un
+            même message à destination d'un serveur Nagios. Le regroupement
+            est désactivé si cette valeur est inférieure ou égale à 1.
+        @type  batch_size: C{int}
+        @param rate_limiter: Objet limitant le débit des messages envoyés
+            à chaque serveur Nagios, ou C{None}.
+        @type  rate_limiter: L{CollectorRateLimiter}
+        @param suppression: Cache des demandes envoyées récemment, ou C{None}.
+            Les éléments qui y figurent sont ignorés et ceux pour lesquels
+            une demande est envoyée y sont ajoutés.
+        @type  suppression: L{SuppressionCache}
+        @param deadline: Date limite (en secondes depuis l'epoch, selon
+            l'horloge C{clock}) au-delà de laquelle plus aucun message n'est
+            envoyé, ou C{None} pour tout envoyer.
+        @type  deadline: C{float}
+        """
+        self.to_sync = to_sync
+        self.max_inflight = max(1, max_inflight)
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter
+        self.suppression = suppression
+        self.deadline = deadline
+        self.clock = None # réacteur Twisted, par défaut
+        self.publisher = None # BusSender
+        # Fonction appelée avec la liste des éléments traités (demande
+        # publiée ou supprimée), par exemple Spool.acknowledge.
+        self.on_done = None
+        # Fonction appelée avec la liste des éléments pour lesquels une
+        # demande a été publiée (voir main.track_requests).
+        self.on_sent = None
+        # Fonction appelée en fin d'envoi avec la liste des éléments lus
+        # pour lesquels aucune demande n'a été publiée (date limite atteinte
+        # ou erreur d'envoi).
+        self.on_unsent = None
+        # Statistiques sur l'envoi des messages.
+        self.count = 0
+        self.messages = 0
+        self.suppressed = 0
+        self.duration = 0.0
+        self.wait_time = 0.0
+        self.publish_time = 0.0
+        self.build_time = 0.0
+        # Indique si l'envoi a été interrompu à l'approche de la date limite.
+        self.expired = False
+        # Nombre d'éléments lus pour lesquels aucune demande n'a été publiée.
+        self.unsent = 0
+        # Commandes en attente de regroupement, par serveur Nagios.
+        self._batches = {}
+
+
+    @defer.inlineCallbacks
+    def askNagios(self, client):
+        """
+        Envoie les demandes de notifications à Nagios.
+
+        Jusqu'à C{max_inflight} messages peuvent être en cours d'envoi
+        simultanément, de sorte que la durée totale de l'envoi ne soit pas
+        proportionnelle à la latence du bus. En cas d'erreur, plus aucun
+        message n'est envoyé et l'erreur est propagée une fois les envois
+        en cours terminés.
+
+        Si le débit est limité (voir L{CollectorRateLimiter}), un message
+        en attente de jeton occupe l'une de ces places.
+
+        Une fois la date limite (C{deadline}) atteinte, plus aucun élément
+        n'est lu ni envoyé. Il ne s'agit pas d'une erreur. Les éléments déjà
+        lus pour lesquels aucune demande n'a été publiée (commandes en
+        attente de regroupement, messages en erreur) sont transmis à
+        C{on_unsent}, les autres restent dans C{to_sync} : ils seront
+        envoyés lors de l'exécution suivante (voir
+        L{vigilo.connector_syncevents.main.track_requests}).
+        """
+        semaphore = defer.DeferredSemaphore(self.max_inflight)
+        errors = []
+        unsent = []
+
+        def sent(_result, supitems, sent_at):
+            self.count += len(supitems)
+            self.messages += 1
+            self.publish_time += time.time() - sent_at
+            if self.suppression is not None:
+                for supitem in supitems:
+                    self.suppression.add(supitem)
+            if self.on_sent is not None:
+                self.on_sent(supitems)
+            if self.on_done is not None:
+                self.on_done(supitems)
+        def failed(failure, supitems):
+            errors.append(failure)
+            unsent.extend(supitems)
+        def release(_result):
+            semaphore.release()
+
+        start = time.time()
+        messages = self._iterMessages()
+        while True:
+            wait_start = time.time()
+            yield semaphore.acquire()
+            self.wait_time += time.time() - wait_start
+            # La date limite est vérifiée avant de lire l'élément suivant,
+            # qui reste ainsi disponible pour l'exécution suivante.
+            if self.deadline is not None and not errors and \
+                    self._seconds() >= self.deadline:
+                self.expired = True
+            item = None
+            if not errors and not self.expired:
+                item = next(messages, None)
+            if item is None:
+                semaphore.release()
+                break
+            message, supitems = item
+            sent_at = time.time()
+            d = self._write(message)
+            d.addCallbacks(sent, failed, callbackArgs=(supitems, sent_at),
+                           errbackArgs=(supitems, ))
+            d.addBoth(release)
+        messages.close()
+        for _commands, supitems in self._batches.values():
+            unsent.extend(supitems)
+        self._batches = {}
+
+        # Attente de la fin des envois en cours.
+        wait_start = time.time()
+        for _i in range(self.max_inflight):
+            yield semaphore.acquire()
+        self.wait_time += time.time() - wait_start
+        self.duration = time.time() - start
+        self.unsent = len(unsent)
+        if unsent and self.on_unsent is not None:
+            self.on_unsent(unsent)
+
+        if self.suppressed:
+            LOGGER.info(_("Skipped %d synchronization request(s) sent "
+                          "recently"), self.suppressed)
+        LOGGER.info(_("Sent %(count)d synchronization request(s) in "
+                      "%(messages)d message(s) in %(duration).2fs "
+                      "(%(rate).1f msg/s, %(wait).2fs waiting for the bus)"), {
+                        "count": self.count,
+                        "messages": self.messages,
+                        "duration": self.duration,
+                        "rate": self.messages / max(self.duration, 1e-6),
+                        "wait": self.wait_time,
+                    })
+        if self.expired:
+            LOGGER.info(_("Time budget exhausted: the remaining "
+                          "synchronization requests are postponed to the "
+                          "next run"))
+        if errors:
+            errors[0].raiseException()
+
+
+    def _seconds(self):
+        """
+        @return: Date courante selon l'horloge C{clock}, en secondes
+            depuis l'epoch.
+        @rtype: C{float}
+        """
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        return clock.seconds()
+
+
+    def _write(self, message):
+        """
+        Publie un message sur le bus, en respectant le débit autorisé
+        pour le serveur Nagios destinataire.
+
+        @param message: Message à publier.
+        @type  message: C{dict}
+        @return: Deferred déclenché une fois le message publié.
+        @rtype: C{Deferred}
+        """
+        delay = 0
+        if self.rate_limiter is not None:
+            delay = self.rate_limiter.reserve(message.get("routing_key"))
+        if delay <= 0:
+            return defer.maybeDeferred(self.publisher.write, message)
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        return task.deferLater(clock, delay, self.publisher.write, message)
+
+
+    def _iterMessages(self):
+        """
+        Construit les messages à envoyer, en regroupant si nécessaire
+        les commandes à destination d'un même serveur Nagios.
+        Les éléments pour lesquels une demande a été envoyée récemment
+        sont ignorés (voir L{SuppressionCache}).
+
+        @return: Générateur de couples (message pour Nagios,
+            liste des éléments concernés).
+        @rtype: C{generator}
+        """
+        batches = self._batches = {}
+        for supitem in self.to_sync:
+            if self.suppression is not None and \
+                    self.suppression.suppressed(supitem):
+                self.suppressed += 1
+                if self.on_done is not None:
+                    self.on_done([supitem])
+                continue
+            build_start = time.time()
+            message = self._buildNagiosMessage(supitem)
+            self.build_time += time.time() - build_start
+            if self.batch_size <= 1:
+                yield (message, [supitem])
+                continue
+            routing_key = message.get("routing_key")
+            messages, supitems = batches.setdefault(routing_key, ([], []))
+            messages.append(message)
+            supitems.append(supitem)
+            if len(messages) >= self.batch_size:
+                del batches[routing_key]
+                yield (self._buildBatchMessage(messages), supitems)
+        while batches:
+            _routing_key, (messages, supitems) = batches.popitem()
+            yield (self._buildBatchMessage(messages), supitems)
+
+
+    def _buildBatchMessage(self, batch):
+        """
+        Regroupe plusieurs commandes Nagios dans un même message.
+        Ce message est d'un type distinct (C{nagios-batch}) : un
+        connector-nagios qui ne sait pas le traiter l'ignore, au lieu
+        de recevoir un message C{nagios} qu'il ne saurait pas lire.
+
+        @param batch: Messages à regrouper, tous à destination
+            du même serveur Nagios.
+        @type  batch: C{list} of C{dict}
+        @return: Le message pour Nagios, contenant la liste des commandes
+            (clé C{commands}), ou le message d'origine s'il n'y en a qu'un.
+        @rtype: C{dict}
+        """
+        if len(batch) == 1:
+            return batch[0]
+        msg = { "type": "nagios-batch",
+                "timestamp": int(time.time()),
+                "commands": [ {"cmdname": m["cmdname"], "value": m["value"]}
+                              for m in batch ],
+                }
+        if "routing_key" in batch[0]:
+            msg["routing_key"] = batch[0]["routing_key"]
+        return msg
+
+
+    def _buildNagiosMessage(self, supitem):
+        """
+        Construit le message de commande Nagios approprié.
+
+        @param supitem: Hôte ou service concerné. Doit disposer d'une propriété
+            C{hostname} et d'une propriété C{servicename}
+        @type  supitem: C{object}
+        @return: Le message pour Nagios
+        @rtype: C{dict}
+        @todo: ajouter une clé routing_key pour n'envoyer qu'au serveur Nagios
+            concerné
+        """
+        msg = { "type": "nagios",
+                "timestamp": int(time.time()),
+                }
+
+        if supitem.vigiloserver:
+            msg['routing_key'] = supitem.vigiloserver
+
+        debug = LOGGER.isEnabledFor(logging.DEBUG)
+        if not supitem.hostname:
+            msg["cmdname"], template = COMMANDS["hls"]
+            msg["value"] = template % (supitem.servicename, )
+            if debug:
+                LOGGER.debug(_("Asking for update on high-level service "
+                               "\"%(service)s\""),
+                             {"service": supitem.servicename})
+        elif supitem.servicename:
+            msg["cmdname"], template = COMMANDS["service"]
+            msg["value"] = template % (supitem.hostname, supitem.servicename)
+            if debug:
+                LOGGER.debug(_("Asking for update on service "
+                               "\"%(service)s\" on host \"%(host)s\""),
+                             {"host": supitem.hostname,
+                              "service": supitem.servicename})
+        else:
+            msg["cmdname"], template = COMMANDS["host"]
+            msg["value"] = template % (supitem.hostname, )
+            if debug:
+                LOGGER.debug(_("Asking for update on host \"%(host)s\""),
+                             {"host": supitem.hostname})
+        return msg
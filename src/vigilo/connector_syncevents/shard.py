@@ -0,0 +1,137 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Répartition de la resynchronisation entre plusieurs instances du connecteur.
+
+Chaque instance ne traite que les éléments ventilés sur une partie des
+collecteurs Nagios : soit une part des collecteurs (option C{--shard i/N}),
+soit une liste explicite de collecteurs (option C{servers}).
+"""
+
+import os
+import re
+import hashlib
+
+
+
+class Shard(object):
+    """
+    Partie des collecteurs Nagios traitée par une instance du connecteur.
+    """
+
+    def __init__(self, index=0, count=1, servers=None, name=None,
+                 hls=False):
+        """
+        @param index: Numéro de la part traitée (à partir de 0).
+        @type  index: C{int}
+        @param count: Nombre total de parts.
+        @type  count: C{int}
+        @param servers: Noms des collecteurs traités, ou C{None}
+            pour ne pas restreindre la liste des collecteurs.
+        @type  servers: C{list} of C{unicode}
+        @param name: Nom de l'instance, utilisé pour distinguer ses fichiers,
+            ou C{None} pour le déduire de la liste des collecteurs.
+        @type  name: C{str}
+        @param hls: Indique si l'instance traite les services de haut
+            niveau lorsque la liste des collecteurs est restreinte.
+        @type  hls: C{bool}
+        """
+        self.index = index
+        self.count = count
+        self.servers = servers
+        self.name = name
+        self.hls = hls
+
+
+    @classmethod
+    def parse(cls, spec, servers=None, name=None, hls=False):
+        """
+        @param spec: Part traitée, sous la forme C{i/N}
+            (avec 1 <= i <= N), ou C{None}.
+        @type  spec: C{str}
+        @param servers: Noms des collecteurs traités, ou C{None}.
+        @type  servers: C{list} of C{unicode}
+        @param name: Nom de l'instance, ou C{None}.
+        @type  name: C{str}
+        @param hls: Indique si l'instance traite les services de haut
+            niveau lorsque la liste des collecteurs est restreinte.
+        @type  hls: C{bool}
+        @return: Part traitée.
+        @rtype: L{Shard}
+        @raise ValueError: La part traitée est invalide.
+        """
+        if spec is None:
+            return cls(servers=servers, name=name, hls=hls)
+        index, _sep, count = spec.partition("/")
+        index = int(index)
+        count = int(count)
+        if not 1 <= index <= count:
+            raise ValueError(spec)
+        return cls(index - 1, count, servers, name, hls)
+
+
+    @property
+    def with_hls(self):
+        """
+        Les services de haut niveau ne sont ventilés sur aucun collecteur :
+        ils sont traités par la première part uniquement et, lorsque la
+        liste des collecteurs est restreinte, seulement si l'instance
+        le demande explicitement.
+        """
+        if self.servers:
+            return self.hls and self.index == 0
+        return self.index == 0
+
+
+    @property
+    def suffix(self):
+        """
+        Suffixe distinguant les fichiers (verrou, fichier d'état)
+        propres à cette part, ou C{None} s'il n'y a qu'une seule part,
+        sans nom ni liste de collecteurs.
+        """
+        parts = []
+        if self.count > 1:
+            parts.append("shard%dof%d" % (self.index + 1, self.count))
+        if self.name:
+            parts.append(re.sub(r"[^\w.-]", "_", self.name))
+        elif self.servers:
+            servers = u",".join(sorted(self.servers)).encode("utf-8")
+            parts.append("servers-%s" % hashlib.md5(servers).hexdigest()[:8])
+        return "-".join(parts) or None
+
+
+    def path(self, path):
+        """
+        @param path: Emplacement d'un fichier propre à l'instance.
+        @type  path: C{str}
+        @return: Emplacement du fichier pour cette part.
+        @rtype: C{str}
+        """
+        if self.suffix is None:
+            return path
+        base, ext = os.path.splitext(path)
+        return "%s-%s%s" % (base, self.suffix, ext)
+
+
+    def filter(self, query):
+        """
+        Restreint une requête aux collecteurs de cette part.
+
+        @param query: Requête portant sur la table des collecteurs.
+        @type  query: C{sqlalchemy.orm.query.Query}
+        @return: Requête restreinte.
+        @rtype: C{sqlalchemy.orm.query.Query}
+        """
+        # Import local : ce module est chargé avant la configuration
+        # de l'accès à la base de données.
+        from vigilo.models import tables
+        if self.count > 1:
+            query = query.filter(
+                tables.VigiloServer.idvigiloserver % self.count
+                == self.index)
+        if self.servers:
+            query = query.filter(tables.VigiloServer.name.in_(self.servers))
+        return query
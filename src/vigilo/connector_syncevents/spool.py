@@ -0,0 +1,316 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Conservation des éléments à synchroniser entre deux exécutions.
+
+Les éléments trouvés par la recherche sont enregistrés dans un fichier
+avant d'être envoyés. Si l'envoi échoue en cours de route (bus indisponible,
+délai dépassé), l'exécution suivante reprend l'envoi là où il s'était
+arrêté, sans relancer la recherche.
+
+Le fichier commence par un en-tête (L{MAGIC}), suivi d'enregistrements
+préfixés par leur type (1 octet) et leur longueur (4 octets) :
+
+    - L{RECORD_STRING} : chaîne de caractères (UTF-8), numérotée
+      à partir de 1 dans l'ordre d'apparition ;
+    - L{RECORD_ITEM} : élément à synchroniser, décrit par les numéros
+      (4 octets chacun) de son nom d'hôte, de son nom de service et de son
+      serveur Nagios (0 pour C{None}).
+
+Chaque chaîne n'est donc enregistrée qu'une fois. La progression de l'envoi
+est enregistrée dans un fichier voisin (suffixe C{.checkpoint}).
+"""
+
+import os
+import errno
+import struct
+import tempfile
+from datetime import datetime
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+from vigilo.connector_syncevents.records import SupItem
+from vigilo.connector_syncevents.state import StateFile, DATE_FORMAT
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+MAGIC = b"VIGILO-SYNCEVENTS-SPOOL-1\n"
+RECORD_STRING = 1
+RECORD_ITEM = 2
+HEADER = struct.Struct(">BI")
+ITEM = struct.Struct(">III")
+
+
+class SpoolError(Exception):
+    """Fichier de reprise invalide."""
+    pass
+
+
+
+def write_records(output, supitems):
+    """
+    Enregistre des éléments à synchroniser.
+
+    @param output: Fichier ouvert en écriture (mode binaire),
+        positionné après l'en-tête.
+    @type  output: C{file}
+    @param supitems: Éléments à synchroniser.
+    @type  supitems: C{iterable}
+    @return: Nombre d'éléments enregistrés.
+    @rtype: C{int}
+    """
+    strings = {}
+    count = 0
+
+    def string_id(value):
+        if value is None:
+            return 0
+        index = strings.get(value)
+        if index is None:
+            data = value.encode("utf-8")
+            output.write(HEADER.pack(RECORD_STRING, len(data)))
+            output.write(data)
+            index = strings[value] = len(strings) + 1
+        return index
+
+    for supitem in supitems:
+        payload = ITEM.pack(string_id(supitem.hostname),
+                            string_id(supitem.servicename),
+                            string_id(supitem.vigiloserver))
+        output.write(HEADER.pack(RECORD_ITEM, len(payload)))
+        output.write(payload)
+        count += 1
+    return count
+
+
+def read_records(source):
+    """
+    Relit des éléments à synchroniser. Les chaînes identiques sont
+    partagées entre les éléments.
+
+    @param source: Fichier ouvert en lecture (mode binaire),
+        positionné après l'en-tête.
+    @type  source: C{file}
+    @return: Générateur d'éléments à synchroniser.
+    @rtype: C{generator} of L{SupItem}
+    @raise SpoolError: Le fichier est tronqué ou invalide.
+    """
+    strings = [None]
+    while True:
+        header = source.read(HEADER.size)
+        if not header:
+            return
+        if len(header) < HEADER.size:
+            raise SpoolError("Truncated record header")
+        record, length = HEADER.unpack(header)
+        payload = source.read(length)
+        if len(payload) < length:
+            raise SpoolError("Truncated record")
+        if record == RECORD_STRING:
+            strings.append(payload.decode("utf-8"))
+        elif record == RECORD_ITEM:
+            try:
+                yield SupItem._make([ strings[index] for index
+                                      in ITEM.unpack(payload) ])
+            except (IndexError, struct.error):
+                raise SpoolError("Invalid item record")
+        # Les types d'enregistrement inconnus sont ignorés.
+
+
+
+class Spool(object):
+    """
+    Fichier de reprise des éléments à synchroniser.
+
+    Utilisation :
+
+        1. si L{pending} indique qu'un envoi précédent n'a pas abouti,
+           L{replay} renvoie les éléments restant à envoyer ;
+        2. sinon, L{write} enregistre les éléments trouvés par la recherche,
+           puis L{replay} les relit ;
+        3. L{acknowledge} est appelée pour les éléments envoyés (ou écartés) ;
+        4. L{finish} supprime le fichier si tous les éléments ont été
+           envoyés, ou enregistre la progression de l'envoi.
+    """
+
+    def __init__(self, path, max_age, checkpoint_every=100):
+        """
+        @param path: Emplacement du fichier de reprise.
+        @type  path: C{str}
+        @param max_age: Délai au-delà duquel les éléments non envoyés
+            sont abandonnés (une nouvelle recherche est alors effectuée).
+        @type  max_age: C{datetime.timedelta}
+        @param checkpoint_every: Nombre d'éléments envoyés entre deux
+            enregistrements de la progression, de sorte qu'elle ne soit pas
+            perdue si le connecteur est interrompu.
+        @type  checkpoint_every: C{int}
+        """
+        self.path = path
+        self.max_age = max_age
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint = StateFile(path + ".checkpoint")
+        self.total = 0
+        self.done = 0
+        self._saved = 0
+        self._inflight = {}
+        self._acknowledged = set()
+
+
+    def pending(self, now=None):
+        """
+        @param now: Date de l'exécution en cours (par défaut,
+            la date courante).
+        @type  now: C{datetime.datetime}
+        @return: Nombre d'éléments restant à envoyer suite à un envoi
+            précédent qui n'a pas abouti.
+        @rtype: C{int}
+        """
+        if not os.path.exists(self.path):
+            return 0
+        self.checkpoint.load()
+        data = self.checkpoint.data
+        try:
+            created = datetime.strptime(data["created"], DATE_FORMAT)
+            self.total = int(data["total"])
+            self.done = int(data["done"])
+        except (KeyError, TypeError, ValueError):
+            LOGGER.warning(_("Ignoring the spool file %s: no valid "
+                             "checkpoint"), self.path)
+            self.discard()
+            return 0
+        if now is None:
+            now = datetime.now()
+        if created + self.max_age < now:
+            LOGGER.info(_("Discarding %(count)d synchronization request(s) "
+                          "spooled at %(date)s"),
+                        {"count": self.total - self.done,
+                         "date": data["created"]})
+            self.discard()
+            return 0
+        if self.done >= self.total:
+            self.discard()
+            return 0
+        self._saved = self.done
+        return self.total - self.done
+
+
+    def write(self, supitems, now=None):
+        """
+        Enregistre les éléments à synchroniser, en remplacement
+        du contenu précédent du fichier.
+
+        @param supitems: Éléments à synchroniser.
+        @type  supitems: C{iterable}
+        @param now: Date de la recherche (par défaut, la date courante).
+        @type  now: C{datetime.datetime}
+        @return: Nombre d'éléments enregistrés.
+        @rtype: C{int}
+        """
+        if now is None:
+            now = datetime.now()
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".spool-")
+        try:
+            with os.fdopen(fd, "wb") as output:
+                output.write(MAGIC)
+                self.total = write_records(output, supitems)
+            os.rename(tmpname, self.path)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+        self.done = self._saved = 0
+        self.checkpoint.data = {"created": now.strftime(DATE_FORMAT)}
+        self._save()
+        return self.total
+
+
+    def replay(self):
+        """
+        @return: Éléments restant à envoyer, dans l'ordre de leur
+            enregistrement.
+        @rtype: C{generator} of L{SupItem}
+        """
+        self._inflight = {}
+        self._acknowledged = set()
+        try:
+            source = open(self.path, "rb")
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with source:
+            if source.read(len(MAGIC)) != MAGIC:
+                LOGGER.warning(_("Ignoring invalid spool file %s"),
+                               self.path)
+                return
+            try:
+                for index, supitem in enumerate(read_records(source)):
+                    if index < self.done:
+                        continue
+                    # L'élément est conservé jusqu'à son acquittement,
+                    # de sorte que son identifiant ne soit pas réutilisé.
+                    self._inflight[id(supitem)] = (index, supitem)
+                    yield supitem
+            except SpoolError as e:
+                LOGGER.warning(_("Spool file %(path)s is damaged: "
+                                 "%(error)s"),
+                               {"path": self.path, "error": e})
+
+
+    def acknowledge(self, supitems):
+        """
+        Indique que des éléments ont été envoyés (ou écartés). La
+        progression ne tient compte que des éléments envoyés sans
+        interruption depuis le début : après un échec, l'envoi reprend
+        au premier élément non envoyé.
+
+        @param supitems: Éléments renvoyés par L{replay}.
+        @type  supitems: C{list}
+        """
+        for supitem in supitems:
+            entry = self._inflight.pop(id(supitem), None)
+            if entry is not None:
+                self._acknowledged.add(entry[0])
+        while self.done in self._acknowledged:
+            self._acknowledged.remove(self.done)
+            self.done += 1
+        if self.checkpoint_every and \
+                self.done - self._saved >= self.checkpoint_every:
+            self._save()
+
+
+    def finish(self):
+        """
+        Termine l'envoi : le fichier est supprimé si tous les éléments
+        ont été envoyés, la progression est enregistrée sinon.
+        """
+        if self.done >= self.total:
+            self.discard()
+            return
+        LOGGER.info(_("%d synchronization request(s) left in the spool"),
+                    self.total - self.done)
+        self._save()
+
+
+    def discard(self):
+        """Supprime le fichier de reprise et sa progression."""
+        for path in (self.path, self.checkpoint.path):
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self.total = self.done = self._saved = 0
+        self._inflight = {}
+        self._acknowledged = set()
+
+
+    def _save(self):
+        self.checkpoint.data["total"] = self.total
+        self.checkpoint.data["done"] = self.done
+        self.checkpoint.save()
+        self._saved = self.done
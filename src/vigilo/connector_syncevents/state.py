@@ -0,0 +1,85 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Persistance de l'état du connecteur syncevents entre deux exécutions.
+"""
+
+import os
+import json
+import errno
+import tempfile
+
+from vigilo.common.logging import get_logger, get_error_message
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+
+class StateFile(object):
+    """
+    Fichier d'état au format JSON. Chaque fonctionnalité y dispose
+    de sa propre section (un dictionnaire), accessible via L{section}.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: Emplacement du fichier d'état.
+        @type  path: C{str}
+        """
+        self.path = path
+        self.data = {}
+
+
+    def load(self):
+        """
+        Charge le contenu du fichier d'état. Un fichier absent ou illisible
+        est traité comme un fichier vide.
+        """
+        try:
+            with open(self.path, "rb") as state:
+                self.data = json.loads(state.read().decode("utf-8"))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                LOGGER.warning(_("Could not read the state file: %s"),
+                               get_error_message(e))
+            self.data = {}
+        except ValueError as e:
+            LOGGER.warning(_("Ignoring invalid state file %(path)s: "
+                             "%(error)s"),
+                           {"path": self.path,
+                            "error": get_error_message(e)})
+            self.data = {}
+        if not isinstance(self.data, dict):
+            self.data = {}
+
+
+    def save(self):
+        """
+        Enregistre le contenu du fichier d'état. Le fichier est remplacé
+        de manière atomique, de sorte qu'une interruption ne le corrompe pas.
+        """
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".state-")
+        try:
+            with os.fdopen(fd, "wb") as state:
+                state.write(json.dumps(self.data).encode("utf-8"))
+            os.rename(tmpname, self.path)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+
+
+    def section(self, name):
+        """
+        @param name: Nom de la section.
+        @type  name: C{str}
+        @return: Section du fichier d'état (créée si nécessaire).
+        @rtype: C{dict}
+        """
+        return self.data.setdefault(name, {})
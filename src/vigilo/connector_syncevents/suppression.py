@@ -0,0 +1,115 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Mémorisation des demandes de mise à jour récemment envoyées.
+
+Si le corrélateur n'a pas encore traité la réponse de Nagios lors de
+l'exécution suivante, l'élément est toujours considéré comme désynchronisé :
+sans cette mémorisation, la même demande serait envoyée une nouvelle fois.
+"""
+
+import time
+from collections import OrderedDict
+
+from vigilo.connector_syncevents.incremental import supitem_key
+
+
+
+class SuppressionCache(object):
+    """
+    Cache des demandes envoyées, avec une durée de vie limitée
+    et un nombre maximum d'entrées (les plus anciennes sont évincées).
+
+    Le cache est conservé en mémoire en mode démon et enregistré dans
+    une section du fichier d'état entre deux exécutions (voir L{flush}).
+    """
+
+    def __init__(self, state, ttl, max_size=0, clock=time.time):
+        """
+        @param state: Section du fichier d'état réservée au cache.
+        @type  state: C{dict}
+        @param ttl: Délai (en secondes) pendant lequel une nouvelle
+            demande pour le même élément est supprimée.
+        @type  ttl: C{int}
+        @param max_size: Nombre maximum d'entrées (0 pour ne pas imposer
+            de limite).
+        @type  max_size: C{int}
+        @param clock: Fonction renvoyant l'heure courante (en secondes).
+        @type  clock: C{callable}
+        """
+        self.state = state
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        # Les entrées sont classées par date de demande croissante.
+        self._entries = OrderedDict()
+        for key, asked_at in sorted(state.get("entries", []),
+                                    key=lambda entry: entry[1]):
+            self._entries[key] = asked_at
+        self.purge()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def purge(self):
+        """Oublie les demandes expirées."""
+        limit = self.clock() - self.ttl
+        while self._entries:
+            key, asked_at = next(iter(self._entries.items()))
+            if asked_at > limit:
+                break
+            del self._entries[key]
+
+
+    def suppressed(self, supitem):
+        """
+        @param supitem: Hôte ou service à synchroniser.
+        @type  supitem: C{object}
+        @return: Indique si une demande a été envoyée récemment
+            pour cet élément.
+        @rtype: C{bool}
+        """
+        asked_at = self._entries.get(supitem_key(supitem))
+        if asked_at is None:
+            return False
+        return asked_at > self.clock() - self.ttl
+
+
+    def exclude(self, supitems):
+        """
+        @param supitems: Éléments à synchroniser.
+        @type  supitems: C{iterable}
+        @return: Éléments pour lesquels aucune demande n'a été envoyée
+            récemment.
+        @rtype: C{generator}
+        """
+        self.purge()
+        for supitem in supitems:
+            if not self.suppressed(supitem):
+                yield supitem
+
+
+    def add(self, supitem):
+        """
+        Mémorise l'envoi d'une demande.
+
+        @param supitem: Hôte ou service concerné.
+        @type  supitem: C{object}
+        """
+        key = supitem_key(supitem)
+        self._entries.pop(key, None)
+        self._entries[key] = self.clock()
+        if self.max_size:
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def flush(self):
+        """Reporte le contenu du cache dans le fichier d'état."""
+        self.purge()
+        self.state["entries"] = [ [key, asked_at] for key, asked_at
+                                  in self._entries.items() ]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste l'ajustement automatique du nombre de demandes par exécution
+"""
+import unittest
+from datetime import datetime
+
+from vigilo.connector_syncevents.adaptive import AdaptiveBudget
+from vigilo.connector_syncevents.records import SupItem
+
+
+
+class Sender(object):
+    def __init__(self, messages, publish_time, duration=0):
+        self.messages = messages
+        self.publish_time = publish_time
+        self.duration = duration
+
+
+
+def make_items(count):
+    return [ SupItem(u"host%d" % i, None, u"collector") for i in range(count) ]
+
+
+class TestAdaptiveBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {}
+        self.now = datetime(2020, 1, 1)
+
+    def run_once(self, budget, count, sender=None, refreshed=None):
+        if refreshed is not None:
+            budget.check(self.now, lambda supitems, since: refreshed)
+        else:
+            budget.check(self.now, lambda supitems, since: len(supitems))
+        budget.track(make_items(count))
+        budget.finish(sender)
+        budget.flush()
+
+    def test_initial(self):
+        """Budget initial borné par les valeurs minimale et maximale"""
+        self.assertEqual(AdaptiveBudget({}, 50, 1000).budget, 50)
+        self.assertEqual(AdaptiveBudget({}, 50, 1000, initial=100).budget, 100)
+        self.assertEqual(AdaptiveBudget({}, 50, 1000, initial=5000).budget,
+                         1000)
+        self.assertEqual(AdaptiveBudget({"budget": 10}, 50, 1000).budget, 50)
+
+    def test_increase(self):
+        """Augmentation lorsque le budget est entièrement consommé"""
+        budget = AdaptiveBudget(self.state, 50, 1000, initial=100,
+                                increase=10)
+        self.run_once(budget, 100, Sender(100, 1))
+        self.assertEqual(budget.budget, 110)
+        self.assertEqual(self.state["budget"], 110)
+
+    def test_not_saturated(self):
+        """Pas d'augmentation lorsque le budget n'est pas atteint"""
+        budget = AdaptiveBudget(self.state, 50, 1000, initial=100)
+        self.run_once(budget, 20, Sender(20, 0.2))
+        self.assertEqual(budget.budget, 100)
+
+    def test_maximum(self):
+        """Le budget ne dépasse pas la valeur maximale"""
+        budget = AdaptiveBudget(self.state, 50, 105, initial=100,
+                                increase=10)
+        self.run_once(budget, 100, Sender(100, 1))
+        self.assertEqual(budget.budget, 105)
+
+    def test_latency(self):
+        """Diminution lorsque la latence de publication est trop élevée"""
+        budget = AdaptiveBudget(self.state, 50, 1000, initial=400,
+                                latency_target=0.5)
+        self.run_once(budget, 400, Sender(400, 400))
+        self.assertEqual(budget.budget, 200)
+        self.run_once(budget, 200, Sender(200, 200))
+        self.assertEqual(budget.budget, 100)
+        self.run_once(budget, 100, Sender(100, 100))
+        self.assertEqual(budget.budget, 50)
+
+    def test_timeout(self):
+        """Diminution lorsque l'envoi approche du délai autorisé"""
+        budget = AdaptiveBudget(self.state, 50, 1000, initial=400,
+                                timeout=30)
+        self.run_once(budget, 400, Sender(400, 4, duration=29))
+        self.assertEqual(budget.budget, 200)
+
+    def test_refreshed(self):
+        """Diminution lorsque trop peu d'éléments ont été mis à jour"""
+        budget = AdaptiveBudget(self.state, 50, 1000, initial=400,
+                                sample_size=10)
+        self.run_once(budget, 400, Sender(400, 4))
+        self.assertEqual(len(self.state["pending"]), 10)
+        self.assertTrue("requested_at" in self.state)
+        budget = AdaptiveBudget(self.state, 50, 1000, sample_size=10)
+        self.run_once(budget, 0, refreshed=2)
+        self.assertEqual(budget.budget, 202)
+        # Pas de demande lors de la dernière exécution : rien à vérifier.
+        self.assertEqual(self.state["pending"], [])
+        self.assertFalse("requested_at" in self.state)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste le banc d'essai de la chaîne complète de resynchronisation
+"""
+import unittest
+from datetime import datetime
+
+from vigilo.common.conf import settings
+settings.load_module(__name__)
+from vigilo.models.configure import configure_db
+configure_db(settings['database'], 'sqlalchemy_')
+
+from vigilo.models.session import DBSession, metadata
+
+from vigilo.connector_syncevents.bench import create_schema, seed_fleet
+from vigilo.connector_syncevents.bench.pipeline import run_pipeline, compare
+from vigilo.connector_syncevents.desync import get_desync
+from vigilo.connector_syncevents.main import get_time_limits
+
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        create_schema()
+        seed_fleet(2, 20, 5, stale=0.1, down=0.1, desync=0.1, hls=5,
+                   progress=False, correvents=0.5)
+
+    def tearDown(self):
+        DBSession.rollback()
+        DBSession.expunge_all()
+        metadata.drop_all()
+
+    def test_run(self):
+        """Mesures d'une resynchronisation complète"""
+        now = datetime.utcnow()
+        expected = len(get_desync(*get_time_limits(now)))
+        self.assertTrue(expected > 0)
+        result = run_pipeline(now)
+        self.assertEqual(result["requests"], expected)
+        self.assertEqual(result["messages"], expected)
+        self.assertTrue(result["throughput"] > 0)
+        self.assertTrue(result["peak_rss"] >= result["base_rss"])
+        for key in ("p50", "p95", "p99", "max"):
+            self.assertTrue(key in result["time_to_publish"])
+
+    def test_compare(self):
+        """Détection d'une dégradation par rapport à une version précédente"""
+        baseline = {"fleet": {}, "settings": {},
+                    "summary": {"throughput": 100.0, "peak_rss": 1000}}
+        results = {"fleet": {}, "settings": {},
+                   "summary": {"throughput": 95.0, "peak_rss": 1050}}
+        self.assertFalse(compare(results, baseline))
+        results["summary"]["throughput"] = 80.0
+        self.assertTrue(compare(results, baseline))
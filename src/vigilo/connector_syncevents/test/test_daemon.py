@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste le mode démon du connecteur syncevents
+"""
+import unittest
+
+# ATTENTION: ne pas utiliser twisted.trial, car nose va ignorer les erreurs
+# produites par ce module !!!
+#from twisted.trial import unittest
+from nose.twistedtools import reactor, deferred # pylint: disable-msg=W0611
+
+from mock import Mock, patch
+
+from vigilo.connector_syncevents.daemon import SyncDaemon
+
+
+
+class DBResult(object):
+    def __init__(self, hostname, servicename, vigiloserver):
+        self.hostname = hostname
+        self.servicename = servicename
+        self.vigiloserver = vigiloserver
+
+
+
+class TestSyncDaemon(unittest.TestCase):
+
+
+    def setUp(self):
+        self.client = Mock()
+        self.client.isConnected.return_value = True
+        self.publisher = Mock()
+        self.daemon = SyncDaemon(self.client, self.publisher, 60)
+        self.patchers = [
+            patch("vigilo.connector_syncevents.daemon.transaction"),
+            patch("vigilo.connector_syncevents.daemon.find_desync"),
+        ]
+        self.transaction = self.patchers[0].start()
+        self.find_desync = self.patchers[1].start()
+
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+
+    @deferred(timeout=30)
+    def test_synchronize(self):
+        """Une resynchronisation publie les demandes sur le bus"""
+        db = DBResult("testhost", "testservice", "collector")
+        self.find_desync.return_value = iter([db] * 3)
+        d = self.daemon.synchronize()
+        def check(_result):
+            self.assertEqual(len(self.publisher.write.call_args_list), 3)
+            self.assertTrue(self.transaction.abort.called)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_watch(self):
+        """Avec --watch, les états trop anciens ne sont pas recherchés"""
+        self.find_desync.return_value = iter([])
+        self.daemon.watch = True
+        d = self.daemon.synchronize()
+        def check(_result):
+            self.assertFalse(self.find_desync.call_args[1]["ages"])
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_not_connected(self):
+        """Pas de resynchronisation sans connexion au bus"""
+        self.client.isConnected.return_value = False
+        d = self.daemon.synchronize()
+        def check(_result):
+            self.assertFalse(self.find_desync.called)
+            self.assertFalse(self.publisher.write.called)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_error_does_not_stop(self):
+        """Une erreur n'interrompt pas le démon"""
+        self.find_desync.side_effect = RuntimeError("dummy")
+        d = self.daemon.synchronize()
+        def check(_result):
+            self.assertFalse(self.publisher.write.called)
+            self.assertTrue(self.transaction.abort.called)
+        d.addCallback(check)
+        return d
@@ -9,6 +9,8 @@ from __future__ import print_function
 import unittest
 from datetime import datetime, timedelta
 
+from mock import patch
+
 from vigilo.common.conf import settings
 settings.load_module(__name__)
 from vigilo.models.configure import configure_db
@@ -18,7 +20,18 @@ from vigilo.models.session import DBSession, metadata
 from vigilo.models import tables
 from vigilo.models.demo import functions as df
 
-from vigilo.connector_syncevents.main import get_desync
+from vigilo.connector_syncevents.desync import get_desync, iter_desync, \
+                                               has_desync, \
+                                               get_desync_parallel, \
+                                               count_refreshed, \
+                                               get_state_timestamps, \
+                                               get_hls_by_dependencies, \
+                                               _branch_rows, \
+                                               _state_timestamp_queries
+from vigilo.connector_syncevents.main import find_desync
+from vigilo.connector_syncevents.shard import Shard
+from vigilo.connector_syncevents.refcache import ReferenceCache
+from vigilo.connector_syncevents.metrics import RunMetrics
 
 # désactivation de "Too many public methods"
 # pylint: disable-msg=R0904
@@ -65,6 +78,29 @@ class TestRequest(unittest.TestCase):
         time_limit = datetime.utcnow() - timedelta(minutes=42)
         self.assertEqual(get_desync(time_limit, time_limit), [])
 
+    def test_has_desync(self):
+        """Recherche rapide d'éléments à synchroniser"""
+        utcnow = datetime.utcnow()
+        time_limit = utcnow - timedelta(minutes=42)
+        self.assertFalse(has_desync(time_limit, time_limit))
+        host = df.add_host("testhost")
+        df.add_ventilation(host, "collector", "nagios")
+        df.add_host_state(host, "DOWN", timestamp=utcnow)
+        DBSession.flush()
+        self.assertFalse(has_desync(time_limit, time_limit))
+        # État désynchronisé par rapport à l'événement.
+        svc = df.add_lowlevelservice(host, "testsvc")
+        df.add_host_state(host, "UP", timestamp=utcnow)
+        df.add_svc_state(svc, "WARNING", timestamp=utcnow)
+        e = df.add_event(svc, "CRITICAL", "dummy")
+        df.add_correvent([e])
+        DBSession.flush()
+        self.assertTrue(has_desync(time_limit, time_limit))
+        self.assertEqual(len(get_desync(time_limit, time_limit)), 1)
+        # Seuls les changements récents sont pris en compte.
+        self.assertFalse(has_desync(time_limit, time_limit,
+                                    event_since=utcnow + timedelta(1)))
+
     def test_age_younger_host(self):
         """Évènements trop récents sur un hôte"""
         host = df.add_host("testhost")
@@ -259,6 +295,308 @@ class TestRequest(unittest.TestCase):
         print(results)
         self.assertEqual(len(results), 2)
 
+    def test_iter_desync(self):
+        """Parcours des résultats au fil de l'eau"""
+        utcnow = datetime.utcnow()
+        age = utcnow - timedelta(minutes=42)
+        for i in range(10):
+            host = df.add_host("testhost%d" % i)
+            df.add_host_state(host, "DOWN", timestamp=age)
+            df.add_ventilation(host, "collector", "nagios")
+        DBSession.flush()
+        results = iter_desync(utcnow, utcnow, 0, 3)
+        self.assertFalse(isinstance(results, list))
+        self.assertEqual(
+            sorted(r.hostname for r in results),
+            sorted(r.hostname for r in get_desync(utcnow, utcnow)))
+        results = list(iter_desync(utcnow, utcnow, 4, 3))
+        self.assertEqual(len(results), 4)
+
+    def test_time_since(self):
+        """Recherche incrémentale sur l'âge des états"""
+        utcnow = datetime.utcnow()
+        time_limit = utcnow - timedelta(minutes=20)
+        for i, minutes in enumerate((21, 30, 40)):
+            host = df.add_host("testhost%d" % i)
+            df.add_host_state(host, "DOWN",
+                              timestamp=utcnow - timedelta(minutes=minutes))
+            df.add_ventilation(host, "collector", "nagios")
+        DBSession.flush()
+        results = get_desync(time_limit, None,
+                             time_since=utcnow - timedelta(minutes=35))
+        self.assertEqual(sorted(r.hostname for r in results),
+                         ["testhost0", "testhost1"])
+
+    def test_event_since(self):
+        """Recherche incrémentale sur les événements"""
+        host = df.add_host("testhost")
+        df.add_ventilation(host, "collector", "nagios")
+        old = datetime.utcnow() - timedelta(minutes=30)
+        df.add_host_state(host, "OK", timestamp=old)
+        e = df.add_event(host, "DOWN", "dummy", timestamp=old)
+        df.add_correvent([e])
+        DBSession.flush()
+        results = get_desync(None, None,
+                             event_since=old - timedelta(minutes=1))
+        self.assertEqual(len(results), 1)
+        results = get_desync(None, None, event_since=old)
+        self.assertEqual(len(results), 0)
+
+    def test_shard(self):
+        """Chaque part ne traite que ses collecteurs"""
+        df.add_vigiloserver("collector2")
+        utcnow = datetime.utcnow()
+        age = utcnow - timedelta(minutes=42)
+        for collector in ("collector", "collector2"):
+            host = df.add_host("host_%s" % collector)
+            df.add_ventilation(host, collector, "nagios")
+            df.add_host_state(host, "DOWN", timestamp=age)
+        hls = df.add_highlevelservice("testhls")
+        df.add_svc_state(hls, "UNKNOWN", timestamp=age)
+        DBSession.flush()
+        results = []
+        for index in range(2):
+            shard = Shard(index, 2)
+            for use_cte in (False, True):
+                shard_results = get_desync(utcnow, utcnow, use_cte=use_cte,
+                                           shard=shard)
+                self.assertEqual(len(shard_results), 1 + int(shard.with_hls))
+            results.extend(shard_results)
+        self.assertEqual(sorted(results), sorted(get_desync(utcnow, utcnow)))
+        results = get_desync(utcnow, utcnow,
+                             shard=Shard(servers=[u"collector2"]))
+        self.assertEqual([ (r.hostname, r.vigiloserver) for r in results ],
+                         [("host_collector2", "collector2")])
+
+    def test_reference_cache(self):
+        """Ventilation retrouvée à l'aide du cache des données de référence"""
+        df.add_vigiloserver("collector2")
+        utcnow = datetime.utcnow()
+        age = utcnow - timedelta(minutes=42)
+        for collector, state in (("collector", "DOWN"),
+                                 ("collector2", "UP")):
+            host = df.add_host("host_%s" % collector)
+            df.add_ventilation(host, collector, "nagios")
+            df.add_host_state(host, state, timestamp=age)
+            svc = df.add_lowlevelservice(host, "testsvc")
+            df.add_svc_state(svc, "CRITICAL", timestamp=age)
+        # Hôte ventilé sur aucun collecteur : jamais remonté.
+        host = df.add_host("not_ventilated")
+        df.add_host_state(host, "DOWN", timestamp=age)
+        hls = df.add_highlevelservice("testhls")
+        df.add_svc_state(hls, "UNKNOWN", timestamp=age)
+        DBSession.flush()
+
+        def as_tuples(results):
+            return sorted(tuple(r) for r in results)
+        refs = ReferenceCache()
+        refs.refresh()
+        expected = as_tuples(get_desync(utcnow, utcnow))
+        self.assertEqual(len(expected), 3)
+        for use_cte in (False, True):
+            for priority in (False, True):
+                results = get_desync(utcnow, utcnow, use_cte=use_cte,
+                                     priority=priority, refs=refs)
+                self.assertEqual(as_tuples(results), expected)
+        self.assertEqual(as_tuples(iter_desync(utcnow, utcnow, refs=refs)),
+                         expected)
+        self.assertEqual(len(get_desync(utcnow, utcnow, 2, refs=refs)), 2)
+        # La limite reste appliquée par la requête.
+        from vigilo.connector_syncevents import desync
+        with patch("vigilo.connector_syncevents.desync._get_desync_query",
+                   wraps=desync._get_desync_query) as query:
+            self.assertEqual(len(list(iter_desync(utcnow, utcnow, 2,
+                                                  refs=refs))), 2)
+            self.assertEqual(query.call_args[0][2], 2)
+        shard = Shard(servers=[u"collector2"])
+        self.assertEqual(as_tuples(get_desync(utcnow, utcnow, shard=shard,
+                                              refs=refs)),
+                         as_tuples(get_desync(utcnow, utcnow, shard=shard)))
+
+    def test_reference_cache_shard_limit(self):
+        """Limite appliquée aux seuls éléments de la part traitée"""
+        df.add_vigiloserver("collector2")
+        utcnow = datetime.utcnow()
+        for i in range(6):
+            # Éléments d'une autre part, plus anciens donc prioritaires.
+            host = df.add_host("other%d" % i)
+            df.add_ventilation(host, "collector", "nagios")
+            df.add_host_state(host, "DOWN",
+                              timestamp=utcnow - timedelta(hours=2))
+        for i in range(3):
+            host = df.add_host("mine%d" % i)
+            df.add_ventilation(host, "collector2", "nagios")
+            df.add_host_state(host, "DOWN",
+                              timestamp=utcnow - timedelta(hours=1))
+        DBSession.flush()
+        refs = ReferenceCache()
+        refs.refresh()
+        shard = Shard(servers=[u"collector2"])
+        for use_cte in (False, True):
+            for priority in (False, True):
+                results = get_desync(utcnow, utcnow, 2, use_cte=use_cte,
+                                     priority=priority, shard=shard,
+                                     refs=refs)
+                self.assertEqual(len(results), 2)
+                results = list(iter_desync(utcnow, utcnow, 2,
+                                           use_cte=use_cte,
+                                           priority=priority, shard=shard,
+                                           refs=refs))
+                self.assertEqual(len(results), 2)
+                for supitem in results:
+                    self.assertEqual(supitem.vigiloserver, u"collector2")
+
+    def test_count_refreshed(self):
+        """Nombre d'éléments dont l'état a été mis à jour"""
+        utcnow = datetime.utcnow()
+        since = utcnow - timedelta(minutes=10)
+        old = utcnow - timedelta(minutes=20)
+        host = df.add_host("testhost")
+        host2 = df.add_host("testhost2")
+        svc = df.add_lowlevelservice(host, "testsvc")
+        svc2 = df.add_lowlevelservice(host, "testsvc2")
+        hls = df.add_highlevelservice("testhls")
+        df.add_host_state(host, "UP", timestamp=utcnow)
+        df.add_host_state(host2, "UP", timestamp=old)
+        df.add_svc_state(svc, "OK", timestamp=utcnow)
+        df.add_svc_state(svc2, "OK", timestamp=old)
+        df.add_svc_state(hls, "OK", timestamp=utcnow)
+        DBSession.flush()
+        supitems = [(u"testhost", None), (u"testhost2", None),
+                    (u"testhost", u"testsvc"), (u"testhost", u"testsvc2"),
+                    (None, u"testhls"), (u"unknown", None)]
+        self.assertEqual(count_refreshed(supitems, since), 3)
+        self.assertEqual(count_refreshed([], since), 0)
+        timestamps = get_state_timestamps(supitems)
+        self.assertEqual(len(timestamps), 5)
+        self.assertEqual(timestamps[(u"testhost2", None)], old)
+        self.assertEqual(timestamps[(None, u"testhls")], utcnow)
+        # Un lot de requêtes par tranche d'éléments.
+        self.assertEqual(len(_state_timestamp_queries(supitems, 2)), 4)
+        self.assertEqual(sum([ query.count() for query
+                               in _state_timestamp_queries(supitems, 2) ]), 5)
+
+    def test_state_timestamps_many(self):
+        """Dates des états d'un grand nombre d'éléments"""
+        utcnow = datetime.utcnow()
+        host = df.add_host("testhost")
+        df.add_host_state(host, "UP", timestamp=utcnow)
+        DBSession.flush()
+        supitems = [(u"testhost", None)] + \
+                   [ (u"testhost", u"svc%d" % i) for i in range(1200) ] + \
+                   [ (None, u"hls%d" % i) for i in range(1200) ]
+        self.assertEqual(get_state_timestamps(supitems),
+                         {(u"testhost", None): utcnow})
+        self.assertEqual(count_refreshed(supitems,
+                                         utcnow - timedelta(minutes=1)), 1)
+
+    def test_parallel(self):
+        """Exécution séparée des branches de la requête"""
+        utcnow = datetime.utcnow()
+        age = utcnow - timedelta(minutes=42)
+        host = df.add_host("testhost")
+        df.add_ventilation(host, "collector", "nagios")
+        for i in range(3):
+            svc = df.add_lowlevelservice(host, "testsvc%d" % i)
+            df.add_svc_state(svc, "CRITICAL", timestamp=age)
+        # Ce service est remonté par deux branches de la requête.
+        e = df.add_event(svc, "WARNING", "dummy")
+        df.add_correvent([e])
+        DBSession.flush()
+        expected = sorted(get_desync(utcnow, utcnow))
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(sorted(get_desync_parallel(utcnow, utcnow)),
+                         expected)
+        self.assertEqual(len(get_desync_parallel(utcnow, utcnow, 2)), 2)
+        # La limite est appliquée à chaque branche par la base de données.
+        params = (utcnow, utcnow, None, None, None, None, None, None)
+        self.assertEqual(len(_branch_rows("old_lls", params)), 3)
+        self.assertEqual(len(_branch_rows("old_lls", params, 2)), 2)
+        # Durée de chaque branche, même sans exécution parallèle.
+        metrics = RunMetrics()
+        get_desync_parallel(utcnow, utcnow, workers=1, metrics=metrics)
+        self.assertTrue("branch_old_lls" in metrics.timings)
+        self.assertTrue("branch_event_services" in metrics.timings)
+
+    def test_parallel_shard_limit(self):
+        """Limite des branches avec le cache et une part des collecteurs"""
+        df.add_vigiloserver("collector2")
+        utcnow = datetime.utcnow()
+        for i in range(6):
+            host = df.add_host("other%d" % i)
+            df.add_ventilation(host, "collector", "nagios")
+            df.add_host_state(host, "DOWN",
+                              timestamp=utcnow - timedelta(hours=2))
+        for i in range(3):
+            host = df.add_host("mine%d" % i)
+            df.add_ventilation(host, "collector2", "nagios")
+            df.add_host_state(host, "DOWN",
+                              timestamp=utcnow - timedelta(hours=1))
+        DBSession.flush()
+        refs = ReferenceCache()
+        refs.refresh()
+        shard = Shard(servers=[u"collector2"])
+        results = get_desync_parallel(utcnow, utcnow, 2, shard=shard,
+                                      refs=refs)
+        self.assertEqual(len(results), 2)
+        for supitem in results:
+            self.assertEqual(supitem.vigiloserver, u"collector2")
+
+    def test_cte(self):
+        """Résultats identiques avec et sans CTE"""
+        utcnow = datetime.utcnow()
+        age = utcnow - timedelta(minutes=42)
+        for i in range(3):
+            host = df.add_host("testhost%d" % i)
+            df.add_ventilation(host, "collector", "nagios")
+            svc = df.add_lowlevelservice(host, "testsvc")
+            df.add_svc_state(svc, "CRITICAL", timestamp=age)
+        host = df.add_host("downhost")
+        df.add_ventilation(host, "collector", "nagios")
+        df.add_host_state(host, "DOWN", timestamp=age)
+        svc = df.add_lowlevelservice(host, "testsvc")
+        df.add_svc_state(svc, "CRITICAL", timestamp=age)
+        e = df.add_event(svc, "WARNING", "dummy")
+        df.add_correvent([e])
+        DBSession.flush()
+        expected = sorted(get_desync(utcnow, utcnow, use_cte=False))
+        self.assertEqual(len(expected), 4)
+        self.assertEqual(sorted(get_desync(utcnow, utcnow, use_cte=True)),
+                         expected)
+
+    def test_priority(self):
+        """Classement des éléments par priorité"""
+        utcnow = datetime.utcnow()
+        host = df.add_host("testhost")
+        df.add_ventilation(host, "collector", "nagios")
+        # Du moins prioritaire au plus prioritaire.
+        for name, state, minutes in (("recent_warning", "WARNING", 50),
+                                     ("old_warning", "WARNING", 90),
+                                     ("critical", "CRITICAL", 50)):
+            svc = df.add_lowlevelservice(host, name)
+            df.add_svc_state(svc, state,
+                             timestamp=utcnow - timedelta(minutes=minutes))
+        svc = df.add_lowlevelservice(host, "with_correvent")
+        df.add_svc_state(svc, "WARNING",
+                         timestamp=utcnow - timedelta(minutes=50))
+        e = df.add_event(svc, "CRITICAL", "dummy")
+        df.add_correvent([e])
+        DBSession.flush()
+        time_limit = utcnow - timedelta(minutes=42)
+        results = get_desync(time_limit, time_limit, priority=True)
+        # Le service avec un événement corrélé est remonté par deux
+        # branches de la requête, mais n'apparaît qu'une fois.
+        self.assertEqual([ r.servicename for r in results ],
+                         ["with_correvent", "critical", "old_warning",
+                          "recent_warning"])
+        results = get_desync(time_limit, time_limit, 2, priority=True)
+        self.assertEqual([ r.servicename for r in results ],
+                         ["with_correvent", "critical"])
+        results = get_desync(time_limit, time_limit, 2, use_cte=True,
+                             priority=True)
+        self.assertEqual([ r.servicename for r in results ],
+                         ["with_correvent", "critical"])
+
     def test_events_service(self):
         """État différent entre la table State et Event pour un service"""
         host = df.add_host("testhost")
@@ -392,3 +730,75 @@ class TestRequest(unittest.TestCase):
         self.assertEqual(results[0].servicename, "testsvc")
         self.assertEqual(results[0].vigiloserver, None)
 
+    def _add_hls_dependency(self, dependent, depended):
+        group = tables.DependencyGroup(iddependent=dependent.idsupitem,
+                                       operator=u'&', role=u'hls')
+        DBSession.add(group)
+        DBSession.flush()
+        DBSession.add(tables.Dependency(idgroup=group.idgroup,
+                                        idsupitem=depended.idsupitem,
+                                        distance=1))
+        DBSession.flush()
+
+    def test_hls_dependencies(self):
+        """Services de haut niveau dont une dépendance a changé"""
+        utcnow = datetime.utcnow()
+        limit = utcnow - timedelta(minutes=42)
+        old = utcnow - timedelta(hours=2)
+        changed = utcnow - timedelta(hours=1)
+        host = df.add_host("testhost")
+        lls = df.add_lowlevelservice(host, "testservice")
+        df.add_svc_state(lls, "CRITICAL", timestamp=changed)
+        lls2 = df.add_lowlevelservice(host, "testservice2")
+        df.add_svc_state(lls2, "CRITICAL", timestamp=utcnow)
+        # Dépendance modifiée après le service de haut niveau.
+        leaf = df.add_highlevelservice("leaf")
+        df.add_svc_state(leaf, "OK", timestamp=old)
+        self._add_hls_dependency(leaf, lls)
+        # Dépend de "leaf" : mise à jour par propagation.
+        parent = df.add_highlevelservice("parent")
+        df.add_svc_state(parent, "OK", timestamp=old)
+        self._add_hls_dependency(parent, leaf)
+        self._add_hls_dependency(parent, lls)
+        # Dépendance modifiée trop récemment.
+        recent = df.add_highlevelservice("recent")
+        df.add_svc_state(recent, "OK", timestamp=old)
+        self._add_hls_dependency(recent, lls2)
+        # Aucune dépendance modifiée : l'état est à jour.
+        stable = df.add_highlevelservice("stable")
+        df.add_svc_state(stable, "OK", timestamp=utcnow - timedelta(hours=1))
+        self._add_hls_dependency(stable, host)
+        # État initial.
+        initial = df.add_highlevelservice("initial")
+        df.add_svc_state(initial, "UNKNOWN", timestamp=old)
+        # État non-OK : réémis par Nagios.
+        critical = df.add_highlevelservice("critical")
+        df.add_svc_state(critical, "CRITICAL", timestamp=old)
+        self._add_hls_dependency(critical, lls)
+
+        postponed = []
+        results = get_hls_by_dependencies(limit, postpone=postponed.append)
+        self.assertEqual([ (r.hostname, r.servicename, r.vigiloserver)
+                           for r in results ],
+                         [(None, u"initial", None), (None, u"leaf", None)])
+        self.assertEqual([ r.servicename for r in postponed ], [u"parent"])
+
+        # Recherche incrémentale : le changement a déjà été pris en compte.
+        results = get_hls_by_dependencies(limit, changed)
+        self.assertEqual(results, [])
+        results = get_hls_by_dependencies(limit,
+                                          changed - timedelta(minutes=1))
+        self.assertEqual([ r.servicename for r in results ], [u"leaf"])
+
+    def test_hls_dependencies_max_events(self):
+        """La limite max_events s'applique aux services de haut niveau"""
+        utcnow = datetime.utcnow()
+        for i in range(3):
+            hls = df.add_highlevelservice("hls%d" % i)
+            df.add_svc_state(hls, "UNKNOWN",
+                             timestamp=utcnow - timedelta(hours=2))
+        options = {"hls_dependencies": "True", "max_events": "2"}
+        with patch.dict(settings["connector-syncevents"], options):
+            results = list(find_desync(utcnow))
+        self.assertEqual([ r.servicename for r in results ],
+                         [u"hls0", u"hls1"])
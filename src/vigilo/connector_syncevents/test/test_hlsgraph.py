@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste l'ordonnancement des services de haut niveau d'après leurs dépendances
+"""
+import unittest
+from collections import OrderedDict
+
+from mock import patch
+
+from vigilo.connector_syncevents.records import SupItem
+from vigilo.connector_syncevents.hlsgraph import order_hls, _cycle_members
+
+
+
+def make_candidates(*ids):
+    return OrderedDict((i, SupItem(None, u"hls%d" % i, None)) for i in ids)
+
+
+def names(supitems):
+    return [ supitem.servicename for supitem in supitems ]
+
+
+
+class TestOrderHls(unittest.TestCase):
+
+    def test_no_dependencies(self):
+        """Services sans dépendance de haut niveau : ordre alphabétique"""
+        supitems, deferred = order_hls(make_candidates(3, 1, 2), [])
+        self.assertEqual(names(supitems), [u"hls1", u"hls2", u"hls3"])
+        self.assertEqual(deferred, [])
+
+    def test_topological_order(self):
+        """Les dépendances sont envoyées avant les services dépendants"""
+        # 1 dépend de 2, qui dépend de 3. Seuls 1 et 4 sont à synchroniser,
+        # ainsi que 5 qui dépend de 6 (hors candidats).
+        edges = [(1, 2), (2, 3), (5, 6), (4, 6)]
+        supitems, deferred = order_hls(make_candidates(1, 4, 5), edges)
+        # 4 et 5 sont à une distance de 1 d'une feuille, 1 à une distance 2.
+        self.assertEqual(names(supitems), [u"hls4", u"hls5", u"hls1"])
+        self.assertEqual(deferred, [])
+
+    def test_redundant_parent(self):
+        """Un service dépendant d'un service synchronisé est écarté"""
+        # 1 dépend de 2, qui dépend de 3 ; 4 ne dépend de rien.
+        edges = [(1, 2), (2, 3)]
+        supitems, deferred = order_hls(make_candidates(1, 3, 4), edges)
+        self.assertEqual(names(supitems), [u"hls3", u"hls4"])
+        self.assertEqual(names(deferred), [u"hls1"])
+
+    def test_cycle(self):
+        """Les services pris dans un cycle sont envoyés en dernier"""
+        edges = [(1, 2), (2, 1), (3, 4)]
+        supitems, deferred = order_hls(make_candidates(1, 3, 5), edges)
+        self.assertEqual(names(supitems), [u"hls5", u"hls3", u"hls1"])
+        self.assertEqual(deferred, [])
+
+    def test_cycle_members(self):
+        """Seuls les services pris dans un cycle en font partie"""
+        # 1 <-> 2 forment un cycle, 3 en dépend, 4 est une feuille
+        # et 5 -> 6 -> 5 forment un second cycle.
+        children = {1: set([2]), 2: set([1, 4]), 3: set([1]),
+                    5: set([6]), 6: set([5])}
+        self.assertEqual(_cycle_members([1, 2, 3, 5, 6], children),
+                         set([1, 2, 5, 6]))
+        self.assertEqual(_cycle_members([3], children), set())
+        # Le service 3, qui dépend du cycle, n'en fait pas partie.
+        with patch("vigilo.connector_syncevents.hlsgraph.LOGGER") as logger:
+            order_hls(make_candidates(1, 3), [(1, 2), (2, 1), (3, 1)])
+        self.assertEqual(logger.warning.call_args[0][1],
+                         {"cycle": 2, "unordered": 2})
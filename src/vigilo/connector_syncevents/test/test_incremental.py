@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste la recherche incrémentale des éléments désynchronisés
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from vigilo.connector_syncevents.state import StateFile
+from vigilo.connector_syncevents.incremental import IncrementalScan
+
+
+
+class DBResult(object):
+    def __init__(self, hostname, servicename, vigiloserver):
+        self.hostname = hostname
+        self.servicename = servicename
+        self.vigiloserver = vigiloserver
+
+
+
+class TestStateFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test-syncevents-")
+        self.path = os.path.join(self.tmpdir, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_missing(self):
+        """Fichier d'état absent"""
+        state_file = StateFile(self.path)
+        state_file.load()
+        self.assertEqual(state_file.data, {})
+
+    def test_invalid(self):
+        """Fichier d'état invalide"""
+        with open(self.path, "w") as f:
+            f.write("{not json")
+        state_file = StateFile(self.path)
+        state_file.load()
+        self.assertEqual(state_file.data, {})
+
+    def test_save_load(self):
+        """Enregistrement puis chargement du fichier d'état"""
+        state_file = StateFile(self.path)
+        state_file.section("test")["key"] = u"value"
+        state_file.save()
+        state_file = StateFile(self.path)
+        state_file.load()
+        self.assertEqual(state_file.section("test"), {"key": u"value"})
+        self.assertEqual(os.listdir(self.tmpdir), ["state.json"])
+
+
+
+class TestIncrementalScan(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {}
+        self.scan = IncrementalScan(self.state, timedelta(minutes=60))
+        self.now = datetime(2020, 1, 1, 12, 0, 0)
+        self.items = [
+            DBResult(u"host1", None, u"collector"),
+            DBResult(u"host1", u"svc1", u"collector"),
+            DBResult(None, u"hls1", None),
+        ]
+
+    def test_first_scan(self):
+        """La première recherche est complète"""
+        self.assertEqual(self.scan.start(self.now), None)
+        self.assertEqual(list(self.scan.filter(self.items)), self.items)
+        self.scan.finish()
+        self.assertEqual(self.state["last_scan"], "2020-01-01T12:00:00")
+
+    def test_incremental(self):
+        """Les recherches suivantes sont incrémentales"""
+        self.scan.start(self.now)
+        list(self.scan.filter(self.items))
+        self.scan.finish()
+        now = self.now + timedelta(minutes=10)
+        self.assertEqual(self.scan.start(now), self.now)
+        # Les éléments déjà demandés sont ignorés.
+        new = DBResult(u"host2", None, u"collector")
+        self.assertEqual(list(self.scan.filter(self.items + [new])), [new])
+
+    def test_incomplete(self):
+        """La date de référence n'avance pas si la recherche est incomplète"""
+        self.scan.start(self.now)
+        results = self.scan.filter(self.items)
+        next(results)
+        self.scan.finish()
+        self.assertFalse("last_scan" in self.state)
+        # Les éléments non parcourus seront repris.
+        self.assertEqual(self.scan.start(self.now + timedelta(minutes=10)),
+                         None)
+        self.assertEqual(list(self.scan.filter(self.items)), self.items[1:])
+
+    def test_expiry(self):
+        """Les demandes expirées sont renouvelées"""
+        self.scan.start(self.now)
+        list(self.scan.filter([]))
+        self.scan.finish()
+        now = self.now + timedelta(minutes=10)
+        self.scan.start(now)
+        list(self.scan.filter(self.items))
+        self.scan.finish()
+
+        # Les demandes ne sont pas encore expirées.
+        now2 = now + timedelta(minutes=30)
+        self.assertEqual(self.scan.start(now2), now)
+        self.assertEqual(list(self.scan.filter(self.items)), [])
+        self.scan.finish()
+
+        # La fenêtre de recherche est élargie
+        # pour retrouver les éléments concernés.
+        now3 = now + timedelta(minutes=60)
+        self.assertEqual(self.scan.start(now3), self.now)
+        self.assertEqual(list(self.scan.filter(self.items)), self.items)
+
+    def test_truncated(self):
+        """Des éléments écartés rendent la recherche incomplète"""
+        self.scan.start(self.now)
+        events = list(self.scan.exclude(self.items))[:1]
+        result = list(self.scan.record(events, lambda: True))
+        self.assertEqual(len(result), 1)
+        self.scan.mark(result)
+        self.scan.finish()
+        self.assertFalse("last_scan" in self.state)
+        self.assertEqual(len(self.state["asked"]), 1)
+
+    def test_released(self):
+        """Un envoi interrompu rend la recherche incomplète"""
+        self.scan.start(self.now)
+        result = list(self.scan.record(self.scan.exclude(self.items)))
+        self.scan.mark(result[:1])
+        self.scan.release(result[1:])
+        self.scan.finish()
+        self.assertFalse("last_scan" in self.state)
+
+    def test_unpublished(self):
+        """Seuls les éléments publiés sont mémorisés"""
+        self.scan.start(self.now)
+        result = list(self.scan.record(self.scan.exclude(self.items)))
+        self.assertEqual(result, self.items)
+        self.scan.mark(result[:1])
+        self.scan.finish()
+        self.scan.start(self.now + timedelta(minutes=10))
+        self.assertEqual(list(self.scan.exclude(self.items)),
+                         self.items[1:])
+
+    def test_full_scan_interval(self):
+        """Une recherche complète est effectuée périodiquement"""
+        scan = IncrementalScan(self.state, timedelta(minutes=60),
+                               timedelta(hours=24))
+        self.assertEqual(scan.start(self.now), None)
+        list(scan.filter([]))
+        scan.finish()
+        now = self.now + timedelta(hours=12)
+        self.assertEqual(scan.start(now), self.now)
+        list(scan.filter([]))
+        scan.finish()
+        # La recherche complète précédente date de plus de 24 heures.
+        self.assertEqual(scan.start(self.now + timedelta(hours=24)), None)
+        list(scan.filter([]))
+        scan.finish()
+        self.assertEqual(self.state["last_full_scan"], "2020-01-02T12:00:00")
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste la vérification des index recommandés
+"""
+import unittest
+
+from vigilo.common.conf import settings
+settings.load_module(__name__)
+from vigilo.models.configure import configure_db
+configure_db(settings['database'], 'sqlalchemy_')
+
+from vigilo.models.session import DBSession, metadata
+from vigilo.models import tables
+
+from vigilo.connector_syncevents.indexes import IndexSpec, check_index, \
+                                                get_existing_indexes, \
+                                                get_recommended_indexes
+
+
+
+class TestIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.spec = IndexSpec("ix_test", tables.State.__table__,
+                              ["timestamp"], where="state NOT IN (1, 2)",
+                              fallback=["state", "timestamp"])
+
+    def tearDown(self):
+        DBSession.rollback()
+        DBSession.expunge_all()
+        metadata.drop_all()
+
+    def test_partial(self):
+        """Index partiel recommandé avec PostgreSQL"""
+        self.assertEqual(check_index(self.spec, [], "postgresql"), "missing")
+        self.assertEqual(check_index(self.spec, [(["timestamp"], None)],
+                                     "postgresql"), "full")
+        self.assertEqual(check_index(self.spec,
+                                     [(["state", "timestamp"], None)],
+                                     "postgresql"), "full")
+        self.assertEqual(check_index(self.spec,
+                                     [(["timestamp"], "state <> 1")],
+                                     "postgresql"), "ok")
+        self.assertEqual(self.spec.ddl("postgresql"),
+                         "CREATE INDEX CONCURRENTLY ix_test ON %s "
+                         "(timestamp) WHERE state NOT IN (1, 2);"
+                         % tables.State.__table__.name)
+
+    def test_fallback(self):
+        """Index complet avec les autres bases de données"""
+        self.assertEqual(check_index(self.spec, [(["state"], None)],
+                                     "sqlite"), "missing")
+        # Seul le début de l'index doit correspondre.
+        self.assertEqual(check_index(self.spec,
+                                     [(["state", "timestamp", "x"], None)],
+                                     "sqlite"), "ok")
+        self.assertEqual(self.spec.ddl("sqlite"),
+                         "CREATE INDEX ix_test ON %s (state, timestamp);"
+                         % tables.State.__table__.name)
+
+    def test_schema(self):
+        """Inspection du schéma de la base de données"""
+        metadata.create_all()
+        DBSession.add(tables.StateName(statename=u'OK', order=1))
+        DBSession.add(tables.StateName(statename=u'UP', order=1))
+        DBSession.flush()
+        bind = DBSession.get_bind()
+        dialect = bind.dialect.name
+        for spec in get_recommended_indexes():
+            existing = get_existing_indexes(bind, spec.table.name)
+            if check_index(spec, existing, dialect) == "ok":
+                continue
+            bind.execute(spec.ddl(dialect))
+            existing = get_existing_indexes(bind, spec.table.name)
+            self.assertEqual(check_index(spec, existing, dialect), "ok",
+                             spec.name)
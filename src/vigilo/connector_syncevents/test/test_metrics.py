@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste les mesures relatives à une exécution du connecteur
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from vigilo.common.conf import settings
+from vigilo.connector_syncevents.metrics import RunMetrics
+from vigilo.connector_syncevents.shard import Shard
+from vigilo.connector_syncevents.main import report_metrics
+
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = RunMetrics(self.clock)
+
+    def test_stage(self):
+        """Mesure de la durée d'une étape"""
+        with self.metrics.stage("lock"):
+            self.clock.now += 2
+        with self.metrics.stage("lock"):
+            self.clock.now += 1
+        self.assertEqual(self.metrics.timings["lock"], 3)
+
+    def test_timed_iter(self):
+        """Seul le temps passé à obtenir les éléments est mesuré"""
+        def rows():
+            for i in range(3):
+                self.clock.now += 1
+                yield i
+        for _row in self.metrics.timed_iter("fetch", rows(), "rows"):
+            # Traitement de l'élément, non comptabilisé.
+            self.clock.now += 10
+        self.assertEqual(self.metrics.timings["fetch"], 3)
+        self.assertEqual(self.metrics.counts["rows"], 3)
+
+    def test_perf_messages(self):
+        """Messages de performance publiés sur le bus"""
+        self.metrics.add_time("lock", 0.5)
+        self.metrics.add_count("requests", 4)
+        messages = self.metrics.perf_messages(u"localhost", u"syncevents",
+                                              "perf")
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0], {
+            "type": "perf",
+            "timestamp": 1000,
+            "host": u"localhost",
+            "datasource": u"syncevents-time-lock",
+            "value": 0.5,
+            "exchange": "perf",
+        })
+        self.assertEqual(messages[1]["datasource"],
+                         u"syncevents-count-requests")
+        self.assertEqual(messages[1]["value"], 4)
+
+    def test_dump(self):
+        """Enregistrement des mesures au format JSON"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "metrics.json")
+            self.metrics.add_time("fetch", 1.5)
+            self.metrics.dump(path)
+            with open(path) as dump:
+                data = json.load(dump)
+            self.assertEqual(data["timings"], {"fetch": 1.5})
+            self.assertEqual(data["timestamp"], 1000)
+            self.assertEqual(os.listdir(tmpdir), ["metrics.json"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_report_shard(self):
+        """Chaque part enregistre ses mesures dans son propre fichier"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "metrics.json")
+            with patch.dict(settings["connector-syncevents"],
+                            {"metrics_file": path, "perf_metrics": "False"}):
+                report_metrics(self.metrics, Shard.parse("2/4"))
+                report_metrics(self.metrics)
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ["metrics-shard2of4.json", "metrics.json"])
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste les bus locaux
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+from vigilo.connector_syncevents.publishers import LoopbackPublisher, \
+                                                   FilePublisher, \
+                                                   PublishError, \
+                                                   get_publisher
+from vigilo.connector_syncevents.sender import SyncSender
+
+
+
+class DBResult(object):
+    def __init__(self, hostname, servicename, vigiloserver):
+        self.hostname = hostname
+        self.servicename = servicename
+        self.vigiloserver = vigiloserver
+
+
+
+class TestLoopbackPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_latency(self):
+        """Les messages sont acquittés au bout du délai configuré"""
+        publisher = LoopbackPublisher(latency=2, keep=True, clock=self.clock)
+        acked = []
+        publisher.write({"n": 1}).addCallback(acked.append)
+        self.clock.advance(1)
+        self.assertEqual(acked, [])
+        self.clock.advance(1)
+        self.assertEqual(acked, [None])
+        self.assertEqual(publisher.messages, [{"n": 1}])
+
+    def test_backpressure(self):
+        """Au-delà de max_pending, les messages sont mis en attente"""
+        publisher = LoopbackPublisher(latency=1, max_pending=2,
+                                      clock=self.clock)
+        acked = []
+        for _i in range(5):
+            publisher.write({}).addCallback(acked.append)
+        self.assertEqual(publisher.pending, 2)
+        self.assertEqual(publisher.throttled, 3)
+        self.clock.advance(1)
+        self.assertEqual(len(acked), 2)
+        self.clock.advance(1)
+        self.assertEqual(len(acked), 4)
+        self.clock.advance(1)
+        self.assertEqual(len(acked), 5)
+        self.assertEqual(publisher.max_queued, 3)
+
+    def test_failures(self):
+        """Une partie des publications échoue"""
+        publisher = LoopbackPublisher(failure_rate=1, clock=self.clock)
+        errors = []
+        publisher.write({}).addErrback(errors.append)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].check(PublishError))
+        self.assertEqual(publisher.failed, 1)
+
+    def test_pipelining(self):
+        """Messages envoyés simultanément par SyncSender"""
+        publisher = LoopbackPublisher(latency=1, clock=self.clock)
+        to_sync = [ DBResult("host%d" % i, None, "collector")
+                    for i in range(10) ]
+        sender = SyncSender(to_sync, max_inflight=5)
+        sender.publisher = publisher
+        done = []
+        sender.askNagios(None).addCallback(done.append)
+        self.clock.advance(1)
+        self.assertEqual(done, [])
+        self.clock.advance(1)
+        self.assertEqual(len(done), 1)
+        self.assertEqual(publisher.published, 10)
+
+    def test_sender_failure(self):
+        """Une erreur de publication interrompt l'envoi"""
+        publisher = LoopbackPublisher(failure_rate=1, clock=self.clock)
+        sender = SyncSender([DBResult("host", None, "collector")])
+        sender.publisher = publisher
+        errors = []
+        sender.askNagios(None).addErrback(errors.append)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].check(PublishError))
+
+
+
+class TestFilePublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="syncevents-test-")
+        self.path = os.path.join(self.tmpdir, "messages.ndjson")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ndjson(self):
+        """Un message JSON par ligne"""
+        publisher = FilePublisher(self.path)
+        sender = SyncSender([DBResult("host", None, "collector"),
+                             DBResult("host", "svc", "collector")])
+        sender.publisher = publisher
+        done = []
+        sender.askNagios(None).addCallback(done.append)
+        publisher.close()
+        self.assertEqual(len(done), 1)
+        with open(self.path) as output:
+            messages = [ json.loads(line) for line in output ]
+        self.assertEqual([ message["value"] for message in messages ],
+                         ["host;0;vigilo;syncevents",
+                          "host;svc;0;vigilo;syncevents"])
+        self.assertEqual(messages[0]["routing_key"], "collector")
+
+
+
+class TestGetPublisher(unittest.TestCase):
+
+    def test_loopback(self):
+        """Description d'un bus en mémoire"""
+        publisher = get_publisher("loopback:latency=0.5,max_pending=10")
+        self.assertTrue(isinstance(publisher, LoopbackPublisher))
+        self.assertEqual(publisher.latency, 0.5)
+        self.assertEqual(publisher.max_pending, 10)
+        self.assertEqual(get_publisher("loopback").latency, 0)
+
+    def test_invalid(self):
+        """Descriptions invalides"""
+        for spec in ("amqp", "file", "file:", "loopback:latency",
+                     "loopback:unknown=1", "loopback:latency=abc"):
+            self.assertRaises(ValueError, get_publisher, spec)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste la représentation compacte des éléments à synchroniser
+"""
+import sys
+import unittest
+
+from vigilo.connector_syncevents.records import SupItem, StringPool, compact
+
+
+
+class DBResult(object):
+    def __init__(self, hostname, servicename, vigiloserver):
+        self.hostname = hostname
+        self.servicename = servicename
+        self.vigiloserver = vigiloserver
+
+
+
+def make_rows(count):
+    # Chaque résultat de requête dispose de ses propres chaînes,
+    # même lorsque leurs valeurs sont identiques.
+    return [ DBResult(u"".join([u"host", u"%d" % (i // 10)]),
+                      u"".join([u"service", u"%d" % (i % 10)]),
+                      u"".join([u"collector", u"%d" % (i % 3)]))
+             for i in range(count) ]
+
+
+def memory_usage(items):
+    """Mémoire occupée par des éléments et les chaînes qu'ils référencent."""
+    total = 0
+    strings = {}
+    for item in items:
+        total += sys.getsizeof(item)
+        if getattr(type(item), "__slots__", None) is None:
+            total += sys.getsizeof(vars(item))
+        for value in (item.hostname, item.servicename, item.vigiloserver):
+            strings[id(value)] = sys.getsizeof(value)
+    return total + sum(strings.values())
+
+
+
+class TestRecords(unittest.TestCase):
+
+    def test_compact(self):
+        """Conversion des résultats de requête"""
+        rows = [DBResult(u"host", u"svc", u"collector"),
+                DBResult(None, u"hls", None)]
+        items = list(compact(rows))
+        self.assertEqual(items, [(u"host", u"svc", u"collector"),
+                                 (None, u"hls", None)])
+        self.assertEqual(items[0].hostname, u"host")
+        self.assertEqual(items[1].vigiloserver, None)
+        # Pas de dictionnaire d'attributs par instance.
+        self.assertEqual(SupItem.__slots__, ())
+
+    def test_string_pool(self):
+        """Les chaînes identiques sont partagées"""
+        pool = StringPool()
+        rows = make_rows(100)
+        items = list(compact(rows, pool))
+        self.assertTrue(items[0].hostname is items[9].hostname)
+        self.assertTrue(items[0].servicename is items[10].servicename)
+        self.assertEqual(len(pool), 10 + 10 + 3)
+
+    def test_memory(self):
+        """La représentation compacte réduit la mémoire occupée"""
+        rows = make_rows(10000)
+        before = memory_usage(rows)
+        after = memory_usage(list(compact(rows)))
+        # Gain d'au moins 50 % (en pratique, plutôt 80 %).
+        self.assertTrue(after * 2 < before, (before, after))
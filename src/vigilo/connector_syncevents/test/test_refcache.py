@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste le cache des données de référence
+"""
+import unittest
+
+from vigilo.common.conf import settings
+settings.load_module(__name__)
+from vigilo.models.configure import configure_db
+configure_db(settings['database'], 'sqlalchemy_')
+
+from vigilo.models.session import DBSession, metadata
+from vigilo.models import tables
+from vigilo.models.demo import functions as df
+
+from vigilo.connector_syncevents.refcache import ReferenceCache, \
+                                                 CONF_VERSION_NAME
+
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+
+class TestReferenceCache(unittest.TestCase):
+
+    def setUp(self):
+        metadata.create_all()
+        DBSession.add(tables.StateName(statename=u'OK', order=1))
+        DBSession.add(tables.StateName(statename=u'UP', order=1))
+        df.add_application("nagios")
+        df.add_vigiloserver("collector")
+        self.host = df.add_host("testhost")
+        df.add_ventilation(self.host, "collector", "nagios")
+        self.version = tables.Version(name=CONF_VERSION_NAME, version=u"1")
+        DBSession.add(self.version)
+        DBSession.flush()
+        self.clock = Clock()
+        self.refs = ReferenceCache(600, clock=self.clock)
+        self.refs.refresh()
+
+    def tearDown(self):
+        DBSession.rollback()
+        DBSession.expunge_all()
+        metadata.drop_all()
+
+    def _add_collector(self):
+        df.add_vigiloserver("collector2")
+        df.add_ventilation(self.host, "collector2", "nagios")
+        DBSession.flush()
+
+    def test_lookups(self):
+        """Valeurs des états et ventilation"""
+        self.assertEqual(self.refs.state_value(u'UP'),
+                         tables.StateName.statename_to_value(u'UP'))
+        self.assertEqual(self.refs.ventilation(),
+                         {self.host.idhost: [u"collector"]})
+
+    def test_kept(self):
+        """Les données sont conservées d'une recherche à l'autre"""
+        self.refs.ventilation()
+        self._add_collector()
+        self.clock.now += 599
+        self.refs.refresh()
+        self.assertEqual(self.refs.ventilation(),
+                         {self.host.idhost: [u"collector"]})
+
+    def test_ttl(self):
+        """Les données sont rechargées après expiration"""
+        self.refs.ventilation()
+        self._add_collector()
+        self.clock.now += 600
+        self.refs.refresh()
+        self.assertEqual(sorted(self.refs.ventilation()[self.host.idhost]),
+                         [u"collector", u"collector2"])
+
+    def test_conf_version(self):
+        """Les données sont rechargées après un déploiement"""
+        self.refs.ventilation()
+        self._add_collector()
+        self.version.version = u"2"
+        DBSession.flush()
+        self.refs.refresh()
+        self.assertEqual(sorted(self.refs.ventilation()[self.host.idhost]),
+                         [u"collector", u"collector2"])
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste la répartition des demandes entre les collecteurs
+"""
+import unittest
+
+from vigilo.connector_syncevents.scheduler import FairScheduler, \
+                                                  TokenBucket, \
+                                                  CollectorRateLimiter
+
+
+
+class DBResult(object):
+    def __init__(self, hostname, servicename, vigiloserver):
+        self.hostname = hostname
+        self.servicename = servicename
+        self.vigiloserver = vigiloserver
+
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+
+class TestFairScheduler(unittest.TestCase):
+
+    def setUp(self):
+        # Un collecteur en panne avec de nombreux éléments désynchronisés,
+        # et deux collecteurs n'en ayant que quelques-uns.
+        self.items = [ DBResult(u"host%d" % i, u"svc", u"failed")
+                       for i in range(100) ]
+        self.items += [ DBResult(u"host%d" % i, u"svc", u"collector%d" % c)
+                        for c in range(2) for i in range(3) ]
+
+    def test_round_robin(self):
+        """Les collecteurs sont servis à tour de rôle"""
+        scheduler = FairScheduler(shuffle=False)
+        result = list(scheduler.schedule(self.items))
+        self.assertEqual(len(result), 106)
+        self.assertEqual([ r.vigiloserver for r in result[:9] ],
+                         [u"collector0", u"collector1", u"failed"] * 3)
+        self.assertEqual(scheduler.dropped, 0)
+
+    def test_max_events(self):
+        """La limite globale ne pénalise pas les petits collecteurs"""
+        scheduler = FairScheduler()
+        result = list(scheduler.schedule(self.items, 9))
+        self.assertEqual(len(result), 9)
+        for collector in (u"collector0", u"collector1", u"failed"):
+            self.assertEqual(
+                len([ r for r in result if r.vigiloserver == collector ]), 3)
+        self.assertEqual(scheduler.dropped, 97)
+
+    def test_max_per_collector(self):
+        """Limite du nombre de demandes par collecteur"""
+        scheduler = FairScheduler(max_per_collector=5)
+        result = list(scheduler.schedule(self.items))
+        self.assertEqual(len(result), 11)
+        self.assertEqual(
+            len([ r for r in result if r.vigiloserver == u"failed" ]), 5)
+        self.assertEqual(scheduler.dropped, 95)
+
+    def test_hls(self):
+        """Les services de haut niveau forment un groupe à part"""
+        items = [ DBResult(None, u"hls%d" % i, None) for i in range(2) ]
+        items.append(DBResult(u"host", None, u"collector"))
+        result = list(FairScheduler(shuffle=False).schedule(items))
+        self.assertEqual([ r.vigiloserver for r in result ],
+                         [None, u"collector", None])
+
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst(self):
+        """Rafale puis débit moyen"""
+        clock = Clock()
+        bucket = TokenBucket(10, 2, clock)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        self.assertAlmostEqual(bucket.reserve(), 0.2)
+        clock.now = 1.0
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_per_collector(self):
+        """Un seau par collecteur"""
+        limiter = CollectorRateLimiter(1, 1, Clock())
+        self.assertEqual(limiter.reserve(u"collector1"), 0)
+        self.assertEqual(limiter.reserve(u"collector2"), 0)
+        self.assertAlmostEqual(limiter.reserve(u"collector1"), 1.0)
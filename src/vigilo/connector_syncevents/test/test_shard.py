@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste la répartition de la resynchronisation entre plusieurs instances
+"""
+import unittest
+
+from vigilo.connector_syncevents.shard import Shard
+
+
+
+class TestShard(unittest.TestCase):
+
+    def test_parse(self):
+        """Lecture de la part traitée"""
+        shard = Shard.parse("2/4")
+        self.assertEqual((shard.index, shard.count), (1, 4))
+        self.assertFalse(shard.with_hls)
+        self.assertTrue(Shard.parse("1/4").with_hls)
+        for spec in ("0/4", "5/4", "a/b", "2"):
+            self.assertRaises(ValueError, Shard.parse, spec)
+
+    def test_path(self):
+        """Fichiers propres à chaque part"""
+        self.assertEqual(Shard.parse("2/4").path("/var/lib/state.json"),
+                         "/var/lib/state-shard2of4.json")
+        self.assertEqual(Shard.parse("2/4").path("/var/lock/lock"),
+                         "/var/lock/lock-shard2of4")
+        self.assertEqual(Shard.parse(None).path("/var/lock/lock"),
+                         "/var/lock/lock")
+        # Instances traitant des listes distinctes de collecteurs.
+        first = Shard.parse(None, [u"collector1", u"collector2"])
+        second = Shard.parse(None, [u"collector3"])
+        self.assertNotEqual(first.path("/var/lock/lock"),
+                            second.path("/var/lock/lock"))
+        self.assertEqual(first.path("/var/lock/lock"), Shard.parse(
+            None, [u"collector2", u"collector1"]).path("/var/lock/lock"))
+        self.assertEqual(Shard.parse(None, [u"collector3"], "east")
+                         .path("/var/lib/state.json"),
+                         "/var/lib/state-east.json")
+
+    def test_servers(self):
+        """Liste explicite de collecteurs"""
+        shard = Shard.parse(None, [u"collector"])
+        self.assertEqual(shard.servers, [u"collector"])
+        self.assertFalse(shard.with_hls)
+        # Une instance peut explicitement traiter les services
+        # de haut niveau.
+        self.assertTrue(Shard.parse(None, [u"collector"], hls=True).with_hls)
+        self.assertFalse(Shard.parse("2/2", [u"collector"],
+                                     hls=True).with_hls)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste la reprise d'un envoi qui n'a pas abouti
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from mock import Mock, patch
+from twisted.internet import defer, task
+
+from vigilo.connector_syncevents.spool import Spool, MAGIC
+from vigilo.connector_syncevents.records import SupItem
+from vigilo.connector_syncevents.sender import SyncSender
+from vigilo.connector_syncevents.tracker import RequestTracker
+from vigilo.connector_syncevents.incremental import IncrementalScan
+from vigilo.connector_syncevents.state import DATE_FORMAT
+from vigilo.common.conf import settings
+from vigilo.connector_syncevents.main import load_events, track_requests, \
+                                             get_spool
+
+
+
+def make_items(count):
+    return [ SupItem(u"host%d" % i, u"service", u"collector")
+             for i in range(count) ]
+
+
+
+class FailingPublisher(object):
+    """Bus qui échoue à partir d'un certain nombre de messages."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.messages = []
+
+    def write(self, message):
+        if len(self.messages) >= self.limit:
+            return defer.fail(IOError("Bus unavailable"))
+        self.messages.append(message)
+        return defer.succeed(None)
+
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="syncevents-test-")
+        self.path = os.path.join(self.tmpdir, "spool.bin")
+        self.now = datetime(2020, 1, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_spool(self):
+        return Spool(self.path, timedelta(minutes=30), checkpoint_every=2)
+
+    def test_roundtrip(self):
+        """Les éléments sont relus à l'identique"""
+        items = [SupItem(u"hôte", None, u"collector"),
+                 SupItem(u"hôte", u"service", u"collector"),
+                 SupItem(None, u"hls", None)]
+        spool = self.make_spool()
+        self.assertEqual(spool.write(items, self.now), 3)
+        replayed = list(spool.replay())
+        self.assertEqual(replayed, items)
+        # Les chaînes identiques sont partagées.
+        self.assertTrue(replayed[0].hostname is replayed[1].hostname)
+
+    def test_compact(self):
+        """Chaque chaîne n'est enregistrée qu'une fois"""
+        spool = self.make_spool()
+        spool.write(make_items(100), self.now)
+        # 100 noms d'hôtes + 2 chaînes partagées (9 octets d'en-tête et
+        # de 4 à 9 octets de texte chacune), 100 éléments de 17 octets.
+        size = os.path.getsize(self.path) - len(MAGIC)
+        self.assertTrue(size < 100 * (17 + 9 + 6) + 2 * 20, size)
+
+    def test_checkpoint(self):
+        """L'envoi reprend au premier élément non envoyé"""
+        spool = self.make_spool()
+        spool.write(make_items(10), self.now)
+        replayed = list(spool.replay())
+        spool.acknowledge([replayed[0], replayed[1], replayed[3]])
+        self.assertEqual(spool.done, 2)
+        spool.acknowledge([replayed[2]])
+        self.assertEqual(spool.done, 4)
+        spool.finish()
+
+        spool = self.make_spool()
+        self.assertEqual(spool.pending(self.now), 6)
+        self.assertEqual(list(spool.replay()), make_items(10)[4:])
+
+    def test_complete(self):
+        """Le fichier est supprimé une fois tous les éléments envoyés"""
+        spool = self.make_spool()
+        spool.write(make_items(3), self.now)
+        spool.acknowledge(list(spool.replay()))
+        spool.finish()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.make_spool().pending(self.now), 0)
+
+    def test_expired(self):
+        """Les éléments trop anciens sont abandonnés"""
+        spool = self.make_spool()
+        spool.write(make_items(3), self.now)
+        spool.finish()
+        spool = self.make_spool()
+        self.assertEqual(spool.pending(self.now + timedelta(minutes=31)), 0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_damaged(self):
+        """Un fichier tronqué est relu jusqu'à l'endroit endommagé"""
+        spool = self.make_spool()
+        spool.write(make_items(3), self.now)
+        with open(self.path, "rb+") as spooled:
+            spooled.truncate(os.path.getsize(self.path) - 5)
+        self.assertEqual(len(list(spool.replay())), 2)
+
+    def test_sender(self):
+        """Reprise après une erreur de publication"""
+        spool = self.make_spool()
+        spool.write(make_items(10), self.now)
+        sender = SyncSender(spool.replay())
+        sender.publisher = FailingPublisher(4)
+        sender.on_done = spool.acknowledge
+        errors = []
+        sender.askNagios(None).addErrback(errors.append)
+        spool.finish()
+        self.assertEqual(len(errors), 1)
+
+        spool = self.make_spool()
+        self.assertEqual(spool.pending(self.now), 6)
+        publisher = FailingPublisher(100)
+        sender = SyncSender(spool.replay())
+        sender.publisher = publisher
+        sender.on_done = spool.acknowledge
+        sender.askNagios(None)
+        spool.finish()
+        self.assertEqual([ m["value"].split(";")[0]
+                           for m in publisher.messages ],
+                         [ "host%d" % i for i in range(4, 10) ])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_track_published(self):
+        """Seuls les éléments publiés sont suivis"""
+        spool = self.make_spool()
+        tracker = RequestTracker({}, timedelta(minutes=10),
+                                 timedelta(minutes=60))
+        sender = SyncSender(load_events(lambda: iter(make_items(10)),
+                                        spool))
+        sender.publisher = FailingPublisher(4)
+        track_requests(sender, self.now, tracker=tracker, spool=spool)
+        errors = []
+        sender.askNagios(None).addErrback(errors.append)
+        spool.finish()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(tracker), 4)
+        self.assertEqual(spool.done, 4)
+
+    def test_disabled(self):
+        """Avertissement si les éléments restants ne sont pas repris"""
+        for margin, warned in (("5", True), ("-1", False)):
+            with patch.dict(settings["connector-syncevents"],
+                            {"spool": "False", "deadline_margin": margin}):
+                with patch("vigilo.connector_syncevents.main.LOGGER") \
+                        as logger:
+                    self.assertEqual(get_spool(), None)
+            self.assertEqual(logger.warning.called, warned)
+
+    def test_incremental_resume(self):
+        """Reprise d'un envoi avec la recherche incrémentale"""
+        state = {}
+        def run(now, limit):
+            scan = IncrementalScan(state, timedelta(minutes=10))
+            spool = self.make_spool()
+            def find():
+                scan.start(now)
+                return scan.record(iter(make_items(10)))
+            sender = SyncSender(load_events(find, spool, scan, now))
+            sender.publisher = FailingPublisher(limit)
+            track_requests(sender, now, scan, spool=spool)
+            sender.askNagios(None).addErrback(lambda _failure: None)
+            spool.finish()
+            scan.finish()
+
+        run(self.now, 4)
+        self.assertEqual(len(state["asked"]), 4)
+        self.assertEqual(state["last_scan"], self.now.strftime(DATE_FORMAT))
+        # Les éléments restants sont repris sans nouvelle recherche :
+        # la date de référence n'avance pas.
+        later = self.now + timedelta(minutes=5)
+        run(later, 100)
+        self.assertEqual(len(state["asked"]), 10)
+        self.assertEqual(state["last_scan"], self.now.strftime(DATE_FORMAT))
+        self.assertEqual(state["asked"][u"host9\tservice\tcollector"],
+                         [later.strftime(DATE_FORMAT), None])
+        # L'exécution suivante traite normalement les demandes expirées.
+        scan = IncrementalScan(state, timedelta(minutes=10))
+        self.assertEqual(scan.start(self.now + timedelta(minutes=12)), None)
+        self.assertEqual(len(state["asked"]), 6)
+
+    def test_deadline(self):
+        """Les éléments restants à la date limite sont envoyés en premier"""
+        spool = self.make_spool()
+        calls = []
+        def find():
+            calls.append(None)
+            return iter(make_items(10))
+        clock = task.Clock()
+        publisher = FailingPublisher(100)
+        def write(message):
+            clock.advance(1)
+            return publisher.write(message)
+        sender = SyncSender(load_events(find, spool), deadline=5.5)
+        sender.clock = clock
+        sender.publisher = Mock()
+        sender.publisher.write.side_effect = write
+        sender.on_done = spool.acknowledge
+        errors = []
+        sender.askNagios(None).addErrback(errors.append)
+        spool.finish()
+        self.assertEqual(errors, [])
+        self.assertTrue(sender.expired)
+        self.assertEqual(sender.count, 6)
+
+        spool = self.make_spool()
+        events = load_events(find, spool)
+        self.assertEqual([ supitem.hostname for supitem in events ],
+                         [ u"host%d" % i for i in range(6, 10) ])
+        self.assertEqual(len(calls), 1)
+
+    def test_load_events(self):
+        """La recherche n'est pas relancée si un envoi est en attente"""
+        spool = self.make_spool()
+        calls = []
+        def find():
+            calls.append(None)
+            return iter(make_items(3))
+        self.assertEqual(len(list(load_events(find, spool))), 3)
+        spool.finish()
+        self.assertEqual(len(calls), 1)
+        spool = self.make_spool()
+        self.assertEqual(len(list(load_events(find, spool))), 3)
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste le démarrage du connecteur syncevents
+"""
+import unittest
+
+from vigilo.connector_syncevents.bench.startup import probe
+
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        """Le module principal ne charge ni la base de données ni le bus"""
+        result = probe("import")
+        self.assertEqual(result["heavy"], [])
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste le cache des demandes envoyées récemment
+"""
+import unittest
+
+from vigilo.connector_syncevents.suppression import SuppressionCache
+
+
+
+class DBResult(object):
+    def __init__(self, hostname, servicename, vigiloserver):
+        self.hostname = hostname
+        self.servicename = servicename
+        self.vigiloserver = vigiloserver
+
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+
+class TestSuppressionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {}
+        self.clock = Clock()
+        self.cache = SuppressionCache(self.state, 60, clock=self.clock)
+        self.items = [ DBResult(u"host%d" % i, u"svc", u"collector")
+                       for i in range(3) ]
+
+    def test_suppressed(self):
+        """Une demande récente est supprimée"""
+        self.cache.add(self.items[0])
+        self.assertTrue(self.cache.suppressed(self.items[0]))
+        self.assertFalse(self.cache.suppressed(self.items[1]))
+        self.assertEqual(list(self.cache.exclude(self.items)),
+                         self.items[1:])
+
+    def test_expiry(self):
+        """Une demande ancienne n'est plus supprimée"""
+        self.cache.add(self.items[0])
+        self.clock.now += 61
+        self.assertFalse(self.cache.suppressed(self.items[0]))
+        self.assertEqual(list(self.cache.exclude(self.items)), self.items)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_size(self):
+        """Les entrées les plus anciennes sont évincées"""
+        cache = SuppressionCache({}, 60, 2, self.clock)
+        for item in self.items:
+            cache.add(item)
+            self.clock.now += 1
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(cache.suppressed(self.items[0]))
+        self.assertTrue(cache.suppressed(self.items[2]))
+
+    def test_flush(self):
+        """Le cache est conservé dans le fichier d'état"""
+        self.cache.add(self.items[0])
+        self.clock.now += 30
+        self.cache.add(self.items[1])
+        self.cache.flush()
+        self.clock.now += 40
+        cache = SuppressionCache(self.state, 60, clock=self.clock)
+        self.assertEqual(len(cache), 1)
+        self.assertFalse(cache.suppressed(self.items[0]))
+        self.assertTrue(cache.suppressed(self.items[1]))
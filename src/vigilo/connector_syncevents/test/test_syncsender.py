@@ -13,8 +13,9 @@ import unittest
 from nose.twistedtools import reactor, deferred # pylint: disable-msg=W0611
 
 from mock import Mock
+from twisted.internet import defer, task
 
-from vigilo.connector_syncevents.main import SyncSender
+from vigilo.connector_syncevents.sender import SyncSender
 
 # on a le droit d'accéder aux attributs privés:
 # pylint: disable-msg=W0212
@@ -73,4 +74,243 @@ class TestSyncSender(unittest.TestCase):
         return d
 
 
+    @deferred(timeout=30)
+    def test_askNagios_generator(self):
+        """Fonction askNagios avec un générateur"""
+        db = DBResult("testhost", "testservice", "collector")
+        count = 42
+        tosync = ( db for _i in range(count) )
+        sender = SyncSender(tosync)
+        sender.publisher = Mock()
+        d = sender.askNagios(None)
+        def check(r):
+            self.assertEqual(len(sender.publisher.write.call_args_list), count)
+            self.assertEqual(sender.count, count)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_askNagios_window(self):
+        """Nombre limité de messages en cours d'envoi"""
+        db = DBResult("testhost", "testservice", "collector")
+        count = 10
+        pending = []
+        inflight = []
+        def write(_msg):
+            d = defer.Deferred()
+            pending.append(d)
+            inflight.append(len(pending))
+            return d
+        sender = SyncSender([ db for _i in range(count) ], max_inflight=3)
+        sender.publisher = Mock()
+        sender.publisher.write.side_effect = write
+        d = sender.askNagios(None)
+        # Seuls les 3 premiers messages ont été envoyés.
+        self.assertEqual(len(pending), 3)
+        while pending:
+            pending.pop(0).callback(None)
+        def check(r):
+            self.assertEqual(sender.count, count)
+            self.assertTrue(max(inflight) <= 3)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_askNagios_error(self):
+        """Une erreur d'envoi interrompt la synchronisation"""
+        db = DBResult("testhost", "testservice", "collector")
+        sender = SyncSender([ db for _i in range(10) ], max_inflight=3)
+        sender.publisher = Mock()
+        sender.publisher.write.side_effect = [
+            defer.succeed(None), defer.fail(RuntimeError("dummy")),
+        ] + [ defer.succeed(None) ] * 8
+        d = sender.askNagios(None)
+        def check_success(r):
+            self.fail("The error was not propagated")
+        def check_error(failure):
+            failure.trap(RuntimeError)
+            self.assertEqual(sender.count, 1)
+            self.assertEqual(len(sender.publisher.write.call_args_list), 2)
+        d.addCallbacks(check_success, check_error)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_askNagios_batch(self):
+        """Regroupement des commandes par serveur Nagios"""
+        tosync = [ DBResult("host%d" % i, "svc", "collector%d" % (i % 2))
+                   for i in range(5) ]
+        sender = SyncSender(tosync, batch_size=2)
+        sender.publisher = Mock()
+        d = sender.askNagios(None)
+        def check(r):
+            messages = [ args[0][0] for args
+                         in sender.publisher.write.call_args_list ]
+            # collector0 : 3 commandes (2 + 1), collector1 : 2 commandes.
+            self.assertEqual(len(messages), 3)
+            self.assertEqual(sender.count, 5)
+            self.assertEqual(sender.messages, 3)
+            batches = [ m for m in messages if "commands" in m ]
+            self.assertEqual(len(batches), 2)
+            for batch in batches:
+                self.assertEqual(batch["type"], "nagios-batch")
+                self.assertEqual(len(batch["commands"]), 2)
+                parity = int(batch["routing_key"][-1])
+                for command in batch["commands"]:
+                    self.assertEqual(command["cmdname"],
+                                     "SEND_CUSTOM_SVC_NOTIFICATION")
+                    self.assertEqual(int(command["value"][4]) % 2, parity)
+            # Le reste est envoyé sous forme de message simple.
+            single = [ m for m in messages if "commands" not in m ]
+            self.assertEqual(len(single), 1)
+            self.assertEqual(single[0]["routing_key"], "collector0")
+            self.assertEqual(single[0]["value"],
+                             "host4;svc;0;vigilo;syncevents")
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_askNagios_rate_limit(self):
+        """Limitation du débit par serveur Nagios"""
+        tosync = [ DBResult("host%d" % i, None, "collector")
+                   for i in range(3) ]
+        tosync.append(DBResult("host", None, "other"))
+        limiter = Mock()
+        limiter.reserve.side_effect = [0, 0.2, 0.4, 0]
+        sender = SyncSender(tosync, max_inflight=4, rate_limiter=limiter)
+        sender.publisher = Mock()
+        sender.clock = task.Clock()
+        d = sender.askNagios(None)
+        # Les messages sans délai sont envoyés immédiatement.
+        self.assertEqual(len(sender.publisher.write.call_args_list), 2)
+        self.assertEqual(
+            [ c[0][0] for c in limiter.reserve.call_args_list ],
+            ["collector"] * 3 + ["other"])
+        sender.clock.advance(0.2)
+        self.assertEqual(len(sender.publisher.write.call_args_list), 3)
+        sender.clock.advance(0.2)
+        self.assertEqual(len(sender.publisher.write.call_args_list), 4)
+        def check(_result):
+            self.assertEqual(sender.count, 4)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_askNagios_suppression(self):
+        """Les demandes envoyées récemment ne sont pas renouvelées"""
+        tosync = [ DBResult("host%d" % i, None, "collector")
+                   for i in range(3) ]
+        suppression = Mock()
+        suppression.suppressed.side_effect = lambda s: s is tosync[0]
+        sender = SyncSender(tosync, suppression=suppression)
+        sender.publisher = Mock()
+        d = sender.askNagios(None)
+        def check(_result):
+            self.assertEqual(len(sender.publisher.write.call_args_list), 2)
+            self.assertEqual(sender.suppressed, 1)
+            self.assertEqual(
+                [ c[0][0] for c in suppression.add.call_args_list ],
+                tosync[1:])
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_askNagios_deadline(self):
+        """L'envoi s'arrête sans erreur à la date limite"""
+        tosync = [ DBResult("host%d" % i, None, "collector")
+                   for i in range(10) ]
+        clock = task.Clock()
+        def write(_msg):
+            clock.advance(1)
+            return defer.succeed(None)
+        done = []
+        sender = SyncSender(tosync, deadline=3.5)
+        sender.clock = clock
+        sender.publisher = Mock()
+        sender.publisher.write.side_effect = write
+        sender.on_done = done.extend
+        d = sender.askNagios(None)
+        def check(_result):
+            # Messages envoyés à t=0, 1, 2 et 3.
+            self.assertEqual(sender.count, 4)
+            self.assertTrue(sender.expired)
+            self.assertEqual(done, tosync[:4])
+            self.assertEqual(sender.unsent, 0)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_askNagios_deadline_unsent(self):
+        """Les éléments non envoyés à la date limite sont restitués"""
+        tosync = [ DBResult("host%d" % i, None, "collector%d" % (i % 2))
+                   for i in range(6) ]
+        remaining = iter(tosync)
+        clock = task.Clock()
+        def write(_msg):
+            clock.advance(1)
+            return defer.succeed(None)
+        unsent = []
+        sender = SyncSender(remaining, batch_size=2, deadline=0.5)
+        sender.clock = clock
+        sender.publisher = Mock()
+        sender.publisher.write.side_effect = write
+        sender.on_unsent = unsent.extend
+        d = sender.askNagios(None)
+        def check(_result):
+            # Seul le premier lot (host0 et host2) a été envoyé.
+            self.assertEqual(sender.count, 2)
+            self.assertTrue(sender.expired)
+            # host1 attendait d'être regroupé.
+            self.assertEqual(unsent, [tosync[1]])
+            self.assertEqual(sender.unsent, 1)
+            # Les éléments suivants n'ont pas été lus.
+            self.assertEqual(list(remaining), tosync[3:])
+        d.addCallback(check)
+        return d
 
+
+    @deferred(timeout=30)
+    def test_askNagios_no_deadline(self):
+        """Sans date limite, tous les messages sont envoyés"""
+        tosync = [ DBResult("host%d" % i, None, "collector")
+                   for i in range(10) ]
+        clock = task.Clock()
+        clock.advance(1000)
+        sender = SyncSender(tosync)
+        sender.clock = clock
+        sender.publisher = Mock()
+        d = sender.askNagios(None)
+        def check(_result):
+            self.assertEqual(sender.count, 10)
+            self.assertFalse(sender.expired)
+        d.addCallback(check)
+        return d
+
+
+    @deferred(timeout=30)
+    def test_askNagios_on_sent(self):
+        """Seuls les éléments publiés sont signalés comme envoyés"""
+        tosync = [ DBResult("host%d" % i, None, "collector")
+                   for i in range(5) ]
+        sent = []
+        sender = SyncSender(tosync)
+        sender.publisher = Mock()
+        sender.publisher.write.side_effect = [
+            defer.succeed(None), defer.succeed(None),
+            defer.fail(RuntimeError("dummy")),
+        ]
+        sender.on_sent = sent.extend
+        d = sender.askNagios(None)
+        def check_success(r):
+            self.fail("The error was not propagated")
+        def check_error(failure):
+            failure.trap(RuntimeError)
+            self.assertEqual(sent, tosync[:2])
+        d.addCallbacks(check_success, check_error)
+        return d
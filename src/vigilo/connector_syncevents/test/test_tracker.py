@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste le suivi de l'efficacité des demandes de mise à jour
+"""
+import unittest
+from datetime import datetime, timedelta
+
+from vigilo.connector_syncevents.tracker import RequestTracker
+from vigilo.connector_syncevents.incremental import IncrementalScan
+from vigilo.connector_syncevents.records import SupItem
+
+
+
+class FakeStates(object):
+    """Dates des états, indexées par (nom d'hôte, nom de service)."""
+    def __init__(self):
+        self.timestamps = {}
+
+    def __call__(self, supitems):
+        return dict([ (supitem, self.timestamps[supitem])
+                      for supitem in supitems
+                      if supitem in self.timestamps ])
+
+
+
+class TestRequestTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.t0 = datetime(2020, 1, 1)
+        self.state = {}
+        self.states = FakeStates()
+        self.host = SupItem(u"host", None, u"collector")
+        self.svc = SupItem(u"host", u"svc", u"collector")
+        self.hls = SupItem(None, u"hls", None)
+        self.tracker = self.make_tracker()
+
+    def make_tracker(self):
+        return RequestTracker(self.state, timedelta(minutes=10),
+                              timedelta(minutes=60), threshold=2,
+                              grace=timedelta(0))
+
+    def run_once(self, now, supitems):
+        self.tracker.check(now, self.states)
+        result = list(self.tracker.exclude(supitems, now))
+        self.tracker.track(result, now)
+        self.tracker.flush(now)
+        return result
+
+    def test_refreshed(self):
+        """Les éléments dont l'état a été mis à jour sont oubliés"""
+        self.run_once(self.t0, [self.host, self.svc])
+        self.assertEqual(len(self.tracker), 2)
+        self.states.timestamps[(u"host", None)] = \
+            self.t0 + timedelta(seconds=30)
+        self.states.timestamps[(u"host", u"svc")] = self.t0
+        result = self.run_once(self.t0 + timedelta(minutes=1), [])
+        self.assertEqual(result, [])
+        self.assertEqual(len(self.tracker), 1)
+
+    def test_backoff(self):
+        """Les demandes restées sans effet sont espacées"""
+        self.run_once(self.t0, [self.svc])
+        # 1er échec : nouvelle demande au bout de 10 minutes.
+        now = self.t0 + timedelta(minutes=5)
+        self.assertEqual(self.run_once(now, [self.svc]), [])
+        self.assertEqual(self.tracker.skipped, 0) # remis à zéro par flush
+        now = self.t0 + timedelta(minutes=10)
+        self.assertEqual(self.run_once(now, [self.svc]), [self.svc])
+        # 2e échec : nouvelle demande au bout de 20 minutes.
+        now = self.t0 + timedelta(minutes=25)
+        self.assertEqual(self.run_once(now, [self.svc]), [])
+        now = self.t0 + timedelta(minutes=30)
+        self.assertEqual(self.run_once(now, [self.svc]), [self.svc])
+
+    def test_backoff_delay(self):
+        """Délai exponentiel, plafonné"""
+        delays = [ self.tracker.backoff(failures)
+                   for failures in range(6) ]
+        self.assertEqual(delays, [timedelta(0)] +
+                         [ timedelta(minutes=minutes)
+                           for minutes in (10, 20, 40, 60, 60) ])
+        self.assertEqual(self.tracker.backoff(1000), timedelta(minutes=60))
+
+    def test_grace(self):
+        """L'effet d'une demande récente n'est pas encore vérifié"""
+        self.tracker = RequestTracker(self.state, timedelta(minutes=10),
+                                      timedelta(minutes=60),
+                                      grace=timedelta(minutes=2))
+        self.run_once(self.t0, [self.host])
+        now = self.t0 + timedelta(minutes=1)
+        self.assertEqual(self.run_once(now, [self.host]), [self.host])
+
+    def test_unresponsive(self):
+        """Éléments ne répondant plus, regroupés par collecteur"""
+        for minutes in (0, 10, 30):
+            self.run_once(self.t0 + timedelta(minutes=minutes),
+                          [self.host, self.svc, self.hls])
+        self.tracker.check(self.t0 + timedelta(minutes=31), self.states)
+        self.assertEqual(self.tracker.unresponsive(), {
+            u"collector": [(u"host", None, 3), (u"host", u"svc", 3)],
+            None: [(None, u"hls", 3)],
+        })
+
+    def test_persistence(self):
+        """Le suivi est conservé dans le fichier d'état"""
+        self.run_once(self.t0, [self.host])
+        self.run_once(self.t0 + timedelta(minutes=5), [self.host])
+        self.tracker = self.make_tracker()
+        self.assertEqual(len(self.tracker), 1)
+        now = self.t0 + timedelta(minutes=6)
+        self.assertEqual(self.run_once(now, [self.host]), [])
+
+    def test_expiry(self):
+        """Les éléments qui ne sont plus demandés sont oubliés"""
+        self.run_once(self.t0, [self.host])
+        self.run_once(self.t0 + timedelta(minutes=5), [])
+        self.assertEqual(len(self.tracker), 1)
+        self.run_once(self.t0 + timedelta(minutes=80), [])
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_postpone(self):
+        """Les éléments écartés sont réexaminés par la recherche incrémentale"""
+        self.run_once(self.t0, [self.host])
+        self.tracker.check(self.t0 + timedelta(minutes=1), self.states)
+        scan = IncrementalScan({}, timedelta(minutes=60))
+        scan.start(self.t0 + timedelta(minutes=1))
+        result = list(self.tracker.exclude([self.host, self.svc],
+                                           self.t0 + timedelta(minutes=1),
+                                           scan.postpone))
+        self.assertEqual(result, [self.svc])
+        self.assertEqual(len(scan.state["asked"]), 1)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Teste la resynchronisation déclenchée par les changements d'état
+"""
+import unittest
+from datetime import datetime, timedelta
+
+# ATTENTION: ne pas utiliser twisted.trial, car nose va ignorer les erreurs
+# produites par ce module !!!
+from nose.twistedtools import reactor, deferred # pylint: disable-msg=W0611
+
+from mock import Mock, patch
+
+from vigilo.common.conf import settings
+settings.load_module(__name__)
+from vigilo.models.configure import configure_db
+configure_db(settings['database'], 'sqlalchemy_')
+
+from vigilo.models.session import DBSession, metadata
+from vigilo.models import tables
+from vigilo.models.demo import functions as df
+
+from vigilo.connector_syncevents.watcher import DeadlineIndex, QueueSource, \
+                                                SyncWatcher
+from vigilo.connector_syncevents.desync import get_watched_states
+
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+
+class TestDeadlineIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.t0 = datetime(2020, 1, 1)
+        self.index = DeadlineIndex()
+
+    def test_order(self):
+        """Les éléments sont retirés par ordre d'échéance"""
+        for idsupitem, minutes in ((1, 30), (2, 10), (3, 20)):
+            self.index.set(idsupitem, self.t0 + timedelta(minutes=minutes),
+                           ["item%d" % idsupitem], idsupitem)
+        self.assertEqual(self.index.next_deadline(),
+                         self.t0 + timedelta(minutes=10))
+        due = self.index.pop_due(self.t0 + timedelta(minutes=25))
+        self.assertEqual([ entry[0] for entry in due ], [2, 3])
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.pop_due(self.t0), [])
+
+    def test_replace(self):
+        """Seule la dernière échéance d'un élément est prise en compte"""
+        self.index.set(1, self.t0, ["item"], 1)
+        self.index.set(1, self.t0 + timedelta(minutes=10), ["item"], 1)
+        self.assertEqual(self.index.pop_due(self.t0), [])
+        self.assertEqual(len(self.index.pop_due(
+                            self.t0 + timedelta(minutes=10))), 1)
+        self.assertEqual(self.index.next_deadline(), None)
+
+    def test_limit(self):
+        """Nombre maximum d'éléments retirés à la fois"""
+        for idsupitem in range(5):
+            self.index.set(idsupitem, self.t0, ["item"], idsupitem)
+        self.assertEqual(len(self.index.pop_due(self.t0, 2)), 2)
+        self.assertEqual(len(self.index), 3)
+
+    def test_host_changed(self):
+        """Le changement d'état d'un hôte concerne aussi ses services"""
+        self.index.set(1, self.t0, ["host"], 1)
+        self.index.set(2, self.t0, ["service"], 1)
+        self.index.set(3, self.t0, ["hls"], None)
+        self.index.set(4, self.t0, ["other"], 5)
+        self.index.discard_changed([1, 3])
+        self.assertEqual([ entry[0] for entry in self.index.pop_due(self.t0) ],
+                         [4])
+
+
+
+class TestSyncWatcher(unittest.TestCase):
+
+    def setUp(self):
+        metadata.create_all()
+        for name in (u'OK', u'UNKNOWN', u'WARNING', u'CRITICAL', u'UP',
+                     u'UNREACHABLE', u'DOWN'):
+            DBSession.add(tables.StateName(statename=name, order=1))
+        df.add_application("nagios")
+        df.add_vigiloserver("collector")
+        self.t0 = datetime(2020, 1, 1)
+        self.host = df.add_host("testhost")
+        df.add_ventilation(self.host, "collector", "nagios")
+        df.add_host_state(self.host, "DOWN", timestamp=self.t0)
+        DBSession.flush()
+
+        self.clock = Clock(self.t0 + timedelta(minutes=10))
+        self.client = Mock()
+        self.client.isConnected.return_value = True
+        self.publisher = Mock()
+        self.source = QueueSource()
+        self.watcher = SyncWatcher(self.client, self.publisher, self.source,
+                                   (timedelta(minutes=45), None),
+                                   reload_interval=0, now=self.clock)
+        self.patcher = patch("vigilo.connector_syncevents.watcher"
+                             ".transaction")
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        DBSession.rollback()
+        DBSession.expunge_all()
+        metadata.drop_all()
+
+    @deferred(timeout=30)
+    def test_deadline(self):
+        """Une demande est envoyée à l'échéance de l'état"""
+        d = self.watcher.tick()
+        def before(_result):
+            self.assertEqual(len(self.watcher.index), 1)
+            self.assertFalse(self.publisher.write.called)
+            self.clock.now = self.t0 + timedelta(minutes=45)
+            return self.watcher.tick()
+        def after(_result):
+            self.assertEqual(len(self.publisher.write.call_args_list), 1)
+            message = self.publisher.write.call_args[0][0]
+            self.assertEqual(message["value"], "testhost;0;vigilo;syncevents")
+            # Nouvelle demande au bout du même délai, sauf changement.
+            self.assertEqual(self.watcher.index.next_deadline(),
+                             self.t0 + timedelta(minutes=90))
+        d.addCallback(before)
+        d.addCallback(after)
+        return d
+
+    @deferred(timeout=30)
+    def test_state_change(self):
+        """Un changement d'état met à jour l'échéance"""
+        d = self.watcher.tick()
+        def changed(_result):
+            df.add_host_state(self.host, "UP",
+                              timestamp=self.t0 + timedelta(minutes=20))
+            DBSession.flush()
+            self.source.push(self.host.idhost)
+            self.clock.now = self.t0 + timedelta(minutes=50)
+            return self.watcher.tick()
+        def check(_result):
+            self.assertEqual(len(self.watcher.index), 0)
+            self.assertFalse(self.publisher.write.called)
+        d.addCallback(changed)
+        d.addCallback(check)
+        return d
+
+    def test_watched_states_many(self):
+        """Recherche des échéances d'un grand nombre d'éléments"""
+        supitems = [self.host.idhost] + list(range(10000, 12000))
+        rows = get_watched_states(supitems=supitems)
+        self.assertEqual([ row.hostname for row in rows ], [u"testhost"])
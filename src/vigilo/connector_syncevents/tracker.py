@@ -0,0 +1,265 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Suivi de l'efficacité des demandes de mise à jour.
+
+Chaque demande envoyée est mémorisée. Lors de l'exécution suivante, on
+vérifie que l'état de l'élément a bien été mis à jour depuis la demande.
+Si ce n'est pas le cas (par exemple, parce que le collecteur ne répond
+plus), les nouvelles demandes pour cet élément sont espacées de manière
+exponentielle, de sorte que la limite C{max_events} ne soit pas consommée
+par des demandes qui ne peuvent pas aboutir.
+"""
+
+from __future__ import print_function
+from datetime import datetime, timedelta
+
+from vigilo.common.logging import get_logger
+from vigilo.common.gettext import translate
+
+from vigilo.connector_syncevents.incremental import supitem_key
+from vigilo.connector_syncevents.state import DATE_FORMAT
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+
+
+class RequestTracker(object):
+    """
+    Suivi des demandes envoyées pour chaque élément. Les entrées sont
+    conservées dans une section du fichier d'état entre deux exécutions
+    (voir L{flush}).
+
+    Chaque entrée contient la date de la dernière demande, le nombre de
+    demandes consécutives restées sans effet, la date à partir de laquelle
+    une nouvelle demande peut être envoyée et un indicateur signalant que
+    l'effet de la dernière demande n'a pas encore été vérifié.
+    """
+
+    def __init__(self, state, delay, max_delay, threshold=3,
+                 grace=timedelta(minutes=1)):
+        """
+        @param state: Section du fichier d'état réservée au suivi.
+        @type  state: C{dict}
+        @param delay: Délai avant une nouvelle demande après une première
+            demande restée sans effet. Ce délai double à chaque nouvel échec.
+        @type  delay: C{datetime.timedelta}
+        @param max_delay: Délai maximum entre deux demandes pour un même
+            élément.
+        @type  max_delay: C{datetime.timedelta}
+        @param threshold: Nombre de demandes consécutives restées sans effet
+            à partir duquel un élément est signalé comme ne répondant plus.
+        @type  threshold: C{int}
+        @param grace: Délai laissé à Nagios et au corrélateur pour traiter
+            une demande avant d'en vérifier l'effet.
+        @type  grace: C{datetime.timedelta}
+        """
+        self.state = state
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        self.threshold = threshold
+        self.grace = grace
+        self.skipped = 0
+        self._entries = {}
+        for key, requested_at, failures, retry_at, pending \
+                in state.get("entries", []):
+            self._entries[key] = [
+                datetime.strptime(requested_at, DATE_FORMAT), failures,
+                datetime.strptime(retry_at, DATE_FORMAT), pending,
+            ]
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def backoff(self, failures):
+        """
+        @param failures: Nombre de demandes consécutives restées sans effet.
+        @type  failures: C{int}
+        @return: Délai avant la prochaine demande.
+        @rtype: C{datetime.timedelta}
+        """
+        if failures <= 0:
+            return timedelta(0)
+        # Limitation de l'exposant pour éviter un dépassement de capacité.
+        delay = self.delay * (2 ** min(failures - 1, 30))
+        return min(delay, self.max_delay)
+
+
+    def check(self, now, get_timestamps):
+        """
+        Vérifie l'effet des demandes envoyées lors des exécutions
+        précédentes. Les éléments dont l'état a été mis à jour sont
+        oubliés, les autres voient le délai avant leur prochaine
+        demande augmenter.
+
+        @param now: Date de l'exécution en cours.
+        @type  now: C{datetime.datetime}
+        @param get_timestamps: Fonction renvoyant la date de l'état
+            des éléments passés en paramètre
+            (voir L{vigilo.connector_syncevents.desync.get_state_timestamps}).
+        @type  get_timestamps: C{callable}
+        """
+        limit = now - self.grace
+        pending = [ key for key, entry in self._entries.items()
+                    if entry[3] and entry[0] <= limit ]
+        if not pending:
+            return
+        supitems = {}
+        for key in pending:
+            hostname, servicename, _vigiloserver = key.split(u"\t")
+            supitems[key] = (hostname or None, servicename or None)
+        timestamps = get_timestamps(list(set(supitems.values())))
+        refreshed = 0
+        for key in pending:
+            entry = self._entries[key]
+            timestamp = timestamps.get(supitems[key])
+            if timestamp is not None and timestamp > entry[0]:
+                refreshed += 1
+                del self._entries[key]
+                continue
+            entry[1] += 1
+            entry[2] = entry[0] + self.backoff(entry[1])
+            entry[3] = False
+        LOGGER.debug(_("%(refreshed)d out of %(total)d requests had an "
+                       "effect"),
+                     {"refreshed": refreshed, "total": len(pending)})
+
+
+    def exclude(self, supitems, now, postpone=None):
+        """
+        @param supitems: Éléments à synchroniser.
+        @type  supitems: C{iterable}
+        @param now: Date de l'exécution en cours.
+        @type  now: C{datetime.datetime}
+        @param postpone: Fonction appelée pour chaque élément écarté,
+            ou C{None} (par exemple, pour que la recherche incrémentale
+            réexamine ces éléments ultérieurement).
+        @type  postpone: C{callable}
+        @return: Éléments pour lesquels une nouvelle demande peut être
+            envoyée.
+        @rtype: C{generator}
+        """
+        for supitem in supitems:
+            entry = self._entries.get(supitem_key(supitem))
+            if entry is not None and entry[2] > now:
+                self.skipped += 1
+                if postpone is not None:
+                    postpone(supitem)
+                continue
+            yield supitem
+
+
+    def track(self, supitems, now):
+        """
+        Mémorise les demandes publiées pour les éléments.
+
+        @param supitems: Hôtes/services pour lesquels une demande
+            a été publiée.
+        @type  supitems: C{list}
+        @param now: Date de l'exécution en cours.
+        @type  now: C{datetime.datetime}
+        """
+        for supitem in supitems:
+            key = supitem_key(supitem)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [now, 0, now, True]
+            else:
+                entry[0] = now
+                entry[3] = True
+
+
+    def unresponsive(self):
+        """
+        @return: Éléments dont les dernières demandes sont restées sans
+            effet, regroupés par serveur Nagios. Chaque élément est décrit
+            par un triplet (nom d'hôte, nom de service, nombre d'échecs).
+        @rtype: C{dict}
+        """
+        result = {}
+        for key, entry in self._entries.items():
+            if entry[1] < self.threshold:
+                continue
+            hostname, servicename, vigiloserver = key.split(u"\t")
+            result.setdefault(vigiloserver or None, []).append(
+                (hostname or None, servicename or None, entry[1]))
+        for supitems in result.values():
+            supitems.sort(key=lambda supitem: (supitem[0] or u"",
+                                               supitem[1] or u""))
+        return result
+
+
+    def report(self):
+        """
+        Signale les serveurs Nagios dont des éléments ne répondent plus
+        aux demandes de mise à jour.
+        """
+        if self.skipped:
+            LOGGER.info(_("Postponed %d request(s) for items which did not "
+                          "respond to previous requests"), self.skipped)
+        unresponsive = self.unresponsive()
+        for vigiloserver in sorted(unresponsive,
+                                   key=lambda server: server or u""):
+            supitems = unresponsive[vigiloserver]
+            LOGGER.warning(_("%(count)d item(s) handled by %(server)s did "
+                             "not respond to the last %(threshold)d "
+                             "requests or more"),
+                           {"count": len(supitems),
+                            "server": vigiloserver or _("(no collector)"),
+                            "threshold": self.threshold})
+
+
+    def flush(self, now):
+        """
+        Reporte le suivi dans le fichier d'état. Les entrées dont la
+        prochaine demande aurait dû être envoyée depuis longtemps sont
+        oubliées : l'élément n'est plus désynchronisé.
+
+        @param now: Date de l'exécution en cours.
+        @type  now: C{datetime.datetime}
+        """
+        limit = now - self.max_delay
+        for key, entry in list(self._entries.items()):
+            if not entry[3] and entry[2] < limit:
+                del self._entries[key]
+        self.state["entries"] = [
+            [key, entry[0].strftime(DATE_FORMAT), entry[1],
+             entry[2].strftime(DATE_FORMAT), entry[3]]
+            for key, entry in self._entries.items()
+        ]
+        self.skipped = 0
+
+
+
+def print_unresponsive(tracker):
+    """
+    Affiche les éléments ne répondant plus aux demandes de mise à jour,
+    regroupés par serveur Nagios.
+
+    @param tracker: Suivi de l'efficacité des demandes.
+    @type  tracker: L{RequestTracker}
+    @return: Nombre d'éléments affichés.
+    @rtype: C{int}
+    """
+    unresponsive = tracker.unresponsive()
+    count = 0
+    for vigiloserver in sorted(unresponsive,
+                               key=lambda server: server or u""):
+        supitems = unresponsive[vigiloserver]
+        print(u"%s (%d)" % (vigiloserver or _("(no collector)"),
+                            len(supitems)))
+        for hostname, servicename, failures in supitems:
+            if hostname is None:
+                name = servicename
+            elif servicename is None:
+                name = hostname
+            else:
+                name = u"%s/%s" % (hostname, servicename)
+            print(u"    %-60s %d" % (name, failures))
+        count += len(supitems)
+    return count
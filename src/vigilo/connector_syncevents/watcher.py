@@ -0,0 +1,437 @@
+# vim: set fileencoding=utf-8 sw=4 ts=4 et :
+# Copyright (C) 2006-2020 CS GROUP - France
+# License: GNU GPL v2 <http://www.gnu.org/licenses/gpl-2.0.html>
+
+"""
+Resynchronisation déclenchée par les changements d'état.
+
+En mode démon, le connecteur peut conserver en mémoire la date à laquelle
+chaque élément devra être synchronisé (date de son état augmentée du délai
+C{minutes_old}) et envoyer la demande de mise à jour dès cette échéance,
+au lieu de rechercher périodiquement tous les éléments désynchronisés.
+
+Les échéances sont tenues à jour à partir des notifications de changement
+d'état, fournies par une source de changements : notifications PostgreSQL
+(C{LISTEN}/C{NOTIFY}, alimentées par un trigger sur la table des états)
+ou file alimentée par le code appelant.
+"""
+
+import heapq
+from datetime import datetime
+
+import transaction
+from twisted.internet import defer, task
+
+from vigilo.common.logging import get_logger, get_error_message
+from vigilo.common.gettext import translate
+
+LOGGER = get_logger(__name__)
+_ = translate(__name__)
+
+
+# Canal sur lequel le trigger de la table des états publie l'identifiant
+# des éléments dont l'état a changé.
+DEFAULT_CHANNEL = "vigilo_state_changes"
+
+
+
+class DeadlineIndex(object):
+    """
+    Échéances de synchronisation des éléments supervisés, classées
+    dans un tas (la plus proche en tête).
+
+    Les entrées remplacées ou supprimées restent dans le tas et sont
+    ignorées lorsqu'elles en atteignent la tête.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # idsupitem -> (échéance, éléments à synchroniser, idhost)
+        self._entries = {}
+        # idhost -> identifiants de l'hôte et de ses services
+        self._by_host = {}
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, idsupitem):
+        return idsupitem in self._entries
+
+
+    def set(self, idsupitem, deadline, supitems, idhost=None):
+        """
+        Enregistre (ou remplace) l'échéance d'un élément supervisé.
+
+        @param idsupitem: Identifiant de l'élément supervisé.
+        @type  idsupitem: C{int}
+        @param deadline: Date à laquelle l'élément devra être synchronisé.
+        @type  deadline: C{datetime.datetime}
+        @param supitems: Éléments à synchroniser à cette échéance
+            (un par collecteur Nagios responsable de l'élément).
+        @type  supitems: C{list}
+        @param idhost: Identifiant de l'hôte de l'élément, ou C{None}
+            pour un service de haut niveau.
+        @type  idhost: C{int}
+        """
+        self.discard(idsupitem)
+        self._entries[idsupitem] = (deadline, supitems, idhost)
+        if idhost is not None:
+            self._by_host.setdefault(idhost, set()).add(idsupitem)
+        heapq.heappush(self._heap, (deadline, idsupitem))
+
+
+    def discard(self, idsupitem):
+        """
+        @param idsupitem: Identifiant de l'élément supervisé à oublier.
+        @type  idsupitem: C{int}
+        """
+        entry = self._entries.pop(idsupitem, None)
+        if entry is None or entry[2] is None:
+            return
+        siblings = self._by_host.get(entry[2])
+        if siblings is not None:
+            siblings.discard(idsupitem)
+            if not siblings:
+                del self._by_host[entry[2]]
+
+
+    def discard_changed(self, changed):
+        """
+        Oublie les éléments dont l'état a changé, ainsi que les services
+        des hôtes dont l'état a changé (la synchronisation d'un service
+        dépend de l'état de son hôte).
+
+        @param changed: Identifiants des éléments supervisés modifiés.
+        @type  changed: C{iterable} of C{int}
+        """
+        for idsupitem in changed:
+            for sibling in list(self._by_host.get(idsupitem, ())):
+                self.discard(sibling)
+            self.discard(idsupitem)
+
+
+    def clear(self):
+        """Oublie toutes les échéances."""
+        del self._heap[:]
+        self._entries.clear()
+        self._by_host.clear()
+
+
+    def _valid(self, deadline, idsupitem):
+        entry = self._entries.get(idsupitem)
+        return entry is not None and entry[0] == deadline
+
+
+    def next_deadline(self):
+        """
+        @return: Échéance la plus proche, ou C{None}.
+        @rtype: C{datetime.datetime}
+        """
+        while self._heap and not self._valid(*self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+
+    def pop_due(self, now, limit=0):
+        """
+        Retire les éléments dont l'échéance est atteinte.
+
+        @param now: Date courante.
+        @type  now: C{datetime.datetime}
+        @param limit: Nombre maximum d'éléments supervisés retirés,
+            ou 0 pour ne pas limiter ce nombre.
+        @type  limit: C{int}
+        @return: Liste de triplets (identifiant, éléments à synchroniser,
+            identifiant de l'hôte), de l'échéance la plus ancienne
+            à la plus récente.
+        @rtype: C{list}
+        """
+        due = []
+        while self._heap and (not limit or len(due) < limit):
+            deadline, idsupitem = self._heap[0]
+            if not self._valid(deadline, idsupitem):
+                heapq.heappop(self._heap)
+                continue
+            if deadline > now:
+                break
+            heapq.heappop(self._heap)
+            _deadline, supitems, idhost = self._entries[idsupitem]
+            self.discard(idsupitem)
+            due.append((idsupitem, supitems, idhost))
+        return due
+
+
+
+class QueueSource(object):
+    """
+    Source de changements alimentée par le code appelant (par exemple,
+    à partir des messages reçus du corrélateur).
+    """
+
+    def __init__(self):
+        self._pending = set()
+
+
+    def push(self, idsupitem):
+        """
+        @param idsupitem: Identifiant de l'élément supervisé modifié.
+        @type  idsupitem: C{int}
+        """
+        self._pending.add(idsupitem)
+
+
+    def poll(self):
+        """
+        @return: Identifiants des éléments modifiés depuis l'appel
+            précédent, ou C{None} si des changements ont pu être perdus
+            (toutes les échéances doivent alors être recalculées).
+        @rtype: C{set}
+        """
+        pending, self._pending = self._pending, set()
+        return pending
+
+
+    def close(self):
+        pass
+
+
+
+class PgNotifySource(object):
+    """
+    Source de changements utilisant les notifications de PostgreSQL
+    (C{LISTEN}/C{NOTIFY}). Un trigger sur la table des états doit publier
+    l'identifiant de l'élément modifié sur le canal écouté
+    (voir la documentation d'administration).
+    """
+
+    def __init__(self, bind, channel=DEFAULT_CHANNEL):
+        """
+        @param bind: Moteur d'accès à la base de données.
+        @type  bind: C{sqlalchemy.engine.Engine}
+        @param channel: Nom du canal de notification.
+        @type  channel: C{str}
+        """
+        self.bind = bind
+        self.channel = channel
+        self._connection = None
+
+
+    def _connect(self):
+        connection = self.bind.raw_connection()
+        # Les notifications ne sont délivrées qu'en dehors des transactions.
+        connection.connection.set_isolation_level(0)
+        cursor = connection.cursor()
+        cursor.execute('LISTEN "%s"' % self.channel)
+        cursor.close()
+        self._connection = connection
+
+
+    def poll(self):
+        """
+        @return: Identifiants des éléments modifiés depuis l'appel
+            précédent, ou C{None} si des notifications ont pu être perdues
+            (première connexion ou reconnexion à la base de données).
+        @rtype: C{set}
+        """
+        if self._connection is None:
+            try:
+                self._connect()
+            except Exception as e:
+                LOGGER.warning(_("Could not listen for state changes: %s"),
+                               get_error_message(e))
+            return None
+        dbapi = self._connection.connection
+        changed = set()
+        try:
+            dbapi.poll()
+        except Exception as e:
+            LOGGER.warning(_("Lost the connection used to listen for state "
+                             "changes: %s"), get_error_message(e))
+            self.close()
+            return None
+        while dbapi.notifies:
+            notify = dbapi.notifies.pop(0)
+            try:
+                changed.add(int(notify.payload))
+            except ValueError:
+                LOGGER.warning(_("Invalid state change notification: %r"),
+                               notify.payload)
+        return changed
+
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+
+
+class SyncWatcher(object):
+    """
+    Envoie les demandes de mise à jour à l'échéance de chaque élément,
+    d'après les changements d'état signalés par une source de changements.
+
+    Seules les resynchronisations liées à l'âge des états sont traitées
+    ici ; les désynchronisations entre états et événements restent
+    détectées par la resynchronisation périodique du démon
+    (voir L{vigilo.connector_syncevents.daemon.SyncDaemon}).
+    """
+
+    def __init__(self, client, publisher, source, delays, poll_interval=1,
+                 reload_interval=3600, max_events=0, shard=None,
+                 suppression=None, now=datetime.now):
+        """
+        @param client: Client du bus.
+        @type  client: C{vigilo.connector.client.VigiloClient}
+        @param publisher: Objet chargé de publier les messages sur le bus.
+        @type  publisher: C{vigilo.connector.handlers.BusPublisher}
+        @param source: Source des changements d'état.
+        @type  source: L{QueueSource} or L{PgNotifySource}
+        @param delays: Délais de resynchronisation des hôtes/services
+            de bas niveau et des services de haut niveau (C{None} lorsque
+            la resynchronisation correspondante est désactivée).
+        @type  delays: C{tuple} of C{datetime.timedelta}
+        @param poll_interval: Délai (en secondes) entre deux consultations
+            de la source de changements.
+        @type  poll_interval: C{float}
+        @param reload_interval: Délai (en secondes) au bout duquel toutes
+            les échéances sont recalculées, ou 0.
+        @type  reload_interval: C{int}
+        @param max_events: Nombre maximum de demandes envoyées à la fois.
+        @type  max_events: C{int}
+        @param shard: Part des collecteurs traitée, ou C{None}.
+        @type  shard: L{vigilo.connector_syncevents.shard.Shard}
+        @param suppression: Cache des demandes envoyées récemment, ou C{None}.
+        @type  suppression:
+            L{vigilo.connector_syncevents.suppression.SuppressionCache}
+        @param now: Fonction renvoyant la date courante.
+        @type  now: C{callable}
+        """
+        self.client = client
+        self.publisher = publisher
+        self.source = source
+        self.delay, self.hls_delay = delays
+        self.poll_interval = poll_interval
+        self.reload_interval = reload_interval
+        self.max_events = max_events
+        self.shard = shard
+        self.suppression = suppression
+        self.now = now
+        self.index = DeadlineIndex()
+        self._loaded = None
+        self._loop = task.LoopingCall(self.tick)
+
+
+    def start(self):
+        """Démarre la surveillance des échéances."""
+        LOGGER.info(_("Watching state changes"))
+        return self._loop.start(self.poll_interval, now=True)
+
+
+    def stop(self):
+        """Arrête la surveillance des échéances."""
+        if self._loop.running:
+            self._loop.stop()
+        self.source.close()
+
+
+    def _deadline(self, row):
+        delay = self.hls_delay if row.idhost is None else self.delay
+        return row.state_timestamp + delay
+
+
+    def refresh(self, changed=None):
+        """
+        Recalcule les échéances des éléments modifiés.
+
+        @param changed: Identifiants des éléments supervisés dont l'état
+            a changé, ou C{None} pour recalculer toutes les échéances.
+        @type  changed: C{iterable} of C{int}
+        """
+        # Import local : configure l'accès à la base de données.
+        from vigilo.connector_syncevents.desync import get_watched_states
+        from vigilo.connector_syncevents.records import StringPool, SupItem
+
+        if changed is None:
+            self.index.clear()
+            self._loaded = self.now()
+        else:
+            self.index.discard_changed(changed)
+        rows = get_watched_states(self.delay is not None,
+                                  self.hls_delay is not None,
+                                  changed, self.shard)
+        pool = StringPool()
+        entries = {}
+        for row in rows:
+            supitem = SupItem(pool(row.hostname), pool(row.servicename),
+                              pool(row.vigiloserver))
+            entry = entries.setdefault(row.idsupitem,
+                                       (self._deadline(row), [], row.idhost))
+            entry[1].append(supitem)
+        for idsupitem, (deadline, supitems, idhost) in entries.items():
+            self.index.set(idsupitem, deadline, supitems, idhost)
+        if changed is None:
+            LOGGER.debug(_("Watching %d item(s)"), len(self.index))
+
+
+    @defer.inlineCallbacks
+    def tick(self):
+        """
+        Prend en compte les changements d'état et envoie les demandes
+        de mise à jour des éléments dont l'échéance est atteinte.
+        Les erreurs sont journalisées mais n'interrompent pas la
+        surveillance.
+        """
+        try:
+            changed = self.source.poll()
+            if changed is None or self._loaded is None or \
+                    (self.reload_interval and
+                     (self.now() - self._loaded).total_seconds()
+                     >= self.reload_interval):
+                self.refresh()
+            elif changed:
+                self.refresh(changed)
+
+            if not self.client.isConnected():
+                return
+            now = self.now()
+            due = self.index.pop_due(now, self.max_events)
+            if not due:
+                return
+            yield self.send(due, now)
+        except Exception as e:
+            LOGGER.error(_("Synchronization failed: %s"),
+                         get_error_message(e))
+        finally:
+            transaction.abort()
+
+
+    @defer.inlineCallbacks
+    def send(self, due, now):
+        """
+        Envoie les demandes de mise à jour des éléments échus. En l'absence
+        de changement d'état d'ici là, une nouvelle demande sera envoyée
+        à l'issue du même délai.
+
+        @param due: Éléments échus (voir L{DeadlineIndex.pop_due}).
+        @type  due: C{list}
+        @param now: Date courante.
+        @type  now: C{datetime.datetime}
+        """
+        # Import local pour éviter une dépendance circulaire.
+        from vigilo.connector_syncevents.main import create_sender
+        for idsupitem, supitems, idhost in due:
+            delay = self.hls_delay if idhost is None else self.delay
+            self.index.set(idsupitem, now + delay, supitems, idhost)
+        to_sync = [ supitem for _id, supitems, _idhost in due
+                    for supitem in supitems ]
+        syncsender = create_sender(iter(to_sync), self.suppression)
+        syncsender.publisher = self.publisher
+        yield syncsender.askNagios(self.client)